@@ -16,6 +16,8 @@
                 of netcdf4 as the format of RAPID inflow file
               Version 1.2, 02/03/2015, bug fixing - calculate inflow assuming that
                 ECMWF runoff data is cumulative instead of incremental through time
+              Version 1.3, support runoff cropped to a region with the
+                lat_index_offset and lon_index_offset global attributes
 -------------------------------------------------------------------------------'''
 import os
 import netCDF4 as NET
@@ -142,8 +144,11 @@ class CreateInflowFileFromECMWFRunoff(object):
         var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', ('Time', streamID))
         data_temp = NUM.empty(shape = [size_time, size_streamID])
 
-        lon_ind_all = [long(i) for i in dict_list[self.header_wt[2]]]
-        lat_ind_all = [long(j) for j in dict_list[self.header_wt[3]]]
+        # Runoff cropped to a region stores the offset of the region in the global grid
+        lon_ind_offset = long(getattr(data_in_nc, 'lon_index_offset', 0))
+        lat_ind_offset = long(getattr(data_in_nc, 'lat_index_offset', 0))
+        lon_ind_all = [long(i) - lon_ind_offset for i in dict_list[self.header_wt[2]]]
+        lat_ind_all = [long(j) - lat_ind_offset for j in dict_list[self.header_wt[3]]]
 
         # Obtain a subset of  runoff data based on the indices in the weight table
         min_lon_ind_all = min(lon_ind_all)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Checks the DAG written by create_ecmwf_rapid_dag for a small synthetic
+cycle of two watershed forecasts without submitting it.
+
+The DAG is checked for the JOB, PRIORITY, RETRY and SCRIPT POST lines of
+the ensemble nodes, the PARENT/CHILD line of each post processing node,
+the FINAL node, the submit files of the nodes and the exit codes of the
+ensemble POST script after a success, a failure with retries left and a
+failure after the last retry.
+
+Usage:
+    python benchmarks/dag_check.py [--output results.json]
+"""
+import argparse
+import json
+import os
+import stat
+from subprocess import call
+import sys
+import tempfile
+from shutil import rmtree
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIRECTORY))
+
+from condor_dag import (create_ecmwf_rapid_dag,
+                        ENSEMBLE_JOB_RETRIES,
+                        FINAL_NODE_NAME,
+                        get_dag_node_name)
+
+FORECAST_DATE_TIMESTEP = "20150505.0"
+
+#rapid input directory, number of ensembles
+WATERSHED_FORECASTS = [("nfie_texas_gulf_region-huc_2_12", 3),
+                       ("magdalena-el_banco", 2),
+                       ]
+
+#watershed forecast of the cycle without ensemble jobs (finished before a restart)
+FINISHED_WATERSHED = "dominican_republic-haina"
+
+#attributes of the FINAL node merging the stage profiles
+FINAL_ATTRIBUTES = [('executable', 'stage_profiler.py'),
+                    ('arguments', "condor profile_report.txt 1430784000.0"),
+                    ('getenv', 'True'),
+                    ]
+
+def get_synthetic_dag_lists():
+    """
+    Returns the ensemble job list and post processing list for create_ecmwf_rapid_dag
+    """
+    job_list = []
+    post_processing_list = []
+    for rapid_input_directory, num_ensembles in WATERSHED_FORECASTS:
+        watershed, subbasin = rapid_input_directory.split("-")
+        for ensemble_number in range(1, num_ensembles+1):
+            job_info = {'watershed' : watershed,
+                        'subbasin' : subbasin,
+                        'forecast_date_timestep' : FORECAST_DATE_TIMESTEP,
+                        'ensemble_number' : ensemble_number,
+                        'predicted_cost' : 100.0*ensemble_number,
+                        }
+            job_name = 'job_%s_%s_%s' % (FORECAST_DATE_TIMESTEP, watershed, len(job_list))
+            job_list.append((job_name,
+                             [('executable', 'compute_ecmwf_rapid.py'),
+                              ('arguments', "%s %s" % (rapid_input_directory, ensemble_number)),
+                              ('transfer_input_files', "rapid_namelist_%s" % ensemble_number),
+                              ],
+                             job_info))
+    for rapid_input_directory, num_ensembles in WATERSHED_FORECASTS + [(FINISHED_WATERSHED, 0)]:
+        post_processing_list.append((rapid_input_directory, FORECAST_DATE_TIMESTEP,
+                                     [('executable', 'postprocess_watershed.py'),
+                                      ('arguments', "%s %s %s" % (rapid_input_directory,
+                                                                  FORECAST_DATE_TIMESTEP,
+                                                                  num_ensembles)),
+                                      ('getenv', 'True'),
+                                      ]))
+    return job_list, post_processing_list
+
+def read_submit_file(submit_file):
+    """
+    Reads the attributes of a submit file into a dictionary
+    """
+    attributes = {}
+    with open(submit_file) as submit_con:
+        for line in submit_con:
+            if " = " in line:
+                attribute, value = line.strip().split(" = ", 1)
+                attributes[attribute] = value
+            elif line.strip():
+                attributes[line.strip()] = None
+    return attributes
+
+def check_dag_lines(dag_lines, dag_directory, job_list, post_processing_list, post_script_file):
+    """
+    Checks the lines of the DAG file
+    """
+    checks = {}
+    job_node_names = [get_dag_node_name(job_name) for job_name, attributes, job_info in job_list]
+    checks['ensemble_jobs'] = all(['JOB %s %s' % (node_name, os.path.join(dag_directory, "%s.sub" % node_name)) \
+                                   in dag_lines for node_name in job_node_names])
+    checks['ensemble_priorities'] = all(['PRIORITY %s %s' % (get_dag_node_name(job_name),
+                                                             int(job_info['predicted_cost'])) in dag_lines \
+                                         for job_name, attributes, job_info in job_list])
+    checks['ensemble_retries'] = all(['RETRY %s %s' % (node_name, ENSEMBLE_JOB_RETRIES) in dag_lines \
+                                      for node_name in job_node_names])
+    checks['ensemble_post_scripts'] = all(['SCRIPT POST %s %s $RETURN $RETRY %s' % \
+                                           (node_name, post_script_file, ENSEMBLE_JOB_RETRIES) in dag_lines \
+                                           for node_name in job_node_names])
+
+    expected_parents = {}
+    for job_name, attributes, job_info in job_list:
+        post_node_name = get_dag_node_name("post_%s_%s-%s" % (job_info['forecast_date_timestep'],
+                                                              job_info['watershed'],
+                                                              job_info['subbasin']))
+        expected_parents.setdefault(post_node_name, set()).add(get_dag_node_name(job_name))
+    parent_lines = {}
+    for dag_line in dag_lines:
+        if dag_line.startswith('PARENT '):
+            parents, child = dag_line[len('PARENT '):].split(' CHILD ')
+            parent_lines[child] = set(parents.split())
+    checks['parent_child'] = parent_lines == expected_parents
+    checks['final_node'] = 'FINAL %s %s' % (FINAL_NODE_NAME,
+                                            os.path.join(dag_directory, "%s.sub" % FINAL_NODE_NAME)) \
+        in dag_lines and not [dag_line for dag_line in dag_lines \
+                              if dag_line.startswith('PARENT ') and FINAL_NODE_NAME in dag_line.split()]
+    checks['post_jobs'] = all([any([dag_line.startswith('JOB %s ' % \
+                                                        get_dag_node_name("post_%s_%s" % (forecast_date_timestep,
+                                                                                          rapid_input_directory)))
+                                    for dag_line in dag_lines]) \
+                               for rapid_input_directory, forecast_date_timestep, attributes in post_processing_list])
+    return checks
+
+def check_submit_files(dag_directory, initialdir, job_list, post_processing_list):
+    """
+    Checks the submit files of the ensemble and post processing nodes
+    """
+    submit_files_correct = []
+    node_attributes = [(get_dag_node_name(job_name), 'vanilla', attributes) \
+                       for job_name, attributes, job_info in job_list] + \
+                      [(get_dag_node_name("post_%s_%s" % (forecast_date_timestep, rapid_input_directory)),
+                        'local', attributes) \
+                       for rapid_input_directory, forecast_date_timestep, attributes in post_processing_list] + \
+                      [(FINAL_NODE_NAME, 'local', FINAL_ATTRIBUTES)]
+    for node_name, universe, attributes in node_attributes:
+        submit_attributes = read_submit_file(os.path.join(dag_directory, "%s.sub" % node_name))
+        correct = submit_attributes.get('universe') == universe and \
+            all([submit_attributes.get(attribute) == value for attribute, value in attributes]) and \
+            submit_attributes.get('initialdir') == initialdir and \
+            submit_attributes.get('log') == "%s.log" % node_name and \
+            'queue 1' in submit_attributes
+        if universe == 'vanilla':
+            correct = correct and submit_attributes.get('should_transfer_files') == 'YES'
+        submit_files_correct.append(correct)
+    return {'submit_files' : all(submit_files_correct)}
+
+def check_post_script(post_script_file):
+    """
+    Checks the exit codes of the ensemble POST script
+    """
+    #return value of the job, retry number, expected exit code
+    cases = [(0, 0, 0),
+             (1, 0, 1),
+             (1, ENSEMBLE_JOB_RETRIES - 1, 1),
+             (1, ENSEMBLE_JOB_RETRIES, 0),
+             (0, ENSEMBLE_JOB_RETRIES, 0),
+             ]
+    with open(os.devnull, 'w') as devnull:
+        exit_codes_correct = [call([post_script_file, str(job_return), str(retry), str(ENSEMBLE_JOB_RETRIES)],
+                                   stdout=devnull) == expected_exit_code \
+                              for job_return, retry, expected_exit_code in cases]
+    return {'post_script_executable' : bool(os.stat(post_script_file).st_mode & stat.S_IXUSR),
+            'post_script_exit_codes' : all(exit_codes_correct)}
+
+def run_dag_check():
+    """
+    Writes the DAG of the synthetic cycle and returns the checks
+    """
+    work_directory = tempfile.mkdtemp(prefix="dag_check_")
+    try:
+        dag_directory = os.path.join(work_directory, 'condor')
+        os.mkdir(dag_directory)
+        dag_file = os.path.join(dag_directory, 'ecmwf_rapid_check.dag')
+        job_list, post_processing_list = get_synthetic_dag_lists()
+        create_ecmwf_rapid_dag(dag_file, job_list, post_processing_list, dag_directory, FINAL_ATTRIBUTES)
+        with open(dag_file) as dag_con:
+            dag_lines = [line.strip() for line in dag_con]
+        post_script_file = os.path.join(dag_directory, 'ensemble_post.sh')
+        checks = check_dag_lines(dag_lines, dag_directory, job_list, post_processing_list, post_script_file)
+        checks.update(check_submit_files(dag_directory, dag_directory, job_list, post_processing_list))
+        checks.update(check_post_script(post_script_file))
+    finally:
+        rmtree(work_directory)
+    for check in sorted(checks):
+        print "%s: %s" % (check, checks[check])
+    return {'checks' : checks,
+            'correct' : all(checks.values()),
+            }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ECMWF-RAPID DAG check")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+    check_results = run_dag_check()
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(check_results, output_file, indent=2)
+    else:
+        print json.dumps(check_results, indent=2)
+    if not check_results['correct']:
+        sys.exit(1)
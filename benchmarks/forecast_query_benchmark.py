@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Latency of ensemble hydrograph requests on a synthetic watershed forecast.
+
+Each layout (the Qout files of the ensembles and the ensemble cube) is
+queried with:
+    file_scan -- opens every Qout file and finds the reach with np.where
+        as the web app did (Qout files only)
+    cold -- a new ForecastQuery for each request
+    warm_open -- one ForecastQuery with its files open but the requested
+        reaches not cached
+    warm_cached -- one ForecastQuery with the requested reaches cached
+
+Usage:
+    python benchmarks/forecast_query_benchmark.py --num-reaches 10000 --output query_results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIRECTORY))
+
+import netCDF4 as NET
+import numpy as np
+
+from ensemble_cube import consolidate_forecast_ensembles
+from forecast_query import ForecastQuery
+from synthetic_data import (create_qout_ensemble,
+                            get_synthetic_comids)
+
+def scan_qout_files(qout_files, comid):
+    """
+    Reads the hydrograph of a reach from every Qout file
+    """
+    hydrographs = []
+    for qout_file in qout_files:
+        data_nc = NET.Dataset(qout_file)
+        comid_index = np.where(data_nc.variables['COMID'][:] == comid)[0][0]
+        hydrographs.append(data_nc.variables['Qout'][:, comid_index])
+        data_nc.close()
+    return hydrographs
+
+def time_requests(request_function, request_comids):
+    """
+    Runs the request for each group of COMIDs and returns the latencies in seconds
+    """
+    latencies = []
+    for comids in request_comids:
+        time_start = time.time()
+        request_function(comids)
+        latencies.append(time.time() - time_start)
+    return latencies
+
+def get_latency_result(layout, mode, comids_per_request, latencies):
+    """
+    Returns the summary of the latencies of a request mode
+    """
+    latencies_ms = np.array(latencies)*1000.0
+    print "%s %s (%s COMIDs): median %0.2f ms, p95 %0.2f ms" % (layout, mode, comids_per_request,
+                                                             np.median(latencies_ms),
+                                                             np.percentile(latencies_ms, 95))
+    return {'layout' : layout,
+            'mode' : mode,
+            'comids_per_request' : comids_per_request,
+            'num_requests' : len(latencies),
+            'ms_median' : float(np.median(latencies_ms)),
+            'ms_p95' : float(np.percentile(latencies_ms, 95)),
+            'ms_mean' : float(np.mean(latencies_ms)),
+            }
+
+def run_query_benchmark(num_reaches=10000, num_ensembles=52, num_requests=50,
+                        comids_per_request=(1, 10), workspace=None, seed=0):
+    """
+    Generates a synthetic forecast and times the requests of each layout and mode
+    """
+    remove_workspace = workspace is None
+    if workspace is None:
+        workspace = tempfile.mkdtemp()
+    random_state = np.random.RandomState(seed)
+    try:
+        comids = get_synthetic_comids(num_reaches)
+        print "Generating synthetic forecast with %s reaches ..." % num_reaches
+        forecast_directory = os.path.join(workspace, 'synthetic-basin', '20150101.0')
+        qout_files = create_qout_ensemble(forecast_directory, comids, num_ensembles=num_ensembles)
+        consolidate_forecast_ensembles(forecast_directory, 'synthetic', 'basin')
+
+        results = []
+        for num_comids in comids_per_request:
+            request_comids = [random_state.choice(comids, num_comids, replace=False) \
+                              for request_index in range(num_requests)]
+            if num_comids == 1:
+                latencies = time_requests(lambda request: scan_qout_files(qout_files, request[0]), request_comids)
+                results.append(get_latency_result('qout_files', 'file_scan', num_comids, latencies))
+            for layout in ('qout_files', 'cube'):
+                def cold_request(request):
+                    forecast_query = ForecastQuery(forecast_directory, layout=layout)
+                    forecast_query.get_hydrographs(request)
+                    forecast_query.close()
+                results.append(get_latency_result(layout, 'cold', num_comids,
+                                                  time_requests(cold_request, request_comids)))
+
+                forecast_query = ForecastQuery(forecast_directory, layout=layout)
+                forecast_query.get_hydrographs(request_comids[0])
+                results.append(get_latency_result(layout, 'warm_open', num_comids,
+                                                  time_requests(forecast_query.get_hydrographs, request_comids[1:])))
+                results.append(get_latency_result(layout, 'warm_cached', num_comids,
+                                                  time_requests(forecast_query.get_hydrographs, request_comids[1:])))
+                forecast_query.close()
+    finally:
+        if remove_workspace:
+            rmtree(workspace, ignore_errors=True)
+    return {'date' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+            'host' : platform.node(),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'num_reaches' : num_reaches,
+            'num_ensembles' : num_ensembles,
+            'results' : results,
+            }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forecast hydrograph query latency benchmark")
+    parser.add_argument('--num-reaches', type=int, default=10000)
+    parser.add_argument('--num-ensembles', type=int, default=52)
+    parser.add_argument('--num-requests', type=int, default=50)
+    parser.add_argument('--comids-per-request', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--workspace', help="directory for the synthetic data (kept after the run)")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+    benchmark_results = run_query_benchmark(args.num_reaches, args.num_ensembles, args.num_requests,
+                                            args.comids_per_request, args.workspace)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        print json.dumps(benchmark_results, indent=2)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Benchmark of the ECMWF ftp download and extraction against a local ftp
+server with synthetic forecast tarballs.
+
+The server can throttle each transfer and inject disconnects and stalls
+after a number of bytes. Each scenario downloads the tarballs with
+download_all_ftp and reports the throughput, the time from each fault
+until the transfer was restarted and whether every extracted ensemble
+file matches the original.
+
+Requires pyftpdlib (pip install pyftpdlib).
+
+Usage:
+    python benchmarks/ftp_download_benchmark.py [--output results.json]
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from shutil import rmtree
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    print "pyftpdlib is required for the ftp benchmark (pip install pyftpdlib)"
+    raise
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import ftp_ecmwf_download
+
+#------------------------------------------------------------------------------
+#synthetic forecasts
+#------------------------------------------------------------------------------
+def create_synthetic_forecasts(ftp_directory, date_string, num_forecasts=2,
+                               num_ensembles=52, ensemble_size=400*1024):
+    """
+    Writes Runoff.<date>.<hour>.netcdf.tar.gz tarballs of random
+    ensemble files and returns the md5 of each ensemble file by name
+    """
+    member_md5s = {}
+    temp_directory = tempfile.mkdtemp()
+    try:
+        for forecast_index in range(num_forecasts):
+            forecast_date_timestep = "%s.%02d" % (date_string, 12*forecast_index)
+            tarball = os.path.join(ftp_directory, "Runoff.%s.netcdf.tar.gz" % forecast_date_timestep)
+            with tarfile.open(tarball, "w:gz") as tar:
+                for ensemble_number in range(1, num_ensembles+1):
+                    member_name = "%s.%s.runoff.netcdf" % (forecast_date_timestep, ensemble_number)
+                    member_file = os.path.join(temp_directory, member_name)
+                    #random data does not compress like the real files
+                    #so the tarball size is close to the sum of the members
+                    data = os.urandom(ensemble_size)
+                    with open(member_file, 'wb') as member_con:
+                        member_con.write(data)
+                    member_md5s[member_name] = hashlib.md5(data).hexdigest()
+                    tar.add(member_file, arcname=member_name)
+                    os.remove(member_file)
+    finally:
+        rmtree(temp_directory, ignore_errors=True)
+    return member_md5s
+
+#------------------------------------------------------------------------------
+#local ftp server with fault injection
+#------------------------------------------------------------------------------
+class FaultInjectingDTPHandler(ThrottledDTPHandler):
+    """
+    Data channel that throttles file transfers to write_limit bytes per
+    second and injects a disconnect or a stall after a number of bytes
+    of a transfer until the fault budget is used up
+    """
+    disconnect_after_bytes = None
+    stall_after_bytes = None
+    stall_seconds = 0
+    faults_left = 0
+    events = []
+    lock = threading.Lock()
+
+    def __init__(self, sock, cmd_channel):
+        ThrottledDTPHandler.__init__(self, sock, cmd_channel)
+        self.transfer_bytes_sent = 0
+        with self.lock:
+            FaultInjectingDTPHandler.events.append(('transfer_start', time.time()))
+
+    def use_sendfile(self):
+        #data has to go through send for the faults
+        return False
+
+    def send(self, data):
+        num_sent = ThrottledDTPHandler.send(self, data)
+        if self.file_obj is None:
+            return num_sent
+        self.transfer_bytes_sent += num_sent
+        fault = None
+        with self.lock:
+            if FaultInjectingDTPHandler.faults_left > 0:
+                if self.disconnect_after_bytes is not None \
+                        and self.transfer_bytes_sent >= self.disconnect_after_bytes:
+                    fault = 'disconnect'
+                elif self.stall_after_bytes is not None \
+                        and self.transfer_bytes_sent >= self.stall_after_bytes:
+                    fault = 'stall'
+                if fault is not None:
+                    FaultInjectingDTPHandler.faults_left -= 1
+                    FaultInjectingDTPHandler.events.append((fault, time.time()))
+        if fault == 'disconnect':
+            #drop both the data and the control connection
+            self.cmd_channel.close()
+        elif fault == 'stall':
+            time.sleep(self.stall_seconds)
+        return num_sent
+
+def configure_faults(write_limit=0, disconnect_after_bytes=None, stall_after_bytes=None,
+                     stall_seconds=0, num_faults=0):
+    """
+    Sets the throttle and faults for the next transfers
+    """
+    with FaultInjectingDTPHandler.lock:
+        FaultInjectingDTPHandler.write_limit = write_limit
+        FaultInjectingDTPHandler.disconnect_after_bytes = disconnect_after_bytes
+        FaultInjectingDTPHandler.stall_after_bytes = stall_after_bytes
+        FaultInjectingDTPHandler.stall_seconds = stall_seconds
+        FaultInjectingDTPHandler.faults_left = num_faults
+        FaultInjectingDTPHandler.events = []
+
+def start_ftp_server(ftp_directory, port, login='benchmark', passwd='benchmark'):
+    """
+    Starts the local ftp server in a background thread
+    """
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(login, passwd, ftp_directory)
+    handler = FTPHandler
+    handler.authorizer = authorizer
+    handler.dtp_handler = FaultInjectingDTPHandler
+    server = ThreadedFTPServer(('127.0.0.1', port), handler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+#------------------------------------------------------------------------------
+#measurements
+#------------------------------------------------------------------------------
+def get_recovery_times(events):
+    """
+    Returns the seconds from each fault until the next transfer started
+    """
+    recovery_times = []
+    for index, (event, event_time) in enumerate(events):
+        if event in ('disconnect', 'stall'):
+            for next_event, next_time in events[index+1:]:
+                if next_event == 'transfer_start':
+                    recovery_times.append(next_time - event_time)
+                    break
+    return recovery_times
+
+def check_extracted_files(download_dir, member_md5s):
+    """
+    Returns the names of the ensemble files missing or different
+    from the originals
+    """
+    bad_members = []
+    for member_name, member_md5 in member_md5s.iteritems():
+        forecast_date_timestep = ".".join(member_name.split(".")[:2])
+        member_file = os.path.join(download_dir, "Runoff.%s.netcdf" % forecast_date_timestep, member_name)
+        if not os.path.exists(member_file) or ftp_ecmwf_download.get_file_md5(member_file) != member_md5:
+            bad_members.append(member_name)
+    return bad_members
+
+def run_scenario(scenario, port, login, passwd, date_string, member_md5s, total_bytes):
+    """
+    Downloads all forecasts for the scenario and returns its results
+    """
+    configure_faults(write_limit=scenario.get('write_limit', 0),
+                     disconnect_after_bytes=scenario.get('disconnect_after_bytes'),
+                     stall_after_bytes=scenario.get('stall_after_bytes'),
+                     stall_seconds=scenario.get('stall_seconds', 0),
+                     num_faults=scenario.get('num_faults', 0))
+    download_dir = tempfile.mkdtemp()
+    try:
+        time_start = time.time()
+        ftp_ecmwf_download.download_all_ftp(download_dir,
+                                            'Runoff.%s*.netcdf.tar.gz' % date_string,
+                                            host='127.0.0.1',
+                                            login=login,
+                                            passwd=passwd,
+                                            directory='',
+                                            port=port,
+                                            num_connections=scenario.get('num_connections', 1),
+                                            segments_per_file=scenario.get('segments_per_file', 1),
+                                            stream_extract=scenario.get('stream_extract', False),
+                                            member_callback=None,
+                                            monitor_interval=scenario.get('monitor_interval', 5),
+                                            retry_wait=scenario.get('retry_wait', 1))
+        seconds = time.time() - time_start
+        bad_members = check_extracted_files(download_dir, member_md5s)
+    finally:
+        rmtree(download_dir, ignore_errors=True)
+    recovery_times = get_recovery_times(FaultInjectingDTPHandler.events)
+    return {'scenario' : scenario['name'],
+            'settings' : scenario,
+            'seconds' : seconds,
+            'throughput_mb_per_second' : total_bytes/(1024.0*1024.0*seconds),
+            'faults_injected' : len([event for event, event_time in FaultInjectingDTPHandler.events \
+                                     if event != 'transfer_start']),
+            'recovery_seconds' : recovery_times,
+            'files_checked' : len(member_md5s),
+            'files_bad' : len(bad_members),
+            'correct' : not bad_members,
+            }
+
+#default scenarios with a 4 MB/s limit per transfer
+DEFAULT_SCENARIOS = [
+    {'name' : 'single_connection', 'write_limit' : 4*1024*1024},
+    {'name' : 'four_connections', 'write_limit' : 4*1024*1024, 'num_connections' : 4},
+    {'name' : 'four_segments', 'write_limit' : 4*1024*1024, 'segments_per_file' : 4},
+    {'name' : 'stream_extract', 'write_limit' : 4*1024*1024, 'stream_extract' : True},
+    {'name' : 'disconnects', 'write_limit' : 4*1024*1024,
+     'disconnect_after_bytes' : 2*1024*1024, 'num_faults' : 3},
+    {'name' : 'stalls', 'write_limit' : 4*1024*1024,
+     'stall_after_bytes' : 2*1024*1024, 'stall_seconds' : 8, 'num_faults' : 2},
+    {'name' : 'stream_disconnect', 'write_limit' : 4*1024*1024, 'stream_extract' : True,
+     'disconnect_after_bytes' : 2*1024*1024, 'num_faults' : 1},
+]
+
+def run_ftp_benchmark(scenarios=DEFAULT_SCENARIOS, num_forecasts=2, num_ensembles=52,
+                      ensemble_size=400*1024, port=2121):
+    """
+    Runs the scenarios against a local ftp server and returns the results
+    """
+    login = passwd = 'benchmark'
+    date_string = datetime.datetime.utcnow().strftime('%Y%m%d')
+    ftp_directory = tempfile.mkdtemp()
+    try:
+        member_md5s = create_synthetic_forecasts(ftp_directory, date_string, num_forecasts,
+                                                 num_ensembles, ensemble_size)
+        total_bytes = sum([os.path.getsize(os.path.join(ftp_directory, file_name)) \
+                           for file_name in os.listdir(ftp_directory)])
+        #allow as many connections to the local server as the scenarios use
+        ftp_ecmwf_download.HOST_CONNECTION_LIMITS['127.0.0.1'] = \
+            max([max(scenario.get('num_connections', 1), scenario.get('segments_per_file', 1)) \
+                 for scenario in scenarios])
+        server = start_ftp_server(ftp_directory, port, login, passwd)
+        results = []
+        try:
+            for scenario in scenarios:
+                print "Running scenario", scenario['name']
+                result = run_scenario(scenario, port, login, passwd, date_string,
+                                      member_md5s, total_bytes)
+                print "%s: %0.1f s, %0.2f MB/s, %s faults, correct: %s" % \
+                    (result['scenario'], result['seconds'], result['throughput_mb_per_second'],
+                     result['faults_injected'], result['correct'])
+                results.append(result)
+        finally:
+            server.close_all()
+    finally:
+        rmtree(ftp_directory, ignore_errors=True)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ECMWF ftp download benchmark")
+    parser.add_argument('--output', help="JSON file for the results")
+    parser.add_argument('--num-forecasts', type=int, default=2)
+    parser.add_argument('--num-ensembles', type=int, default=52)
+    parser.add_argument('--ensemble-size-kb', type=int, default=400)
+    parser.add_argument('--port', type=int, default=2121)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    benchmark_results = run_ftp_benchmark(num_forecasts=args.num_forecasts,
+                                          num_ensembles=args.num_ensembles,
+                                          ensemble_size=args.ensemble_size_kb*1024,
+                                          port=args.port)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        print json.dumps(benchmark_results, indent=2)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Checks the NumPy Muskingum routing against the conventions of RAPID on a
+small reference network.
+
+The reference network has two headwater branches joining above the outlet,
+a reach in rapid_connect.csv outside of riv_bas_id.csv and riv_bas_id.csv
+in a different order than rapid_connect.csv. The routing is run through a
+RAPID namelist with run_muskingum_routing and compared with a dense
+reference that solves
+    (I - C1*N)*Q(t+dtR) = C1*Qe + C2*(N*Q(t) + Qe) + C3*Q(t)
+with numpy.linalg.solve for each routing time step. The checks are:
+    qout_average -- Qout is the average of the flows at the end of the
+        routing time steps of each ZS_TauR interval
+    qout_basin_order -- the COMID of Qout is in riv_bas_id order
+    qfinal_connect_order -- Qfinal is the flow at the end of the run in
+        rapid_connect order with zero outside of the basin
+    qinit_connect_order -- Qinit is read in rapid_connect order
+    steady_state_mass_balance -- with constant lateral inflow the flow of
+        each reach tends to the inflow of the reaches upstream of it
+    partition_routing -- routing the partitions of the basin by stage with
+        the handoffs at the cuts gives the flows of routing the whole basin
+    partition_stages -- the partitions of a random tree of
+        PARTITION_TREE_SIZE reaches cover each reach once and are routed in
+        at most MAX_PARTITION_STAGES stages
+
+Usage:
+    python benchmarks/muskingum_check.py [--output results.json]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+from shutil import rmtree
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIRECTORY))
+
+import netCDF4 as NET
+import numpy as np
+
+from muskingum_routing import (MuskingumRouter,
+                               run_muskingum_routing)
+from river_network import (get_num_stages,
+                           RiverNetwork)
+
+#rapid_connect rows (COMID, downstream COMID): 11 and 12 join into 13,
+#21 flows into 22, 13 and 22 join into the outlet 30, 40 is outside the basin
+REFERENCE_CONNECT = [(30, 0), (13, 30), (11, 13), (40, 0), (22, 30), (12, 13), (21, 22)]
+REFERENCE_BASIN = [11, 12, 21, 13, 22, 30]
+#Muskingum k (s) and x in rapid_connect order
+REFERENCE_K = [5400.0, 3600.0, 2700.0, 3600.0, 4500.0, 1800.0, 3600.0]
+REFERENCE_X = [0.3, 0.2, 0.1, 0.3, 0.25, 0.35, 0.2]
+
+ROUTING_TIME_STEP = 900
+INTERVAL = 3*3600
+NUM_INTERVALS = 8
+
+#relative tolerance of the float32 Qout file
+QOUT_TOLERANCE = 1e-5
+
+#partitions of the reference network (trunk 13-30 after 11, 12 and 21-22)
+NUM_REFERENCE_PARTITIONS = 3
+PARTITION_TREE_SIZE = 2000
+NUM_TREE_PARTITIONS = 16
+MAX_PARTITION_STAGES = 4
+
+def write_csv(csv_file, rows):
+    """
+    Writes the rows to a CSV file without header
+    """
+    with open(csv_file, 'wb') as csv_con:
+        csv.writer(csv_con).writerows(rows)
+
+def write_lateral_inflow(vlat_file, lateral_inflow_volume):
+    """
+    Writes the lateral inflow volume (Time, reach in rapid_connect order)
+    as a RAPID Vlat file
+    """
+    data_nc = NET.Dataset(vlat_file, "w", format="NETCDF3_CLASSIC")
+    try:
+        data_nc.createDimension('Time', lateral_inflow_volume.shape[0])
+        data_nc.createDimension('COMID', lateral_inflow_volume.shape[1])
+        comid_var = data_nc.createVariable('COMID', 'i4', ('COMID',))
+        comid_var[:] = [comid for comid, downstream_comid in REFERENCE_CONNECT]
+        m3_var = data_nc.createVariable('m3_riv', 'f8', ('Time', 'COMID'))
+        m3_var[:] = lateral_inflow_volume
+    finally:
+        data_nc.close()
+
+def write_reference_inputs(input_directory, lateral_inflow_volume, initial_flow):
+    """
+    Writes the RAPID inputs and namelist of the reference network and
+    returns the namelist file
+    """
+    write_csv(os.path.join(input_directory, 'rapid_connect.csv'),
+              [[comid, downstream_comid, 1 if downstream_comid else 0] \
+               for comid, downstream_comid in REFERENCE_CONNECT])
+    write_csv(os.path.join(input_directory, 'riv_bas_id.csv'), [[comid] for comid in REFERENCE_BASIN])
+    write_csv(os.path.join(input_directory, 'k.csv'), [[k] for k in REFERENCE_K])
+    write_csv(os.path.join(input_directory, 'x.csv'), [[x] for x in REFERENCE_X])
+    write_csv(os.path.join(input_directory, 'qinit.csv'), [[flow] for flow in initial_flow])
+    write_lateral_inflow(os.path.join(input_directory, 'm3_riv.nc'), lateral_inflow_volume)
+    namelist = [('BS_opt_Qinit', '.true.'),
+                ('BS_opt_Qfinal', '.true.'),
+                ('ZS_TauM', NUM_INTERVALS*INTERVAL),
+                ('ZS_dtM', INTERVAL),
+                ('ZS_TauR', INTERVAL),
+                ('ZS_dtR', ROUTING_TIME_STEP),
+                ('rapid_connect_file', "'%s'" % os.path.join(input_directory, 'rapid_connect.csv')),
+                ('riv_bas_id_file', "'%s'" % os.path.join(input_directory, 'riv_bas_id.csv')),
+                ('k_file', "'%s'" % os.path.join(input_directory, 'k.csv')),
+                ('x_file', "'%s'" % os.path.join(input_directory, 'x.csv')),
+                ('Vlat_file', "'%s'" % os.path.join(input_directory, 'm3_riv.nc')),
+                ('Qinit_file', "'%s'" % os.path.join(input_directory, 'qinit.csv')),
+                ('Qout_file', "'%s'" % os.path.join(input_directory, 'Qout.nc')),
+                ('Qfinal_file', "'%s'" % os.path.join(input_directory, 'qfinal.csv')),
+                ]
+    namelist_file = os.path.join(input_directory, 'rapid_namelist')
+    with open(namelist_file, 'w') as namelist_con:
+        namelist_con.write("&NL_namelist\n")
+        for name, value in namelist:
+            namelist_con.write("%-20s =%s\n" % (name, value))
+        namelist_con.write("/\n")
+    return namelist_file
+
+def route_dense_reference(lateral_inflow_volume, initial_flow):
+    """
+    Routes the lateral inflow volume (Time, reach in rapid_connect order) of
+    the basin reaches with a dense network matrix. Returns the average flow
+    of each interval and the final flow in basin order.
+    """
+    connect_index = dict([(comid, index) for index, (comid, downstream_comid) in enumerate(REFERENCE_CONNECT)])
+    basin_index = dict([(comid, index) for index, comid in enumerate(REFERENCE_BASIN)])
+    connect_indices = [connect_index[comid] for comid in REFERENCE_BASIN]
+    num_reaches = len(REFERENCE_BASIN)
+
+    #N[i, j] = 1 if reach j flows into reach i
+    network_matrix = np.zeros((num_reaches, num_reaches))
+    for comid, downstream_comid in REFERENCE_CONNECT:
+        if comid in basin_index and downstream_comid in basin_index:
+            network_matrix[basin_index[downstream_comid], basin_index[comid]] = 1.0
+
+    k = np.array(REFERENCE_K)[connect_indices]
+    x = np.array(REFERENCE_X)[connect_indices]
+    denominator = k*(1.0 - x) + ROUTING_TIME_STEP/2.0
+    c1 = (ROUTING_TIME_STEP/2.0 - k*x)/denominator
+    c2 = (ROUTING_TIME_STEP/2.0 + k*x)/denominator
+    c3 = (k*(1.0 - x) - ROUTING_TIME_STEP/2.0)/denominator
+    left_hand_side = np.eye(num_reaches) - np.diag(c1).dot(network_matrix)
+
+    num_steps_per_interval = INTERVAL//ROUTING_TIME_STEP
+    flow = np.asarray(initial_flow, dtype=np.float64)[connect_indices]
+    average_flow = np.zeros((lateral_inflow_volume.shape[0], num_reaches))
+    for interval_index in range(lateral_inflow_volume.shape[0]):
+        lateral_inflow_rate = lateral_inflow_volume[interval_index, connect_indices]/float(INTERVAL)
+        for step in range(num_steps_per_interval):
+            right_hand_side = c1*lateral_inflow_rate + \
+                              c2*(network_matrix.dot(flow) + lateral_inflow_rate) + \
+                              c3*flow
+            flow = np.linalg.solve(left_hand_side, right_hand_side)
+            average_flow[interval_index] += flow/num_steps_per_interval
+    return average_flow, flow
+
+def get_upstream_inflow_rate(lateral_inflow_rate):
+    """
+    Returns the lateral inflow rate of each basin reach and the reaches
+    upstream of it (the steady state flow)
+    """
+    connect_index = dict([(comid, index) for index, (comid, downstream_comid) in enumerate(REFERENCE_CONNECT)])
+    downstream = dict(REFERENCE_CONNECT)
+    steady_flow = dict([(comid, 0.0) for comid in REFERENCE_BASIN])
+    for comid in REFERENCE_BASIN:
+        reach_comid = comid
+        while reach_comid in steady_flow:
+            steady_flow[reach_comid] += lateral_inflow_rate[connect_index[comid]]
+            reach_comid = downstream[reach_comid]
+    return np.array([steady_flow[comid] for comid in REFERENCE_BASIN])
+
+def check_partition_stages(random_state):
+    """
+    Checks the partitions of a random tree
+    """
+    comids = np.arange(1, PARTITION_TREE_SIZE + 1)
+    downstream_comids = np.concatenate([[0], [random_state.randint(1, comid) for comid in comids[1:]]])
+    partitions = RiverNetwork(comids, downstream_comids).partition(NUM_TREE_PARTITIONS)
+    reach_indices = np.sort(np.concatenate([partition['reach_indices'] for partition in partitions]))
+    num_stages = get_num_stages(partitions)
+    print "Random tree of", PARTITION_TREE_SIZE, "reaches:", len(partitions), "partitions in", num_stages, "stages"
+    return bool(np.array_equal(reach_indices, np.arange(PARTITION_TREE_SIZE))) and \
+        num_stages <= MAX_PARTITION_STAGES
+
+def is_close(values, reference_values, tolerance=QOUT_TOLERANCE):
+    """
+    Checks that the values match the reference within a relative tolerance
+    """
+    values = np.asarray(values, dtype=np.float64)
+    reference_values = np.asarray(reference_values, dtype=np.float64)
+    return values.shape == reference_values.shape and \
+        bool(np.all(np.abs(values - reference_values) <= tolerance*np.maximum(1.0, np.abs(reference_values))))
+
+def run_muskingum_check():
+    """
+    Runs the routing of the reference network and returns the checks
+    """
+    random_state = np.random.RandomState(43)
+    num_connect = len(REFERENCE_CONNECT)
+    lateral_inflow_volume = random_state.uniform(0.0, 5.0, (NUM_INTERVALS, num_connect))*INTERVAL
+    initial_flow = random_state.uniform(1.0, 10.0, num_connect)
+    outside_index = [comid for comid, downstream_comid in REFERENCE_CONNECT].index(40)
+
+    work_directory = tempfile.mkdtemp(prefix="muskingum_check_")
+    checks = {}
+    try:
+        namelist_file = write_reference_inputs(work_directory, lateral_inflow_volume, initial_flow)
+        run_muskingum_routing(namelist_file)
+        reference_average_flow, reference_final_flow = route_dense_reference(lateral_inflow_volume,
+                                                                             initial_flow)
+
+        data_nc = NET.Dataset(os.path.join(work_directory, 'Qout.nc'))
+        try:
+            qout_comids = data_nc.variables['COMID'][:]
+            qout = data_nc.variables['Qout'][:]
+        finally:
+            data_nc.close()
+        checks['qout_basin_order'] = [int(comid) for comid in qout_comids] == REFERENCE_BASIN
+        checks['qout_average'] = is_close(qout, reference_average_flow)
+
+        with open(os.path.join(work_directory, 'qfinal.csv'), 'rb') as qfinal_con:
+            qfinal = np.array([float(row[0]) for row in csv.reader(qfinal_con) if row])
+        connect_index = dict([(comid, index) for index, (comid, downstream_comid) in enumerate(REFERENCE_CONNECT)])
+        reference_qfinal = np.zeros(num_connect)
+        reference_qfinal[[connect_index[comid] for comid in REFERENCE_BASIN]] = reference_final_flow
+        checks['qfinal_connect_order'] = is_close(qfinal, reference_qfinal, 1e-9) and \
+            bool(qfinal[outside_index] == 0)
+
+        #Qinit in basin order instead of rapid_connect order gives different flows
+        misordered_average_flow = route_dense_reference(lateral_inflow_volume,
+                                                        initial_flow[::-1])[0]
+        checks['qinit_connect_order'] = checks['qout_average'] and \
+            not is_close(qout[0], misordered_average_flow[0])
+
+        router = MuskingumRouter(os.path.join(work_directory, 'rapid_connect.csv'),
+                                 os.path.join(work_directory, 'riv_bas_id.csv'),
+                                 os.path.join(work_directory, 'k.csv'),
+                                 os.path.join(work_directory, 'x.csv'),
+                                 routing_time_step=ROUTING_TIME_STEP)
+        constant_inflow_rate = random_state.uniform(1.0, 5.0, num_connect)
+        steady_average_flow = router.route(np.tile(router.to_basin_order(constant_inflow_rate)*INTERVAL,
+                                                   (40, 1)), INTERVAL)[0]
+        checks['steady_state_mass_balance'] = is_close(steady_average_flow[-1],
+                                                       get_upstream_inflow_rate(constant_inflow_rate), 1e-4)
+
+        basin_lateral_inflow_volume = lateral_inflow_volume[:, router.connect_indices]
+        basin_initial_flow = router.to_basin_order(initial_flow)
+        partitions = router.network.partition(NUM_REFERENCE_PARTITIONS)
+        partition_average_flow, partition_final_flow = router.route_partitions(partitions,
+                                                                               basin_lateral_inflow_volume,
+                                                                               INTERVAL, basin_initial_flow)
+        checks['partition_routing'] = get_num_stages(partitions) == 2 and \
+            is_close(partition_average_flow, reference_average_flow, 1e-9) and \
+            is_close(partition_final_flow, reference_final_flow, 1e-9)
+        checks['partition_stages'] = check_partition_stages(random_state)
+    finally:
+        rmtree(work_directory)
+
+    for check in sorted(checks):
+        print "%s: %s" % (check, checks[check])
+    return {'checks' : checks,
+            'correct' : all(checks.values()),
+            }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Muskingum routing check against RAPID conventions")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+    check_results = run_muskingum_check()
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(check_results, output_file, indent=2)
+    else:
+        print json.dumps(check_results, indent=2)
+    if not check_results['correct']:
+        sys.exit(1)
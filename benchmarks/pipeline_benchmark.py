@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+Times each stage of the ECMWF-RAPID process on synthetic data of
+increasing river network size and writes the results as JSON so runs
+before and after a change can be compared.
+
+Stages:
+    inflow_low_res / inflow_high_res -- CreateInflowFileFromECMWFRunoff.execute
+    generate_namelist_file -- compute_ecmwf_rapid.generate_namelist_file
+    convert_to_cf -- make_CF_RAPID_output.convert_ecmwf_rapid_output_to_cf_compliant
+    compute_initial_rapid_flows -- initial_flows.compute_initial_rapid_flows
+    warning_points_return_periods -- generate_warning_points_from_return_periods
+    warning_points_era_interim -- generate_warning_points_from_era_interim_data
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --sizes 1000 10000 --output results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+SCRIPTS_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+sys.path.insert(0, SCRIPTS_DIRECTORY)
+
+import numpy as np
+
+from synthetic_data import (create_ecmwf_runoff_file,
+                            create_era_interim_file,
+                            create_qout_ensemble,
+                            create_qout_file,
+                            create_rapid_input_files,
+                            create_return_period_file,
+                            get_synthetic_forecast_date_timestep)
+
+def link_scripts_package(workspace):
+    """
+    Links the scripts as the erfp_data_process_ubuntu_aws package in the
+    workspace as on the execute nodes and adds the workspace to the path
+    """
+    package_link = os.path.join(workspace, 'erfp_data_process_ubuntu_aws')
+    if not os.path.exists(package_link):
+        os.symlink(SCRIPTS_DIRECTORY, package_link)
+    if workspace not in sys.path:
+        sys.path.insert(0, workspace)
+
+def time_stage(stage_function, setup_function=None, repeat=3):
+    """
+    Runs the stage repeat times and returns the run times in seconds.
+    The setup is run before each repetition and is not timed.
+    """
+    run_times = []
+    for repetition in range(repeat):
+        if setup_function is not None:
+            setup_function()
+        time_start = time.time()
+        stage_function()
+        run_times.append(time.time() - time_start)
+    return run_times
+
+def get_stage_result(stage, num_reaches, run_times):
+    """
+    Returns the summary of the run times of a stage
+    """
+    print "%s (%s reaches): %0.3f s" % (stage, num_reaches, min(run_times))
+    return {'stage' : stage,
+            'num_reaches' : num_reaches,
+            'seconds_min' : min(run_times),
+            'seconds_mean' : float(np.mean(run_times)),
+            'seconds_all' : run_times,
+            }
+
+def run_size_benchmark(workspace, num_reaches, num_lat, num_lon, num_ensembles, repeat, stages):
+    """
+    Generates the synthetic data for a river network size and times the stages
+    """
+    #imported here as they need the package link in the workspace
+    from erfp_data_process_ubuntu_aws.CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
+    from erfp_data_process_ubuntu_aws.compute_ecmwf_rapid import generate_namelist_file
+    from erfp_data_process_ubuntu_aws.make_CF_RAPID_output import convert_ecmwf_rapid_output_to_cf_compliant
+    from generate_warning_points_from_era_interim_data import generate_warning_points as \
+        generate_warning_points_era_interim
+    from generate_warning_points_from_return_periods import generate_warning_points as \
+        generate_warning_points_return_periods
+    from initial_flows import compute_initial_rapid_flows
+
+    size_directory = os.path.join(workspace, 'size_%s' % num_reaches)
+    os.makedirs(size_directory)
+    forecast_date_timestep = get_synthetic_forecast_date_timestep()
+
+    #node layout: inputs in rapid_input and the scripts next to them
+    node_directory = os.path.join(size_directory, 'node')
+    input_directory = os.path.join(node_directory, 'rapid_input')
+    comids = create_rapid_input_files(input_directory, num_reaches, num_lat, num_lon)
+    os.symlink(SCRIPTS_DIRECTORY, os.path.join(node_directory, 'erfp_data_process_ubuntu_aws'))
+
+    print "Generating synthetic data for %s reaches ..." % num_reaches
+    low_res_runoff_file = os.path.join(size_directory, '%s.1.runoff.netcdf' % forecast_date_timestep)
+    create_ecmwf_runoff_file(low_res_runoff_file, "LowRes", num_lat, num_lon)
+    high_res_runoff_file = os.path.join(size_directory, '%s.52.runoff.netcdf' % forecast_date_timestep)
+    create_ecmwf_runoff_file(high_res_runoff_file, "HighRes", num_lat, num_lon)
+    ensemble_directory = os.path.join(size_directory, 'ensemble')
+    qout_files = create_qout_ensemble(ensemble_directory, comids, num_ensembles=num_ensembles)
+    return_period_file = os.path.join(size_directory, 'return_periods.nc')
+    create_return_period_file(return_period_file, comids)
+    era_interim_file = os.path.join(size_directory, 'era_interim.nc')
+    create_era_interim_file(era_interim_file, comids)
+    warning_points_directory = os.path.join(size_directory, 'warning_points')
+    os.makedirs(warning_points_directory)
+    inflow_file = os.path.join(size_directory, 'm3_riv_bas.nc')
+    qinit_directory = os.path.join(size_directory, 'qinit')
+    create_rapid_input_files(qinit_directory, num_reaches, num_lat, num_lon)
+
+    def remove_inflow_file():
+        if os.path.exists(inflow_file):
+            os.remove(inflow_file)
+
+    def create_cf_input():
+        create_qout_file(os.path.join(node_directory, 'Qout_synthetic_basin_1.nc'), comids)
+
+    stage_functions = [
+        ('inflow_low_res',
+         lambda: CreateInflowFileFromECMWFRunoff().execute(low_res_runoff_file,
+                                                           os.path.join(input_directory, 'weight_low_res.csv'),
+                                                           inflow_file),
+         remove_inflow_file),
+        ('inflow_high_res',
+         lambda: CreateInflowFileFromECMWFRunoff().execute(high_res_runoff_file,
+                                                           os.path.join(input_directory, 'weight_high_res.csv'),
+                                                           inflow_file),
+         remove_inflow_file),
+        ('generate_namelist_file',
+         lambda: generate_namelist_file(node_directory, 'synthetic', 'basin', 1, forecast_date_timestep),
+         None),
+        ('convert_to_cf',
+         lambda: convert_ecmwf_rapid_output_to_cf_compliant(
+             datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"),
+             node_directory),
+         create_cf_input),
+        ('compute_initial_rapid_flows',
+         lambda: compute_initial_rapid_flows(qout_files, qinit_directory, forecast_date_timestep),
+         None),
+        ('warning_points_return_periods',
+         lambda: generate_warning_points_return_periods(ensemble_directory, return_period_file,
+                                                        warning_points_directory),
+         None),
+        ('warning_points_era_interim',
+         lambda: generate_warning_points_era_interim(ensemble_directory, era_interim_file,
+                                                     warning_points_directory),
+         None),
+    ]
+
+    results = []
+    for stage, stage_function, setup_function in stage_functions:
+        if stages and stage not in stages:
+            continue
+        try:
+            run_times = time_stage(stage_function, setup_function, repeat)
+        except Exception as ex:
+            print "Stage", stage, "failed:", ex
+            results.append({'stage' : stage, 'num_reaches' : num_reaches, 'error' : str(ex)})
+            continue
+        results.append(get_stage_result(stage, num_reaches, run_times))
+    return results
+
+def run_pipeline_benchmark(sizes=(1000, 10000), num_lat=180, num_lon=360, num_ensembles=52,
+                           repeat=3, stages=None, workspace=None):
+    """
+    Runs the stage benchmarks for each river network size
+    and returns the results
+    """
+    remove_workspace = workspace is None
+    if workspace is None:
+        workspace = tempfile.mkdtemp()
+    link_scripts_package(workspace)
+    try:
+        results = []
+        for num_reaches in sizes:
+            results += run_size_benchmark(workspace, num_reaches, num_lat, num_lon,
+                                          num_ensembles, repeat, stages)
+    finally:
+        if remove_workspace:
+            rmtree(workspace, ignore_errors=True)
+    return {'date' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+            'host' : platform.node(),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'grid' : [num_lat, num_lon],
+            'num_ensembles' : num_ensembles,
+            'repeat' : repeat,
+            'results' : results,
+            }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ECMWF-RAPID pipeline stage benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="numbers of reaches in the synthetic river networks")
+    parser.add_argument('--num-lat', type=int, default=180)
+    parser.add_argument('--num-lon', type=int, default=360)
+    parser.add_argument('--num-ensembles', type=int, default=52)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', help="only run these stages")
+    parser.add_argument('--workspace', help="directory for the synthetic data (kept after the run)")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+    benchmark_results = run_pipeline_benchmark(args.sizes, args.num_lat, args.num_lon,
+                                               args.num_ensembles, args.repeat, args.stages,
+                                               args.workspace)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        print json.dumps(benchmark_results, indent=2)
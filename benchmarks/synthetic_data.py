@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Generators of synthetic inputs and outputs of the ECMWF-RAPID process
+with the same structure as the real files for benchmarks.
+"""
+import csv
+import datetime
+import os
+
+import netCDF4 as NET
+import numpy as np
+
+#number of runoff time steps and hours between them
+LOW_RES_RUNOFF_HOURS = range(0, 361, 6)
+HIGH_RES_RUNOFF_HOURS = range(0, 91, 1) + range(93, 145, 3) + range(150, 241, 6)
+#number of 6-hr RAPID output time steps
+QOUT_TIME_STEPS = {"LowRes": 60, "HighRes": 40}
+
+def get_synthetic_comids(num_reaches, first_comid=1000):
+    """
+    Returns the COMIDs of the synthetic river network
+    """
+    return np.arange(first_comid, first_comid + num_reaches, dtype=np.int32)
+
+def get_synthetic_downstream_indices(num_reaches, seed=0):
+    """
+    Returns the index of the downstream reach of each reach (-1 for
+    outlets). Each reach flows into a reach with a higher index so the
+    reaches are ordered from upstream to downstream.
+    """
+    random_state = np.random.RandomState(seed)
+    downstream_indices = np.arange(num_reaches) + random_state.randint(1, 10, size=num_reaches)
+    downstream_indices[downstream_indices >= num_reaches] = -1
+    return downstream_indices
+
+def create_ecmwf_runoff_file(runoff_file, resolution="LowRes", num_lat=180, num_lon=360, seed=0):
+    """
+    Writes an ECMWF runoff file with cumulative runoff (m) on a global
+    grid with dimensions lon, lat and time and variables lon, lat, time, RO
+    """
+    random_state = np.random.RandomState(seed)
+    hours = LOW_RES_RUNOFF_HOURS if resolution == "LowRes" else HIGH_RES_RUNOFF_HOURS
+    data_nc = NET.Dataset(runoff_file, "w", format="NETCDF3_CLASSIC")
+    data_nc.createDimension('lon', num_lon)
+    data_nc.createDimension('lat', num_lat)
+    data_nc.createDimension('time', len(hours))
+    lon_var = data_nc.createVariable('lon', 'f8', ('lon',))
+    lon_var[:] = np.linspace(0, 360, num_lon, endpoint=False)
+    lat_var = data_nc.createVariable('lat', 'f8', ('lat',))
+    lat_var[:] = np.linspace(90, -90, num_lat)
+    time_var = data_nc.createVariable('time', 'f8', ('time',))
+    time_var[:] = hours
+    runoff_var = data_nc.createVariable('RO', 'f4', ('time', 'lat', 'lon'))
+    #runoff is cumulative through time
+    runoff_increments = random_state.uniform(0, 1e-4, size=(len(hours), num_lat, num_lon))
+    runoff_var[:] = np.cumsum(runoff_increments, axis=0)
+    data_nc.close()
+
+def create_weight_table(weight_table_file, comids, num_lat=180, num_lon=360, max_points=4, seed=0):
+    """
+    Writes a weight table with one to max_points grid cells per reach
+    """
+    random_state = np.random.RandomState(seed)
+    #keep the watershed in a window of the grid like a real region
+    lat_start = random_state.randint(0, max(1, num_lat - num_lat//4))
+    lon_start = random_state.randint(0, max(1, num_lon - num_lon//4))
+    with open(weight_table_file, 'wb') as weight_con:
+        writer = csv.writer(weight_con)
+        writer.writerow(['COMID', 'area_sqm', 'lon_index', 'lat_index', 'npoints', 'weight', 'Lon', 'Lat'])
+        for comid in comids:
+            npoints = random_state.randint(1, max_points + 1)
+            for point in range(npoints):
+                lon_index = lon_start + random_state.randint(0, max(1, num_lon//4))
+                lat_index = lat_start + random_state.randint(0, max(1, num_lat//4))
+                writer.writerow([comid, random_state.uniform(1e5, 1e7), lon_index, lat_index,
+                                 npoints, 1.0/npoints, lon_index*360.0/num_lon,
+                                 90 - lat_index*180.0/num_lat])
+
+def create_rapid_input_files(input_directory, num_reaches, num_lat=180, num_lon=360, seed=0):
+    """
+    Writes rapid_connect.csv, riv_bas_id.csv, k.csv, x.csv,
+    comid_lat_lon_z.csv and the low and high resolution weight tables
+    for a synthetic river network. Returns the COMIDs.
+    """
+    try:
+        os.makedirs(input_directory)
+    except OSError:
+        pass
+    random_state = np.random.RandomState(seed)
+    comids = get_synthetic_comids(num_reaches)
+    downstream_indices = get_synthetic_downstream_indices(num_reaches, seed)
+    upstream_comids = [[] for comid in comids]
+    for reach_index, downstream_index in enumerate(downstream_indices):
+        if downstream_index >= 0:
+            upstream_comids[downstream_index].append(comids[reach_index])
+    max_upstream = max([len(upstream) for upstream in upstream_comids] + [1])
+
+    with open(os.path.join(input_directory, 'rapid_connect.csv'), 'wb') as connect_con:
+        writer = csv.writer(connect_con)
+        for reach_index, comid in enumerate(comids):
+            downstream_index = downstream_indices[reach_index]
+            downstream_comid = comids[downstream_index] if downstream_index >= 0 else 0
+            upstream = upstream_comids[reach_index]
+            writer.writerow([comid, downstream_comid, len(upstream)] + \
+                            upstream + [0]*(max_upstream - len(upstream)))
+
+    with open(os.path.join(input_directory, 'riv_bas_id.csv'), 'wb') as riv_bas_con:
+        writer = csv.writer(riv_bas_con)
+        for comid in comids:
+            writer.writerow([comid])
+
+    with open(os.path.join(input_directory, 'k.csv'), 'wb') as k_con:
+        writer = csv.writer(k_con)
+        for k in random_state.uniform(1800, 36000, size=num_reaches):
+            writer.writerow([k])
+
+    with open(os.path.join(input_directory, 'x.csv'), 'wb') as x_con:
+        writer = csv.writer(x_con)
+        for reach_index in range(num_reaches):
+            writer.writerow([0.3])
+
+    with open(os.path.join(input_directory, 'comid_lat_lon_z.csv'), 'wb') as lookup_con:
+        writer = csv.writer(lookup_con)
+        writer.writerow(['COMID', 'Lat', 'Lon', 'Elev_m'])
+        for comid in comids:
+            writer.writerow([comid, random_state.uniform(25, 45), random_state.uniform(-120, -80),
+                             random_state.uniform(0, 2000)])
+
+    create_weight_table(os.path.join(input_directory, 'weight_low_res.csv'), comids,
+                        num_lat, num_lon, seed=seed)
+    create_weight_table(os.path.join(input_directory, 'weight_high_res.csv'), comids,
+                        num_lat, num_lon, seed=seed+1)
+    return comids
+
+def create_qout_file(qout_file, comids, resolution="LowRes", seed=0):
+    """
+    Writes a RAPID Qout file with dimensions Time and COMID
+    """
+    random_state = np.random.RandomState(seed)
+    data_nc = NET.Dataset(qout_file, "w", format="NETCDF3_CLASSIC")
+    data_nc.createDimension('Time', QOUT_TIME_STEPS[resolution])
+    data_nc.createDimension('COMID', len(comids))
+    comid_var = data_nc.createVariable('COMID', 'i4', ('COMID',))
+    comid_var[:] = comids
+    qout_var = data_nc.createVariable('Qout', 'f4', ('Time', 'COMID'))
+    qout_var[:] = random_state.lognormal(2, 1.5, size=(QOUT_TIME_STEPS[resolution], len(comids)))
+    data_nc.close()
+
+def create_qout_ensemble(output_directory, comids, watershed="synthetic", subbasin="basin",
+                         num_ensembles=52):
+    """
+    Writes the Qout files of all ensembles of a forecast
+    (ensemble 52 is the high resolution forecast)
+    """
+    try:
+        os.makedirs(output_directory)
+    except OSError:
+        pass
+    qout_files = []
+    for ensemble_number in range(1, num_ensembles+1):
+        resolution = "HighRes" if ensemble_number == 52 else "LowRes"
+        qout_file = os.path.join(output_directory, 'Qout_%s_%s_%s.nc' % (watershed, subbasin, ensemble_number))
+        create_qout_file(qout_file, comids, resolution, seed=ensemble_number)
+        qout_files.append(qout_file)
+    return qout_files
+
+def create_return_period_file(return_period_file, comids, seed=0):
+    """
+    Writes a return period file with the 2, 10 and 20 year flows of each reach
+    """
+    random_state = np.random.RandomState(seed)
+    data_nc = NET.Dataset(return_period_file, "w", format="NETCDF3_CLASSIC")
+    data_nc.createDimension('COMID', len(comids))
+    comid_var = data_nc.createVariable('COMID', 'i4', ('COMID',))
+    comid_var[:] = comids
+    return_period_2 = random_state.lognormal(3, 1.5, size=len(comids))
+    for variable_name, factor in (('return_period_2', 1.0), ('return_period_10', 2.0),
+                                  ('return_period_20', 3.0)):
+        variable = data_nc.createVariable(variable_name, 'f8', ('COMID',))
+        variable[:] = return_period_2*factor
+    lat_var = data_nc.createVariable('lat', 'f8', ('COMID',))
+    lat_var[:] = random_state.uniform(25, 45, size=len(comids))
+    lon_var = data_nc.createVariable('lon', 'f8', ('COMID',))
+    lon_var[:] = random_state.uniform(-120, -80, size=len(comids))
+    data_nc.close()
+
+def create_era_interim_file(era_interim_file, comids, num_years=5, seed=0):
+    """
+    Writes a daily ERA Interim historical flow file with dimensions COMID and time
+    """
+    random_state = np.random.RandomState(seed)
+    data_nc = NET.Dataset(era_interim_file, "w", format="NETCDF3_CLASSIC")
+    data_nc.createDimension('COMID', len(comids))
+    data_nc.createDimension('time', 365*num_years)
+    comid_var = data_nc.createVariable('COMID', 'i4', ('COMID',))
+    comid_var[:] = comids
+    qout_var = data_nc.createVariable('Qout', 'f4', ('COMID', 'time'))
+    qout_var[:] = random_state.lognormal(2, 1.5, size=(len(comids), 365*num_years))
+    lat_var = data_nc.createVariable('lat', 'f8', ('COMID',))
+    lat_var[:] = random_state.uniform(25, 45, size=len(comids))
+    lon_var = data_nc.createVariable('lon', 'f8', ('COMID',))
+    lon_var[:] = random_state.uniform(-120, -80, size=len(comids))
+    data_nc.close()
+
+def get_synthetic_forecast_date_timestep(date=None):
+    """
+    Returns the forecast date and time step string of the synthetic forecast
+    """
+    if date is None:
+        date = datetime.datetime.utcnow()
+    return "%s.00" % date.strftime("%Y%m%d")
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+Benchmark of the concurrent RAPID output upload against a local HTTP
+stand-in for the CKAN action API.
+
+The stand-in keeps datasets and resources in memory and can fail a
+number of resource_create calls per resource with HTTP 503. Each
+scenario uploads synthetic Qout files with UploadManager and is checked
+for the number of attempts, the backoff between them, the resources
+stored and that a rerun with the same upload record uploads nothing.
+
+The uploads go through a minimal data manager with the interface of
+ECMWFRAPIDDatasetManager (initialize_run_ecmwf, resource_name,
+update_resource_ensemble_number, upload_resource). With --dataset-manager
+the sfpt_dataset_manager submodule is used against the stand-in instead.
+
+Usage:
+    python benchmarks/upload_benchmark.py [--output results.json]
+"""
+import argparse
+from BaseHTTPServer import (BaseHTTPRequestHandler,
+                            HTTPServer)
+import cgi
+import datetime
+import json
+import os
+from SocketServer import ThreadingMixIn
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import uuid
+from shutil import rmtree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from output_packager import OutputPackager
+from upload_manager import UploadManager
+
+#------------------------------------------------------------------------------
+#local CKAN stand-in with fault injection
+#------------------------------------------------------------------------------
+class CKANStandIn(object):
+    """
+    In memory datasets and resources of the CKAN action API with
+    failures injected into the uploads
+    """
+    def __init__(self, failures_per_resource=0, api_key='benchmark'):
+        self.failures_per_resource = failures_per_resource
+        self.api_key = api_key
+        self.datasets = {}
+        self.resource_attempts = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def reset(self, failures_per_resource=0):
+        """
+        Removes the datasets and events and sets the failures for the next scenario
+        """
+        with self.lock:
+            self.failures_per_resource = failures_per_resource
+            self.datasets = {}
+            self.resource_attempts = {}
+            self.events = []
+
+    def call_action(self, action, data, upload=None):
+        """
+        Runs an action and returns (HTTP status, CKAN response)
+        """
+        with self.lock:
+            if action == 'package_show':
+                dataset = self.datasets.get(data.get('id'))
+                if dataset is None:
+                    return 404, {'success' : False, 'error' : {'message' : 'Not found'}}
+                return 200, {'success' : True, 'result' : dataset}
+            if action == 'package_create':
+                dataset = {'id' : data['name'], 'name' : data['name'], 'resources' : []}
+                self.datasets.setdefault(data['name'], dataset)
+                return 200, {'success' : True, 'result' : self.datasets[data['name']]}
+            if action == 'resource_create':
+                dataset = self.datasets.get(data.get('package_id'))
+                if dataset is None:
+                    return 404, {'success' : False, 'error' : {'message' : 'Dataset not found'}}
+                resource_name = data.get('name')
+                attempt = self.resource_attempts.get(resource_name, 0) + 1
+                self.resource_attempts[resource_name] = attempt
+                if attempt <= self.failures_per_resource:
+                    self.events.append(('failure', resource_name, time.time()))
+                    return 503, {'success' : False, 'error' : {'message' : 'Service unavailable'}}
+                resource = {'id' : str(uuid.uuid4()),
+                            'name' : resource_name,
+                            'size' : len(upload or ''),
+                            }
+                dataset['resources'].append(resource)
+                self.events.append(('upload', resource_name, time.time()))
+                return 200, {'success' : True, 'result' : resource}
+        return 400, {'success' : False, 'error' : {'message' : 'Unknown action %s' % action}}
+
+class CKANRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves /api/3/action/<action> with JSON or multipart form data
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_action(dict([(key, values[0]) for key, values in \
+                                 cgi.parse_qs(self.path.partition('?')[2]).iteritems()]))
+
+    def do_POST(self):
+        content_type = self.headers.getheader('content-type', '')
+        upload = None
+        if content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                    environ={'REQUEST_METHOD' : 'POST',
+                                             'CONTENT_TYPE' : content_type})
+            data = {}
+            for key in form.keys():
+                if form[key].filename:
+                    upload = form[key].file.read()
+                else:
+                    data[key] = form[key].value
+        else:
+            body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+            data = json.loads(body) if body else {}
+        self.handle_action(data, upload)
+
+    def handle_action(self, data, upload=None):
+        stand_in = self.server.stand_in
+        if self.headers.getheader('authorization') != stand_in.api_key:
+            status, response = 403, {'success' : False, 'error' : {'message' : 'Access denied'}}
+        else:
+            action = self.path.partition('?')[0].rstrip('/').split('/')[-1]
+            status, response = stand_in.call_action(action, data, upload)
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_ckan_server(stand_in, port):
+    """
+    Starts the local CKAN stand-in in a background thread
+    """
+    server = ThreadedHTTPServer(('127.0.0.1', port), CKANRequestHandler)
+    server.stand_in = stand_in
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+#------------------------------------------------------------------------------
+#data manager for the stand-in
+#------------------------------------------------------------------------------
+class CKANStandInDataManager(object):
+    """
+    Minimal ECMWF-RAPID data manager with the interface used by UploadManager
+    """
+    def __init__(self, data_store_url, api_key):
+        self.api_url = "%s/api/3/action" % data_store_url.rstrip('/')
+        self.api_key = api_key
+        self.dataset_name = None
+        self.resource_name = None
+        self.resource_base_name = None
+
+    def call_action(self, action, body, content_type='application/json'):
+        request = urllib2.Request("%s/%s" % (self.api_url, action), body,
+                                  {'Content-Type' : content_type,
+                                   'Authorization' : self.api_key})
+        try:
+            return json.loads(urllib2.urlopen(request, timeout=30).read())
+        except urllib2.HTTPError, ex:
+            try:
+                return json.loads(ex.read())
+            except ValueError:
+                return {'success' : False, 'error' : str(ex)}
+
+    def initialize_run_ecmwf(self, watershed, subbasin, date_string):
+        self.dataset_name = ("erfp-%s-%s" % (watershed, subbasin)).lower()
+        self.resource_base_name = "%s-%s-%s" % (watershed, subbasin, date_string)
+        self.resource_name = self.resource_base_name
+
+    def update_resource_ensemble_number(self, ensemble_number):
+        self.resource_name = "%s-%s" % (self.resource_base_name, ensemble_number)
+
+    def upload_resource(self, file_path):
+        dataset = self.call_action('package_show', json.dumps({'id' : self.dataset_name}))
+        if not dataset['success']:
+            dataset = self.call_action('package_create', json.dumps({'name' : self.dataset_name}))
+            if not dataset['success']:
+                return dataset
+        boundary = uuid.uuid4().hex
+        with open(file_path, 'rb') as upload_con:
+            file_data = upload_con.read()
+        body = "".join(["--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n" % \
+                        (boundary, name, value) for name, value in (('package_id', self.dataset_name),
+                                                                     ('name', self.resource_name))])
+        body += "--%s\r\nContent-Disposition: form-data; name=\"upload\"; filename=\"%s\"\r\n" \
+                "Content-Type: application/octet-stream\r\n\r\n%s\r\n--%s--\r\n" % \
+                (boundary, os.path.basename(file_path), file_data, boundary)
+        return self.call_action('resource_create', body, 'multipart/form-data; boundary=%s' % boundary)
+
+def get_data_manager_factory(data_store_url, api_key, use_dataset_manager=False):
+    """
+    Returns the factory of the data managers for the upload workers
+    """
+    if use_dataset_manager:
+        from sfpt_dataset_manager.dataset_manager import ECMWFRAPIDDatasetManager
+        return lambda: ECMWFRAPIDDatasetManager(data_store_url, api_key)
+    return lambda: CKANStandInDataManager(data_store_url, api_key)
+
+#------------------------------------------------------------------------------
+#measurements
+#------------------------------------------------------------------------------
+def create_synthetic_outputs(output_directory, num_outputs, output_size):
+    """
+    Writes random Qout files and returns the job information for their upload
+    """
+    forecast_date_timestep = datetime.datetime.utcnow().strftime('%Y%m%d.0')
+    job_info_list = []
+    for ensemble_number in range(1, num_outputs + 1):
+        outflow_file = os.path.join(output_directory, 'Qout_synthetic_basin_%s.nc' % ensemble_number)
+        with open(outflow_file, 'wb') as outflow_con:
+            outflow_con.write(os.urandom(output_size))
+        job_info_list.append({'watershed' : 'synthetic',
+                              'subbasin' : 'basin',
+                              'forecast_date_timestep' : forecast_date_timestep,
+                              'ensemble_number' : ensemble_number,
+                              'outflow_file_name' : outflow_file,
+                              'master_watershed_outflow_directory' : output_directory,
+                              })
+    return job_info_list
+
+def run_uploads(job_info_list, data_manager_factory, upload_record_file, settings):
+    """
+    Uploads the outputs with a new UploadManager and returns the states
+    reported for each output and the run time
+    """
+    states = {}
+    states_lock = threading.Lock()
+    def record_state(job_info, state):
+        with states_lock:
+            states.setdefault(job_info['ensemble_number'], []).append(state)
+    output_packager = OutputPackager(settings.get('num_package_processes', 2))
+    upload_manager = UploadManager(data_manager_factory, upload_record_file,
+                                   num_workers=settings.get('num_workers', 4),
+                                   max_attempts=settings.get('max_attempts', 5),
+                                   backoff_seconds=settings.get('backoff_seconds', 0.2),
+                                   packager=output_packager,
+                                   state_callback=record_state)
+    time_start = time.time()
+    try:
+        for job_info in job_info_list:
+            upload_manager.add_upload(job_info)
+        upload_manager.wait_for_uploads()
+    finally:
+        output_packager.close()
+    return states, time.time() - time_start, upload_manager.upload_stats
+
+def get_backoff_times(events):
+    """
+    Returns the seconds from each failed upload to the next attempt of the resource
+    """
+    backoff_times = []
+    for index, (event, resource_name, event_time) in enumerate(events):
+        if event == 'failure':
+            for next_event, next_resource_name, next_time in events[index+1:]:
+                if next_resource_name == resource_name:
+                    backoff_times.append(next_time - event_time)
+                    break
+    return backoff_times
+
+def run_scenario(scenario, stand_in, data_manager_factory, num_outputs, output_size):
+    """
+    Uploads the synthetic outputs, reruns the upload and returns the results
+    """
+    stand_in.reset(scenario.get('failures_per_resource', 0))
+    workspace = tempfile.mkdtemp()
+    try:
+        job_info_list = create_synthetic_outputs(workspace, num_outputs, output_size)
+        upload_record_file = os.path.join(workspace, 'upload_record.json')
+        states, seconds, upload_stats = run_uploads(job_info_list, data_manager_factory,
+                                                    upload_record_file, scenario)
+        with stand_in.lock:
+            events = list(stand_in.events)
+            stored_resources = [resource['name'] for dataset in stand_in.datasets.values() \
+                                for resource in dataset['resources']]
+        rerun_states, rerun_seconds, rerun_upload_stats = run_uploads(job_info_list, data_manager_factory,
+                                                                      upload_record_file, scenario)
+        with stand_in.lock:
+            rerun_events = stand_in.events[len(events):]
+    finally:
+        rmtree(workspace, ignore_errors=True)
+
+    expected_failures = min(scenario.get('failures_per_resource', 0),
+                            scenario.get('max_attempts', 5))*num_outputs
+    expect_uploaded = scenario.get('failures_per_resource', 0) < scenario.get('max_attempts', 5)
+    num_uploaded = len([ensemble_states for ensemble_states in states.values() if 'uploaded' in ensemble_states])
+    backoff_times = get_backoff_times(events)
+    checks = {'failures_injected' : len([event for event in events if event[0] == 'failure']) == expected_failures,
+              'outputs_uploaded' : num_uploaded == (num_outputs if expect_uploaded else 0),
+              'resources_stored_once' : len(stored_resources) == len(set(stored_resources)) and \
+                                        len(stored_resources) == (num_outputs if expect_uploaded else 0),
+              'backoff_waited' : all([backoff >= 0.5*scenario.get('backoff_seconds', 0.2) \
+                                      for backoff in backoff_times]),
+              'rerun_skipped' : not rerun_events and not rerun_upload_stats if expect_uploaded \
+                                else len(rerun_events) > 0,
+              'rerun_marked_uploaded' : all(['uploaded' in rerun_states.get(job_info['ensemble_number'], []) \
+                                             for job_info in job_info_list]) if expect_uploaded else True,
+              }
+    return {'scenario' : scenario['name'],
+            'settings' : scenario,
+            'seconds' : seconds,
+            'throughput_mb_per_second' : num_outputs*output_size/(1024.0*1024.0*seconds),
+            'attempts' : sum([stat['attempts'] for stat in upload_stats]),
+            'failures_injected' : len([event for event in events if event[0] == 'failure']),
+            'backoff_seconds' : backoff_times,
+            'rerun_seconds' : rerun_seconds,
+            'rerun_requests' : len(rerun_events),
+            'checks' : checks,
+            'correct' : all(checks.values()),
+            }
+
+#default scenarios with 0.2 s base backoff
+DEFAULT_SCENARIOS = [
+    {'name' : 'no_failures'},
+    {'name' : 'transient_failures', 'failures_per_resource' : 2},
+    {'name' : 'single_worker_failures', 'failures_per_resource' : 1, 'num_workers' : 1},
+    {'name' : 'attempts_exhausted', 'failures_per_resource' : 3, 'max_attempts' : 3},
+]
+
+def run_upload_benchmark(scenarios=DEFAULT_SCENARIOS, num_outputs=20, output_size=256*1024,
+                         port=5080, use_dataset_manager=False):
+    """
+    Runs the scenarios against the local CKAN stand-in and returns the results
+    """
+    stand_in = CKANStandIn()
+    server = start_ckan_server(stand_in, port)
+    data_manager_factory = get_data_manager_factory("http://127.0.0.1:%s" % port, stand_in.api_key,
+                                                    use_dataset_manager)
+    results = []
+    try:
+        for scenario in scenarios:
+            print "Running scenario", scenario['name']
+            result = run_scenario(scenario, stand_in, data_manager_factory, num_outputs, output_size)
+            print "%s: %0.1f s, %s attempts, %s failures, rerun requests: %s, correct: %s" % \
+                (result['scenario'], result['seconds'], result['attempts'], result['failures_injected'],
+                 result['rerun_requests'], result['correct'])
+            results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAPID output upload benchmark")
+    parser.add_argument('--output', help="JSON file for the results")
+    parser.add_argument('--num-outputs', type=int, default=20)
+    parser.add_argument('--output-size-kb', type=int, default=256)
+    parser.add_argument('--port', type=int, default=5080)
+    parser.add_argument('--dataset-manager', action='store_true',
+                        help="upload with sfpt_dataset_manager instead of the minimal data manager")
+    args = parser.parse_args()
+    benchmark_results = run_upload_benchmark(num_outputs=args.num_outputs,
+                                             output_size=args.output_size_kb*1024,
+                                             port=args.port,
+                                             use_dataset_manager=args.dataset_manager)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        print json.dumps(benchmark_results, indent=2)
+    if not all([result['correct'] for result in benchmark_results]):
+        sys.exit(1)
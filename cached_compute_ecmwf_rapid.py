@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Runs the ECMWF-RAPID process on a node with the watershed input and the
+scripts taken from the node input cache. The cache entries are fetched
+from the master only on a cache miss.
+
+Usage:
+    cached_compute_ecmwf_rapid.py cache_directory cache_quota_gb
+        watershed_input_hash watershed_input_archive scripts_hash
+        scripts_archive forecast watershed subbasin
+        rapid_executable_location init_flow [warm_start [routing_engine]]
+"""
+import os
+import sys
+
+from input_cache import NodeInputCache
+
+def remove_link(link_path):
+    """
+    Removes a link to a cache entry
+    """
+    try:
+        if os.path.islink(link_path):
+            os.unlink(link_path)
+    except OSError:
+        pass
+
+if __name__ == "__main__":
+    node_path = os.path.dirname(os.path.realpath(__file__))
+    forecast = sys.argv[7]
+    watershed = sys.argv[8]
+    subbasin = sys.argv[9]
+    if "," in forecast:
+        #all ensembles routed in one job
+        ensemble_number = "all"
+    else:
+        ensemble_number = int(os.path.basename(forecast).split(".")[2])
+    warm_start = len(sys.argv) > 12 and sys.argv[12].lower() == "true"
+    routing_engine = sys.argv[13] if len(sys.argv) > 13 else "rapid"
+    input_cache = NodeInputCache(sys.argv[1], float(sys.argv[2])*1024*1024*1024)
+    watershed_input_link = os.path.join(node_path, "%s-%s" % (watershed, subbasin))
+    scripts_link = os.path.join(node_path, 'erfp_data_process_ubuntu_aws')
+    try:
+        os.symlink(input_cache.get(sys.argv[3], sys.argv[4]), watershed_input_link)
+        os.symlink(input_cache.get(sys.argv[5], sys.argv[6]), scripts_link)
+        input_cache.write_stats(os.path.join(node_path, 'input_cache_stats_%s_%s_%s.json' % \
+                                             (watershed, subbasin, ensemble_number)))
+
+        from erfp_data_process_ubuntu_aws.compute_ecmwf_rapid import process_upload_ECMWF_RAPID
+        process_upload_ECMWF_RAPID(forecast, watershed, subbasin, sys.argv[10], sys.argv[11],
+                                   warm_start, node_path, routing_engine)
+    finally:
+        remove_link(watershed_input_link)
+        remove_link(os.path.join(node_path, 'rapid_input'))
+        remove_link(scripts_link)
+        input_cache.release()
@@ -6,8 +6,15 @@ import re
 from subprocess import Popen
 import sys
 
+import numpy as np
+
 from erfp_data_process_ubuntu_aws.CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
 from erfp_data_process_ubuntu_aws.make_CF_RAPID_output import convert_ecmwf_rapid_output_to_cf_compliant
+from erfp_data_process_ubuntu_aws.muskingum_routing import (MuskingumRouter,
+                                                            read_csv_column,
+                                                            read_rapid_namelist,
+                                                            run_muskingum_routing)
+from erfp_data_process_ubuntu_aws.stage_profiler import profile_stage
 #------------------------------------------------------------------------------
 #functions
 #------------------------------------------------------------------------------
@@ -34,10 +41,44 @@ def csv_to_list(csv_file, delimiter=','):
         reader = csv.reader(csv_con, delimiter=delimiter)
         return list(reader)
 
+def get_qfinal_file_name(watershed, subbasin, ensemble_number):
+    """
+    Returns the name of the Qfinal file written in warm start mode
+    """
+    return 'Qfinal_%s_%s_%s.csv' % (watershed.lower(), subbasin.lower(), ensemble_number)
+
+def get_qinit_file(rapid_input_directory, forecast_date_timestep, job_directory=None):
+    """
+    Returns the Qinit file computed from the forecast 12 hours before.
+    The file transferred into the job directory (see input_cache) is
+    used before the one in the watershed input directory.
+    """
+    past_date = (datetime.datetime.strptime(forecast_date_timestep[:11],"%Y%m%d.%H") - \
+                 datetime.timedelta(hours=12)).strftime("%Y%m%dt%H")
+    qinit_file_name = 'Qinit_%s.csv' % past_date
+    if job_directory is not None and os.path.exists(os.path.join(job_directory, qinit_file_name)):
+        return os.path.join(job_directory, qinit_file_name)
+    return os.path.join(rapid_input_directory, qinit_file_name)
+
+def get_ensemble_duration(ensemble_number):
+    """
+    Returns the duration of the forecast of the ensemble in seconds
+    """
+    if int(ensemble_number) == 52:
+        #high res is 10 days
+        return 10*24*60*60
+    #low res is 15 days
+    return 15*24*60*60
+
 def generate_namelist_file(rapid_io_files_location, watershed, subbasin,
-                           ensemble_number, forecast_date_timestep, init_flow = False):
+                           ensemble_number, forecast_date_timestep, init_flow = False,
+                           qfinal_file = None, duration = None, qout_file = None):
     """
     Generate RAPID namelist file with new input
+
+    If qfinal_file is given, RAPID writes the instantaneous flow at the end of
+    the simulation to that file (BS_opt_Qfinal). The duration (seconds) and
+    the Qout file can be overridden for short state-only runs.
     """
     rapid_input_directory = os.path.join(rapid_io_files_location, "rapid_input")
     watershed_namelist_file = os.path.join(rapid_io_files_location, 'rapid_namelist')
@@ -56,23 +97,24 @@ def generate_namelist_file(rapid_io_files_location, watershed, subbasin,
     is_riv_bas = len(riv_bas_id_table)
 
 
-    #default duration of 15 days
-    duration = 15*24*60*60
     #default interval of 6 hrs
     interval = 6*60*60
-    #if it is high res
-    if(int(ensemble_number) == 52):
-        #duration of 10 days
-        duration = 10*24*60*60
-        #interval of 3 hrs
-        #interval = 3*60*60
+    if duration is None:
+        duration = get_ensemble_duration(ensemble_number)
+    #main time step cannot be longer than the run
+    main_time_step = min(86400, duration)
+
+    if qout_file is None:
+        qout_file = os.path.join(rapid_io_files_location,
+                                 'Qout_%s_%s_%s.nc' % (watershed.lower(),
+                                                       subbasin.lower(),
+                                                       ensemble_number))
 
     qinit_file = None
     if(init_flow):
         #check for qinit file
-        past_date = (datetime.datetime.strptime(forecast_date_timestep[:11],"%Y%m%d.%H") - \
-                     datetime.timedelta(hours=12)).strftime("%Y%m%dt%H")
-        qinit_file = os.path.join(rapid_input_directory, 'Qinit_%s.csv' % past_date)
+        qinit_file = get_qinit_file(rapid_input_directory, forecast_date_timestep,
+                                    rapid_io_files_location)
         init_flow = qinit_file and os.path.exists(qinit_file)
         if not init_flow:
             print "Error:", qinit_file, "not found. Not initializing ..."
@@ -85,10 +127,15 @@ def generate_namelist_file(rapid_io_files_location, watershed, subbasin,
                 new_file.write('BS_opt_Qinit       =.true.\n')
             else:
                 new_file.write('BS_opt_Qinit       =.false.\n')
+        elif line.strip().startswith('BS_opt_Qfinal'):
+            if (qfinal_file):
+                new_file.write('BS_opt_Qfinal      =.true.\n')
+            else:
+                new_file.write('BS_opt_Qfinal      =.false.\n')
         elif line.strip().startswith('ZS_TauM'):
             new_file.write('ZS_TauM            =%s\n' % duration)
         elif line.strip().startswith('ZS_dtM'):
-            new_file.write('ZS_dtM             =%s\n' % 86400)
+            new_file.write('ZS_dtM             =%s\n' % main_time_step)
         elif line.strip().startswith('ZS_TauR'):
             new_file.write('ZS_TauR            =%s\n' % interval)
         elif line.strip().startswith('IS_riv_tot'):
@@ -109,6 +156,11 @@ def generate_namelist_file(rapid_io_files_location, watershed, subbasin,
                 new_file.write('Qinit_file         =\'%s\'\n' % qinit_file)
             else:
                 new_file.write('Qinit_file         =\'\'\n')
+        elif line.strip().startswith('Qfinal_file'):
+            if (qfinal_file):
+                new_file.write('Qfinal_file        =\'%s\'\n' % qfinal_file)
+            else:
+                new_file.write('Qfinal_file        =\'\'\n')
         elif line.strip().startswith('k_file'):
             new_file.write('k_file             =\'%s\'\n' % case_insensitive_file_search(rapid_input_directory,
                                                                                          r'k\.csv'))
@@ -116,10 +168,7 @@ def generate_namelist_file(rapid_io_files_location, watershed, subbasin,
             new_file.write('x_file             =\'%s\'\n' % case_insensitive_file_search(rapid_input_directory,
                                                                                          r'x\.csv'))
         elif line.strip().startswith('Qout_file'):
-            new_file.write('Qout_file          =\'%s\'\n' % os.path.join(rapid_io_files_location,
-                                                                         'Qout_%s_%s_%s.nc' % (watershed.lower(),
-                                                                                               subbasin.lower(),
-                                                                                               ensemble_number)))
+            new_file.write('Qout_file          =\'%s\'\n' % qout_file)
         else:
             new_file.write(line)
 
@@ -127,19 +176,35 @@ def generate_namelist_file(rapid_io_files_location, watershed, subbasin,
     new_file.close()
     old_file.close()
 
+def run_routing(local_rapid_executable, rapid_namelist_file, routing_engine):
+    """
+    Runs RAPID or the NumPy Muskingum routing with the namelist file
+    """
+    if routing_engine == "muskingum":
+        run_muskingum_routing(rapid_namelist_file)
+    else:
+        process = Popen([local_rapid_executable], shell=True)
+        process.communicate()
+
 def run_RAPID_single_watershed(forecast, watershed, subbasin,
-                               rapid_executable_location, node_path, init_flow):
+                               rapid_executable_location, node_path, init_flow,
+                               warm_start=False, routing_engine="rapid"):
     """
     run RAPID on single watershed after ECMWF prepared
+
+    With routing_engine "muskingum", the NumPy Muskingum routing is run
+    in this process with the same namelist instead of the RAPID executable.
     """
     forecast_split = os.path.basename(forecast).split(".")
     ensemble_number = int(forecast_split[2])
     forecast_date_timestep = ".".join(forecast_split[:2])
+    profile_label = "%s_%s_%s_%s" % (forecast_date_timestep, watershed, subbasin, ensemble_number)
     rapid_namelist_file = os.path.join(node_path,'rapid_namelist')
     local_rapid_executable = os.path.join(node_path,'rapid')
 
     #create link to RAPID
-    os.symlink(rapid_executable_location, local_rapid_executable)
+    if routing_engine != "muskingum":
+        os.symlink(rapid_executable_location, local_rapid_executable)
 
     time_start_rapid = datetime.datetime.utcnow()
 
@@ -169,26 +234,154 @@ def run_RAPID_single_watershed(forecast, watershed, subbasin,
     #run RAPID
     print "Running RAPID for:", subbasin, "Ensemble:", ensemble_number
     try:
-        process = Popen([local_rapid_executable], shell=True)
-        process.communicate()
+        with profile_stage('rapid', node_path, profile_label):
+            run_routing(local_rapid_executable, rapid_namelist_file, routing_engine)
     except Exception:
         rapid_cleanup(local_rapid_executable, rapid_namelist_file)
         raise
 
     print "Time to run RAPID:",(datetime.datetime.utcnow()-time_start_rapid)
 
+    if warm_start:
+        #run RAPID for 12 hrs to write the state for the next forecast
+        print "Writing Qfinal for:", subbasin, "Ensemble:", ensemble_number
+        warm_start_qout_file = os.path.join(node_path, 'warm_start_%s_%s_%s.nc' % (watershed.lower(),
+                                                                                 subbasin.lower(),
+                                                                                 ensemble_number))
+        generate_namelist_file(node_path, watershed, subbasin, ensemble_number,
+                               forecast_date_timestep, init_flow,
+                               qfinal_file=os.path.join(node_path, get_qfinal_file_name(watershed, subbasin,
+                                                                                        ensemble_number)),
+                               duration=12*60*60,
+                               qout_file=warm_start_qout_file)
+        try:
+            with profile_stage('rapid_warm_start', node_path, profile_label):
+                run_routing(local_rapid_executable, rapid_namelist_file, routing_engine)
+        except Exception:
+            rapid_cleanup(local_rapid_executable, rapid_namelist_file)
+            raise
+        finally:
+            try:
+                os.remove(warm_start_qout_file)
+            except OSError:
+                pass
+
     rapid_cleanup(local_rapid_executable, rapid_namelist_file)
 
     #convert rapid output to be CF compliant
     convert_ecmwf_rapid_output_to_cf_compliant(datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"),
                                                node_path)
 
+def process_ECMWF_RAPID_ensemble(ecmwf_forecasts, watershed, subbasin, init_flow,
+                                 warm_start=False, node_path=None):
+    """
+    Downscales the forecasts of all ensembles for the watershed and routes
+    them at once with the NumPy Muskingum routing as a (time, reach, ensemble)
+    cube, so the river network is set up once per watershed instead of
+    once per ensemble. The high resolution ensemble is zero padded to the
+    length of the low resolution ensembles. Writes the Qout file (and the
+    Qfinal file in warm start mode) of each ensemble like the single
+    ensemble jobs.
+    """
+    if node_path is None:
+        node_path = os.path.dirname(os.path.realpath(__file__))
+    forecast_basenames = sorted([os.path.basename(forecast) for forecast in ecmwf_forecasts],
+                                key=lambda forecast_basename: int(forecast_basename.split(".")[2]))
+    ensemble_numbers = [int(forecast_basename.split(".")[2]) for forecast_basename in forecast_basenames]
+    forecast_date_timestep = ".".join(forecast_basenames[0].split(".")[:2])
+    profile_label = "%s_%s_%s_all" % (forecast_date_timestep, watershed, subbasin)
+    old_rapid_input_directory = os.path.join(node_path, "%s-%s" % (watershed, subbasin))
+    rapid_input_directory = os.path.join(node_path, "rapid_input")
+
+    #rename rapid input directory
+    os.rename(old_rapid_input_directory, rapid_input_directory)
+
+    time_start_all = datetime.datetime.utcnow()
+    template_namelist_file = case_insensitive_file_search(os.path.join(node_path, 'erfp_data_process_ubuntu_aws'),
+                                                          'rapid_namelist_template\.dat')
+    router = MuskingumRouter(case_insensitive_file_search(rapid_input_directory, r'rapid_connect\.csv'),
+                             case_insensitive_file_search(rapid_input_directory, r'riv_bas_id.*?\.csv'),
+                             case_insensitive_file_search(rapid_input_directory, r'k\.csv'),
+                             case_insensitive_file_search(rapid_input_directory, r'x\.csv'),
+                             routing_time_step=float(read_rapid_namelist(template_namelist_file)['ZS_dtR']))
+
+    #6-hr lateral inflow of all ensembles
+    interval = 6*60*60
+    num_intervals = [get_ensemble_duration(ensemble_number)/interval for ensemble_number in ensemble_numbers]
+    inflow_cube = np.zeros((max(num_intervals), router.num_reaches, len(ensemble_numbers)))
+    for ensemble_index, ensemble_number in enumerate(ensemble_numbers):
+        if ensemble_number == 52:
+            weight_table_file = case_insensitive_file_search(rapid_input_directory,
+                                                             r'weight_high_res.csv')
+        else:
+            weight_table_file = case_insensitive_file_search(rapid_input_directory,
+                                                             r'weight_low_res.csv')
+        inflow_file = os.path.join(node_path, 'm3_riv_bas_%s.nc' % ensemble_number)
+        print "Converting ECMWF inflow for:", watershed, subbasin, forecast_date_timestep, ensemble_number
+        try:
+            with profile_stage('inflow', node_path, "%s_%s_%s_%s" % (forecast_date_timestep, watershed,
+                                                                     subbasin, ensemble_number)):
+                CreateInflowFileFromECMWFRunoff().execute(os.path.join(node_path, forecast_basenames[ensemble_index]),
+                                                          weight_table_file, inflow_file)
+            lateral_inflow_volume = router.read_lateral_inflow(inflow_file, num_intervals[ensemble_index])
+            inflow_cube[:lateral_inflow_volume.shape[0], :, ensemble_index] = lateral_inflow_volume
+        finally:
+            try:
+                os.remove(inflow_file)
+            except OSError:
+                pass
+    print "Time to convert ECMWF: %s" % (datetime.datetime.utcnow()-time_start_all)
+
+    initial_flow = None
+    if init_flow:
+        qinit_file = get_qinit_file(rapid_input_directory, forecast_date_timestep, node_path)
+        if os.path.exists(qinit_file):
+            initial_flow = router.to_basin_order(read_csv_column(qinit_file))[:, np.newaxis]
+        else:
+            print "Error:", qinit_file, "not found. Not initializing ..."
+
+    print "Routing", len(ensemble_numbers), "ensembles for:", watershed, subbasin
+    time_start_routing = datetime.datetime.utcnow()
+    with profile_stage('ensemble_routing', node_path, profile_label):
+        average_flow, final_flow = router.route(inflow_cube, interval, initial_flow)
+    for ensemble_index, ensemble_number in enumerate(ensemble_numbers):
+        router.write_qout(os.path.join(node_path, 'Qout_%s_%s_%s.nc' % (watershed.lower(),
+                                                                        subbasin.lower(),
+                                                                        ensemble_number)),
+                          average_flow[:num_intervals[ensemble_index], :, ensemble_index])
+    print "Time to route ensembles:", (datetime.datetime.utcnow()-time_start_routing)
+
+    if warm_start:
+        #state after 12 hrs for the next forecast
+        print "Writing Qfinal for:", subbasin, "Ensembles:", len(ensemble_numbers)
+        with profile_stage('ensemble_routing_warm_start', node_path, profile_label):
+            warm_start_flow, qfinal_flow = router.route(inflow_cube[:2], interval, initial_flow)
+        for ensemble_index, ensemble_number in enumerate(ensemble_numbers):
+            router.write_qfinal(os.path.join(node_path, get_qfinal_file_name(watershed, subbasin,
+                                                                             ensemble_number)),
+                                qfinal_flow[:, ensemble_index])
+
+    #convert rapid output to be CF compliant
+    convert_ecmwf_rapid_output_to_cf_compliant(datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"),
+                                               node_path)
+    print "Total time to compute: %s" % (datetime.datetime.utcnow()-time_start_all)
+
 def process_upload_ECMWF_RAPID(ecmwf_forecast, watershed, subbasin,
-                               rapid_executable_location, init_flow):
+                               rapid_executable_location, init_flow, warm_start=False,
+                               node_path=None, routing_engine="rapid"):
     """
     prepare all ECMWF files for rapid
+
+    With routing_engine "muskingum_ensemble", ecmwf_forecast is a comma
+    separated list of the forecasts of all ensembles, which are routed at
+    once (see process_ECMWF_RAPID_ensemble).
     """
-    node_path = os.path.dirname(os.path.realpath(__file__))
+    if routing_engine == "muskingum_ensemble":
+        process_ECMWF_RAPID_ensemble(ecmwf_forecast.split(","), watershed, subbasin, init_flow,
+                                     warm_start, node_path)
+        return
+    if node_path is None:
+        node_path = os.path.dirname(os.path.realpath(__file__))
     forecast_basename = os.path.basename(ecmwf_forecast)
     forecast_split = forecast_basename.split(".")
     forecast_date_timestep = ".".join(forecast_split[:2])
@@ -231,13 +424,16 @@ def process_upload_ECMWF_RAPID(ecmwf_forecast, watershed, subbasin,
         print "Converting ECMWF inflow"
         #optional argument ... time interval?
         RAPIDinflowECMWF_tool = CreateInflowFileFromECMWFRunoff()
-        RAPIDinflowECMWF_tool.execute(forecast_basename, weight_table_file, inflow_file_name)
+        with profile_stage('inflow', node_path, "%s_%s_%s_%s" % (forecast_date_timestep, watershed,
+                                                                 subbasin, ensemble_number)):
+            RAPIDinflowECMWF_tool.execute(forecast_basename, weight_table_file, inflow_file_name)
 
         time_finish_ecmwf = datetime.datetime.utcnow()
         print "Time to convert ECMWF: %s" % (time_finish_ecmwf-time_start_all)
 
         run_RAPID_single_watershed(forecast_basename, watershed, subbasin,
-                                   rapid_executable_location, node_path, init_flow)
+                                   rapid_executable_location, node_path, init_flow,
+                                   warm_start, routing_engine)
     except Exception:
         remove_inflow_file(inflow_file_name)
         raise
@@ -249,4 +445,7 @@ def process_upload_ECMWF_RAPID(ecmwf_forecast, watershed, subbasin,
     print "Total time to compute: %s" % (time_stop_all-time_start_all)
 
 if __name__ == "__main__":   
-    process_upload_ECMWF_RAPID(sys.argv[1],sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+    warm_start = len(sys.argv) > 6 and sys.argv[6].lower() == "true"
+    routing_engine = sys.argv[7] if len(sys.argv) > 7 else "rapid"
+    process_upload_ECMWF_RAPID(sys.argv[1],sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5],
+                               warm_start, routing_engine=routing_engine)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Creates an HTCondor DAGMan workflow for the ECMWF-RAPID process where the
+ensemble jobs of each watershed forecast are the parents of the post
+processing node of that watershed forecast.
+
+Each ensemble node is retried and has a POST script that reports success
+after its last retry, so the post processing node of a watershed always
+runs over the ensembles that succeeded. An optional FINAL node runs after
+all other nodes (e.g. to merge the stage profiles of the cycle).
+"""
+import os
+import re
+from subprocess import Popen, PIPE
+
+#number of retries of an ensemble job
+ENSEMBLE_JOB_RETRIES = 2
+
+#POST script of the ensemble nodes: called with the return value of the
+#job, the retry number and the number of retries. A failed job fails the
+#node so it is retried, except after the last retry so the children run.
+ENSEMBLE_POST_SCRIPT = """#!/bin/sh
+if [ "$1" != "0" ] && [ "$2" -lt "$3" ]; then
+    exit 1
+fi
+if [ "$1" != "0" ]; then
+    echo "Job failed with $1 after $2 retries. Continuing with the other ensembles ..."
+fi
+exit 0
+"""
+
+#name of the FINAL node of the DAG
+FINAL_NODE_NAME = 'final'
+
+def get_dag_node_name(name):
+    """
+    Returns a valid DAG node name (no spaces, dots or plus signs)
+    """
+    return re.sub(r'[^A-Za-z0-9_\-]', '_', name)
+
+def write_submit_file(submit_file, universe, attributes, job_name, initialdir):
+    """
+    Writes an HTCondor submit description file with the attributes
+    given as a list of (name, value)
+    """
+    with open(submit_file, 'w') as submit_con:
+        submit_con.write('universe = %s\n' % universe)
+        for attribute, value in attributes:
+            submit_con.write('%s = %s\n' % (attribute, value))
+        if universe == 'vanilla':
+            submit_con.write('should_transfer_files = YES\n')
+            submit_con.write('when_to_transfer_output = ON_EXIT\n')
+        submit_con.write('initialdir = %s\n' % initialdir)
+        submit_con.write('log = %s.log\n' % job_name)
+        submit_con.write('output = %s.out\n' % job_name)
+        submit_con.write('error = %s.err\n' % job_name)
+        submit_con.write('queue 1\n')
+
+def write_ensemble_post_script(post_script_file):
+    """
+    Writes the POST script of the ensemble nodes
+    """
+    with open(post_script_file, 'w') as post_script_con:
+        post_script_con.write(ENSEMBLE_POST_SCRIPT)
+    os.chmod(post_script_file, 0755)
+
+def create_ecmwf_rapid_dag(dag_file, job_list, post_processing_list, initialdir,
+                           final_attributes=None):
+    """
+    Writes the DAG and the submit files of its nodes into the directory
+    of the DAG file.
+
+    Arguments:
+        dag_file -- path of the DAG file to write
+        job_list -- list of (job_name, attributes, job_info) of the
+                    ensemble jobs where attributes is a list of
+                    (name, value) for the vanilla universe submit file
+                    and job_info has the keys watershed, subbasin,
+                    forecast_date_timestep and optionally predicted_cost
+        post_processing_list -- list of (rapid_input_directory,
+                                forecast_date_timestep, attributes) of
+                                the post processing jobs that run in the
+                                local universe on the submit machine
+        initialdir -- directory for job logs and output
+        final_attributes -- attributes of the FINAL node that runs in
+                            the local universe after all other nodes
+                            (no FINAL node if None)
+
+    Returns the list of DAG node names for the ensemble jobs and a
+    dictionary of post processing node name to its parent node names.
+    """
+    dag_directory = os.path.dirname(os.path.abspath(dag_file))
+    post_script_file = os.path.join(dag_directory, 'ensemble_post.sh')
+    write_ensemble_post_script(post_script_file)
+    parent_nodes = {}
+    job_node_names = []
+    dag_lines = []
+    for job_name, attributes, job_info in job_list:
+        node_name = get_dag_node_name(job_name)
+        submit_file = os.path.join(dag_directory, "%s.sub" % node_name)
+        write_submit_file(submit_file, 'vanilla', attributes, node_name, initialdir)
+        dag_lines.append('JOB %s %s\n' % (node_name, submit_file))
+        if job_info.get('predicted_cost'):
+            #submit the longest jobs first
+            dag_lines.append('PRIORITY %s %s\n' % (node_name, int(job_info['predicted_cost'])))
+        dag_lines.append('RETRY %s %s\n' % (node_name, ENSEMBLE_JOB_RETRIES))
+        dag_lines.append('SCRIPT POST %s %s $RETURN $RETRY %s\n' % (node_name, post_script_file,
+                                                                    ENSEMBLE_JOB_RETRIES))
+        job_node_names.append(node_name)
+        post_node_name = get_dag_node_name("post_%s_%s-%s" % (job_info['forecast_date_timestep'],
+                                                              job_info['watershed'],
+                                                              job_info['subbasin']))
+        parent_nodes.setdefault(post_node_name, []).append(node_name)
+
+    post_node_parents = {}
+    for rapid_input_directory, forecast_date_timestep, attributes in post_processing_list:
+        post_node_name = get_dag_node_name("post_%s_%s" % (forecast_date_timestep, rapid_input_directory))
+        submit_file = os.path.join(dag_directory, "%s.sub" % post_node_name)
+        write_submit_file(submit_file, 'local', attributes, post_node_name, initialdir)
+        dag_lines.append('JOB %s %s\n' % (post_node_name, submit_file))
+        post_node_parents[post_node_name] = parent_nodes.get(post_node_name, [])
+        if post_node_parents[post_node_name]:
+            dag_lines.append('PARENT %s CHILD %s\n' % (" ".join(post_node_parents[post_node_name]),
+                                                       post_node_name))
+
+    if final_attributes is not None:
+        submit_file = os.path.join(dag_directory, "%s.sub" % FINAL_NODE_NAME)
+        write_submit_file(submit_file, 'local', final_attributes, FINAL_NODE_NAME, initialdir)
+        dag_lines.append('FINAL %s %s\n' % (FINAL_NODE_NAME, submit_file))
+
+    with open(dag_file, 'w') as dag_con:
+        dag_con.writelines(dag_lines)
+
+    return job_node_names, post_node_parents
+
+def submit_dag(dag_file):
+    """
+    Submits the DAG to HTCondor with condor_submit_dag
+    """
+    process = Popen(['condor_submit_dag', '-force', dag_file],
+                    stdout=PIPE, stderr=PIPE,
+                    cwd=os.path.dirname(os.path.abspath(dag_file)))
+    out, err = process.communicate()
+    print out
+    if process.returncode != 0:
+        raise Exception("condor_submit_dag failed: %s" % err)
@@ -3,14 +3,22 @@ cron_manager = CronTab(user='sgeadmin')
 cron_comment = "ECMWF RAPID PROCESS"
 cron_manager.remove_all(comment=cron_comment)
 cron_command = '/home/sgeadmin/work/scripts/erfp_data_process_ubuntu_aws/rapid_process.sh' 
+#set to True if watch_ecmwf is set in rapid_process_async_ubuntu.py
+#the watcher is started every hour and exits if one is already running
+watch_mode = False
 #add new times   
-cron_job_morning = cron_manager.new(command=cron_command, 
-                                    comment=cron_comment)
-cron_job_morning.minute.on(30)
-cron_job_morning.hour.on(9)
-cron_job_evening = cron_manager.new(command=cron_command, 
-                                    comment=cron_comment)
-cron_job_evening.minute.on(30)
-cron_job_evening.hour.on(21)
+if watch_mode:
+    cron_job_watch = cron_manager.new(command=cron_command,
+                                      comment=cron_comment)
+    cron_job_watch.minute.on(0)
+else:
+    cron_job_morning = cron_manager.new(command=cron_command, 
+                                        comment=cron_comment)
+    cron_job_morning.minute.on(30)
+    cron_job_morning.hour.on(9)
+    cron_job_evening = cron_manager.new(command=cron_command, 
+                                        comment=cron_comment)
+    cron_job_evening.minute.on(30)
+    cron_job_evening.hour.on(21)
 #writes content to crontab
 cron_manager.write()
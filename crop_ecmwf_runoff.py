@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Crops the global ECMWF runoff files to the grid windows of the weight
+tables of each watershed so jobs only receive the runoff of their region.
+
+The cropped files keep the dimensions and variables of the global files
+and store the offset of the window in the global grid in the global
+attributes lat_index_offset and lon_index_offset. CreateInflowFileFromECMWFRunoff
+uses these to map the weight table indices to the cropped grid.
+"""
+import csv
+from glob import glob
+import json
+import os
+import re
+
+import netCDF4 as NET
+
+def get_weight_table_window(weight_table_file):
+    """
+    Returns the (min lat index, max lat index, min lon index, max lon index)
+    of the grid cells used in the weight table
+    """
+    lat_indices = []
+    lon_indices = []
+    with open(weight_table_file, 'rb') as csvfile:
+        reader = csv.reader(csvfile)
+        reader.next()
+        for row in reader:
+            lon_indices.append(int(row[2]))
+            lat_indices.append(int(row[3]))
+    if not lat_indices:
+        return None
+    return min(lat_indices), max(lat_indices), min(lon_indices), max(lon_indices)
+
+def get_region_windows(rapid_io_files_location, rapid_input_directories):
+    """
+    Returns the grid windows of the low and high resolution weight
+    tables of each watershed as {rapid_input_directory: {resolution: window}}
+    """
+    region_windows = {}
+    for rapid_input_directory in rapid_input_directories:
+        input_directory = os.path.join(rapid_io_files_location, 'input', rapid_input_directory)
+        region_windows[rapid_input_directory] = {}
+        for file_name in os.listdir(input_directory):
+            resolution = None
+            if re.search(r'weight_low_res\.csv', file_name, re.IGNORECASE):
+                resolution = "LowRes"
+            elif re.search(r'weight_high_res\.csv', file_name, re.IGNORECASE):
+                resolution = "HighRes"
+            if resolution:
+                window = get_weight_table_window(os.path.join(input_directory, file_name))
+                if window is not None:
+                    region_windows[rapid_input_directory][resolution] = window
+    return region_windows
+
+def get_union_window(windows):
+    """
+    Returns the window containing all windows
+    """
+    return (min([window[0] for window in windows]), max([window[1] for window in windows]),
+            min([window[2] for window in windows]), max([window[3] for window in windows]))
+
+def get_regional_forecast_file(ecmwf_folder, rapid_input_directory, forecast_file):
+    """
+    Returns the path of the forecast file cropped to the watershed
+    """
+    return os.path.join(ecmwf_folder, 'regions', rapid_input_directory, os.path.basename(forecast_file))
+
+def write_cropped_runoff(data_in_nc, runoff_window_data, union_window, window, out_file):
+    """
+    Writes the window of the runoff data to a file with the same structure
+    as the global file and the offset of the window in the global grid
+    """
+    lat_start = window[0] - union_window[0]
+    lat_end = window[1] - union_window[0] + 1
+    lon_start = window[2] - union_window[2]
+    lon_end = window[3] - union_window[2] + 1
+    temp_out_file = "%s.tmp" % out_file
+    data_out_nc = NET.Dataset(temp_out_file, "w", format=data_in_nc.data_model)
+    try:
+        for attribute in data_in_nc.ncattrs():
+            data_out_nc.setncattr(attribute, data_in_nc.getncattr(attribute))
+        data_out_nc.lat_index_offset = window[0]
+        data_out_nc.lon_index_offset = window[2]
+        data_out_nc.global_lat_size = len(data_in_nc.dimensions['lat'])
+        data_out_nc.global_lon_size = len(data_in_nc.dimensions['lon'])
+
+        dimension_sizes = {'lat' : lat_end - lat_start,
+                           'lon' : lon_end - lon_start,
+                           }
+        for dimension_name, dimension in data_in_nc.dimensions.iteritems():
+            if dimension.isunlimited():
+                data_out_nc.createDimension(dimension_name, None)
+            else:
+                data_out_nc.createDimension(dimension_name,
+                                            dimension_sizes.get(dimension_name, len(dimension)))
+
+        for variable_name, variable in data_in_nc.variables.iteritems():
+            out_variable = data_out_nc.createVariable(variable_name, variable.dtype, variable.dimensions,
+                                                      fill_value=getattr(variable, '_FillValue', None))
+            for attribute in variable.ncattrs():
+                if attribute != '_FillValue':
+                    out_variable.setncattr(attribute, variable.getncattr(attribute))
+            if variable_name == 'lat':
+                out_variable[:] = variable[window[0]:window[1]+1]
+            elif variable_name == 'lon':
+                out_variable[:] = variable[window[2]:window[3]+1]
+            elif variable_name == 'RO':
+                out_variable[:] = runoff_window_data[:, lat_start:lat_end, lon_start:lon_end]
+            else:
+                out_variable[:] = variable[:]
+    finally:
+        data_out_nc.close()
+    os.rename(temp_out_file, out_file)
+
+def crop_ecmwf_folder(ecmwf_folder, region_windows):
+    """
+    Crops each ensemble runoff file in the folder to the window of each
+    watershed. The union window of all watersheds is read from the
+    global file once per ensemble.
+    """
+    for forecast_file in glob(os.path.join(ecmwf_folder, '*.runoff.netcdf')):
+        ensemble_number = int(os.path.basename(forecast_file).split(".")[2])
+        resolution = "HighRes" if ensemble_number == 52 else "LowRes"
+        regions = [(rapid_input_directory, windows[resolution]) \
+                   for rapid_input_directory, windows in region_windows.iteritems() \
+                   if resolution in windows and \
+                   not os.path.exists(get_regional_forecast_file(ecmwf_folder, rapid_input_directory, forecast_file))]
+        if not regions:
+            continue
+
+        print "Cropping", os.path.basename(forecast_file), "to", len(regions), "regions"
+        union_window = get_union_window([window for rapid_input_directory, window in regions])
+        data_in_nc = NET.Dataset(forecast_file)
+        try:
+            runoff_window_data = data_in_nc.variables['RO'][:, union_window[0]:union_window[1]+1,
+                                                            union_window[2]:union_window[3]+1]
+            for rapid_input_directory, window in regions:
+                regional_forecast_file = get_regional_forecast_file(ecmwf_folder, rapid_input_directory,
+                                                                    forecast_file)
+                try:
+                    os.makedirs(os.path.dirname(regional_forecast_file))
+                except OSError:
+                    pass
+                write_cropped_runoff(data_in_nc, runoff_window_data, union_window,
+                                     window, regional_forecast_file)
+        finally:
+            data_in_nc.close()
+
+    #index of the windows in the global grid
+    for rapid_input_directory, windows in region_windows.iteritems():
+        region_directory = os.path.join(ecmwf_folder, 'regions', rapid_input_directory)
+        if os.path.exists(region_directory):
+            with open(os.path.join(region_directory, 'crop_index.json'), 'wb') as index_file:
+                index_file.write(json.dumps(dict([(resolution, {'lat_index_min' : window[0],
+                                                                'lat_index_max' : window[1],
+                                                                'lon_index_min' : window[2],
+                                                                'lon_index_max' : window[3]}) \
+                                                  for resolution, window in windows.iteritems()])))
+
+def crop_ecmwf_folders(ecmwf_folders, rapid_io_files_location, rapid_input_directories):
+    """
+    Crops the runoff of all ECMWF folders to the watersheds
+    """
+    region_windows = get_region_windows(rapid_io_files_location, rapid_input_directories)
+    for ecmwf_folder in ecmwf_folders:
+        try:
+            crop_ecmwf_folder(ecmwf_folder, region_windows)
+        except Exception, ex:
+            print "Error cropping", ecmwf_folder, ex
+            pass
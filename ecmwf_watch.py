@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Watches the ECMWF ftp site or a local drop directory for the forecasts
+of the day and processes each forecast as soon as its tarball is complete
+and extracted instead of processing all forecasts at a fixed time.
+Forecasts are processed one at a time by a worker thread so the watcher
+keeps polling while a forecast is processed.
+"""
+import datetime
+import errno
+import fcntl
+from glob import glob
+import json
+import os
+from Queue import Queue
+import tarfile
+import threading
+import time
+
+#local imports
+from ftp_ecmwf_download import (download_all_ftp,
+                                DownloadManifest,
+                                extract_member_verified,
+                                get_file_md5,
+                                print_extracted_member)
+
+class ECMWFForecastWatcher(object):
+    """
+    Polls for new ECMWF forecast tarballs every poll_interval seconds.
+
+    A tarball is taken as complete once its size is the same in two polls
+    in a row. Forecasts are downloaded from the ftp site, or extracted from
+    drop_directory if given, into ecmwf_forecast_location and recorded in
+    its download manifest. Each forecast folder is passed to
+    process_forecasts(ecmwf_folders) once by the worker thread, which is
+    recorded in watch_state.json so a restarted watcher does not process
+    it again.
+    """
+    def __init__(self, ecmwf_forecast_location, process_forecasts,
+                 poll_interval=300, drop_directory=None, download_kwargs=None):
+        self.ecmwf_forecast_location = ecmwf_forecast_location
+        self.process_forecasts = process_forecasts
+        self.poll_interval = poll_interval
+        self.drop_directory = drop_directory
+        self.download_kwargs = download_kwargs or {}
+        self.tarball_sizes = {}
+        self.state_file = os.path.join(ecmwf_forecast_location, 'watch_state.json')
+        self.lock = threading.Lock()
+        self.forecast_queue = Queue()
+        self.queued = set()
+        self.processed = {}
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'rb') as state_con:
+                    self.processed = json.load(state_con)
+            except ValueError:
+                print "Invalid watch state", self.state_file, ". Starting new state ..."
+        #only keep forecasts still on disk
+        self.processed = dict([(ecmwf_folder, processed_time) \
+                               for ecmwf_folder, processed_time in self.processed.iteritems() \
+                               if os.path.exists(ecmwf_folder)])
+
+    def write_state(self):
+        """
+        Writes the processed forecasts (call with lock held)
+        """
+        temp_state_file = "%s.tmp" % self.state_file
+        with open(temp_state_file, 'wb') as state_con:
+            json.dump(self.processed, state_con)
+        os.rename(temp_state_file, self.state_file)
+
+    def is_stable(self, file_name, file_size):
+        """
+        Checks if the size of the tarball is the same as in the last poll
+        """
+        previous_size = self.tarball_sizes.get(file_name)
+        self.tarball_sizes[file_name] = file_size
+        return file_size is not None and previous_size == file_size
+
+    def get_file_match(self):
+        """
+        Returns the pattern of the tarballs of the forecasts of today
+        """
+        return 'Runoff.%s*.netcdf.tar.gz' % datetime.datetime.utcnow().strftime('%Y%m%d')
+
+    def ingest_ftp(self):
+        """
+        Downloads and extracts the complete tarballs on the ftp site
+        """
+        download_all_ftp(self.ecmwf_forecast_location,
+                         self.get_file_match(),
+                         file_filter=self.is_stable,
+                         **self.download_kwargs)
+
+    def ingest_drop_directory(self):
+        """
+        Extracts the complete tarballs in the drop directory
+        """
+        download_manifest = DownloadManifest(os.path.join(self.ecmwf_forecast_location,
+                                                          'download_manifest.json'))
+        for tarball in sorted(glob(os.path.join(self.drop_directory, self.get_file_match()))):
+            file_name = os.path.basename(tarball)
+            if download_manifest.is_extracted(file_name) \
+                    or not self.is_stable(file_name, os.path.getsize(tarball)):
+                continue
+            local_dir = download_manifest.get_local_dir(file_name)
+            print "Extracting: " + tarball
+            try:
+                download_manifest.start_download(file_name, os.path.getsize(tarball))
+                if not os.path.exists(local_dir):
+                    os.mkdir(local_dir)
+                extracted_members = {}
+                with tarfile.open(tarball) as tar:
+                    for member in tar:
+                        member_size = extract_member_verified(tar, member, local_dir)
+                        if member_size is not None:
+                            extracted_members[member.name] = member_size
+                            print_extracted_member(os.path.join(local_dir, member.name))
+                download_manifest.update(file_name,
+                                         bytes_received=os.path.getsize(tarball),
+                                         md5=get_file_md5(tarball),
+                                         complete=True,
+                                         extracted=True,
+                                         members=extracted_members)
+                os.remove(tarball)
+            except Exception as ex:
+                print "Error extracting", tarball, ex
+                pass
+
+    def get_ready_forecasts(self):
+        """
+        Returns the extracted forecast folders of today not yet processed
+        """
+        download_manifest = DownloadManifest(os.path.join(self.ecmwf_forecast_location,
+                                                          'download_manifest.json'))
+        ready_forecasts = []
+        for ecmwf_folder in sorted(glob(os.path.join(self.ecmwf_forecast_location,
+                                                     self.get_file_match()[:-7]))):
+            with self.lock:
+                if ecmwf_folder in self.processed or ecmwf_folder in self.queued:
+                    continue
+            if download_manifest.is_extracted("%s.tar.gz" % os.path.basename(ecmwf_folder)):
+                ready_forecasts.append(ecmwf_folder)
+        return ready_forecasts
+
+    def process_queued_forecasts(self):
+        """
+        Worker loop that processes the queued forecasts in order until
+        None is queued. A forecast that fails is queued again by the next
+        poll.
+        """
+        while True:
+            ecmwf_folder = self.forecast_queue.get()
+            try:
+                if ecmwf_folder is None:
+                    return
+                print "Processing forecast", ecmwf_folder
+                try:
+                    self.process_forecasts([ecmwf_folder])
+                except Exception as ex:
+                    print "Error processing", ecmwf_folder, ex
+                    with self.lock:
+                        self.queued.discard(ecmwf_folder)
+                    continue
+                with self.lock:
+                    self.queued.discard(ecmwf_folder)
+                    self.processed[ecmwf_folder] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+                    self.write_state()
+            finally:
+                self.forecast_queue.task_done()
+
+    def poll(self):
+        """
+        Ingests new tarballs and queues the forecasts that are ready
+        for the worker
+        """
+        if self.drop_directory:
+            self.ingest_drop_directory()
+        else:
+            self.ingest_ftp()
+        for ecmwf_folder in self.get_ready_forecasts():
+            print "Queueing forecast", ecmwf_folder
+            with self.lock:
+                self.queued.add(ecmwf_folder)
+            self.forecast_queue.put(ecmwf_folder)
+
+    def watch(self, watch_hours=24):
+        """
+        Polls until watch_hours have passed and then waits for the queued
+        forecasts to be processed. Only one watcher runs at a time for a
+        forecast location so the watcher can be restarted by cron without
+        running twice.
+        """
+        lock_file = open(os.path.join(self.ecmwf_forecast_location, 'watch.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ex:
+            if ex.errno in (errno.EACCES, errno.EAGAIN):
+                print "Watcher already running for", self.ecmwf_forecast_location
+                lock_file.close()
+                return
+            raise
+        worker_thread = threading.Thread(target=self.process_queued_forecasts)
+        worker_thread.daemon = True
+        worker_thread.start()
+        try:
+            time_end = datetime.datetime.utcnow() + datetime.timedelta(hours=watch_hours)
+            while datetime.datetime.utcnow() < time_end:
+                try:
+                    self.poll()
+                except Exception as ex:
+                    print "Error polling for forecasts", ex
+                    pass
+                time.sleep(self.poll_interval)
+        finally:
+            #finish the queued forecasts before releasing the lock
+            self.forecast_queue.put(None)
+            worker_thread.join()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
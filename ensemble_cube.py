@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Consolidates the Qout files of all ensembles of a watershed forecast into
+one NetCDF4 file with Qout(COMID, ensemble, time).
+
+The cube is an uncompressed NetCDF classic file (CDF-2 for cubes over
+2 GB) where the ensemble hydrographs of a reach are one contiguous block
+of Qout, so they are read from a memory map (see netcdf3_memmap.py) with
+one read instead of opening every ensemble file. Compressed NetCDF4
+chunks of reaches were slower to query than the Qout files because every
+request decompressed a whole chunk. The time
+axis is the union of the times of the ensembles (the high resolution
+ensemble 52 is shorter than the low resolution ensembles) and times
+missing in an ensemble are NaN.
+"""
+from glob import glob
+import os
+import sys
+
+import netCDF4 as NET
+import numpy as np
+
+#local imports
+from stage_profiler import profiled_stage
+
+def get_ensemble_number(qout_file):
+    """
+    Returns the ensemble number of a Qout_<watershed>_<subbasin>_<ensemble>.nc file
+    """
+    return int(os.path.basename(qout_file)[:-3].split("_")[-1])
+
+def get_ensemble_cube_file(forecast_directory, watershed, subbasin):
+    """
+    Returns the ensemble cube file of a watershed forecast. The name does
+    not start with Qout so it is not taken for an ensemble output.
+    """
+    return os.path.join(forecast_directory, 'ensemble_cube_%s_%s.nc' % (watershed.lower(), subbasin.lower()))
+
+def find_ensemble_qout_files(forecast_directory, watershed, subbasin):
+    """
+    Returns the Qout files of the ensembles ordered by ensemble number
+    """
+    qout_files = glob(os.path.join(forecast_directory, "Qout_%s_%s_*.nc" % (watershed.lower(), subbasin.lower())))
+    return sorted(qout_files, key=get_ensemble_number)
+
+def get_qout_comid_axis(qout_variable):
+    """
+    Returns the axis of the COMID dimension of a Qout variable (Time, COMID) or (COMID, time)
+    """
+    if qout_variable.dimensions[0].lower() == 'comid':
+        return 0
+    elif qout_variable.dimensions[1].lower() == 'comid':
+        return 1
+    raise Exception("Invalid Qout dimensions %s" % (qout_variable.dimensions,))
+
+def get_qout_times(qout_nc, time_step=6*3600):
+    """
+    Returns the times of a Qout file (seconds since 1970 in CF files or
+    time step offsets in raw RAPID files)
+    """
+    if 'time' in qout_nc.variables:
+        return np.array(qout_nc.variables['time'][:], dtype=np.int64)
+    qout_variable = qout_nc.variables['Qout']
+    num_times = qout_variable.shape[1 - get_qout_comid_axis(qout_variable)]
+    return np.arange(num_times, dtype=np.int64)*time_step
+
+@profiled_stage('ensemble_cube')
+def write_ensemble_cube(qout_files, cube_file, memory_limit_mb=256):
+    """
+    Writes the Qout files of the ensembles of a forecast into the cube file.
+    The reaches are copied in blocks that fit in memory_limit_mb.
+    Returns the cube file.
+    """
+    qout_files = sorted(qout_files, key=get_ensemble_number)
+    ensemble_numbers = [get_ensemble_number(qout_file) for qout_file in qout_files]
+    qout_ncs = [NET.Dataset(qout_file) for qout_file in qout_files]
+    temp_cube_file = "%s.tmp" % cube_file
+    try:
+        comids = qout_ncs[0].variables['COMID'][:]
+        for qout_file, qout_nc in zip(qout_files, qout_ncs):
+            if not np.array_equal(qout_nc.variables['COMID'][:], comids):
+                raise Exception("COMIDs in %s differ from %s" % (qout_file, qout_files[0]))
+
+        #common time axis of the ensembles
+        ensemble_times = [get_qout_times(qout_nc) for qout_nc in qout_ncs]
+        times = np.unique(np.concatenate(ensemble_times))
+        ensemble_time_indices = [np.searchsorted(times, ensemble_time) for ensemble_time in ensemble_times]
+
+        num_reaches = len(comids)
+        num_ensembles = len(qout_files)
+        cube_nc = NET.Dataset(temp_cube_file, "w", format="NETCDF3_64BIT")
+        try:
+            cube_nc.createDimension('COMID', num_reaches)
+            cube_nc.createDimension('ensemble', num_ensembles)
+            cube_nc.createDimension('time', len(times))
+            comid_var = cube_nc.createVariable('COMID', 'i4', ('COMID',))
+            comid_var.long_name = 'unique identifier for each river reach feature'
+            comid_var.cf_role = 'timeseries_id'
+            comid_var[:] = comids
+            ensemble_var = cube_nc.createVariable('ensemble', 'i4', ('ensemble',))
+            ensemble_var.long_name = 'ECMWF ensemble number'
+            ensemble_var[:] = ensemble_numbers
+            time_var = cube_nc.createVariable('time', 'i4', ('time',))
+            time_var.long_name = 'time'
+            time_var.standard_name = 'time'
+            time_var.axis = 'T'
+            if 'time' in qout_ncs[0].variables:
+                time_var.units = qout_ncs[0].variables['time'].units
+            else:
+                time_var.units = 'seconds since forecast start'
+            time_var[:] = times
+            for coordinate_name in ('lat', 'lon', 'z'):
+                if coordinate_name in qout_ncs[0].variables:
+                    source_var = qout_ncs[0].variables[coordinate_name]
+                    coordinate_var = cube_nc.createVariable(coordinate_name, 'f8', ('COMID',))
+                    coordinate_var.setncatts(dict([(attribute, source_var.getncattr(attribute)) \
+                                                   for attribute in source_var.ncattrs() \
+                                                   if attribute != '_FillValue']))
+                    coordinate_var[:] = source_var[:]
+
+            qout_var = cube_nc.createVariable('Qout', 'f4', ('COMID', 'ensemble', 'time'),
+                                              fill_value=np.nan)
+            qout_var.long_name = 'Discharge'
+            qout_var.units = 'm^3/s'
+            qout_var.coordinates = 'time lat lon z'
+
+            #copy blocks of reaches
+            reach_bytes = num_ensembles*len(times)*4
+            block_size = max(1, int(memory_limit_mb*1024*1024/reach_bytes))
+            for block_start in xrange(0, num_reaches, block_size):
+                block_end = min(block_start + block_size, num_reaches)
+                block = np.empty((block_end - block_start, num_ensembles, len(times)), dtype=np.float32)
+                block.fill(np.nan)
+                for ensemble_index, qout_nc in enumerate(qout_ncs):
+                    qout_variable = qout_nc.variables['Qout']
+                    if get_qout_comid_axis(qout_variable) == 0:
+                        ensemble_block = qout_variable[block_start:block_end, :]
+                    else:
+                        ensemble_block = qout_variable[:, block_start:block_end].transpose()
+                    block[:, ensemble_index, ensemble_time_indices[ensemble_index]] = \
+                        np.ma.filled(ensemble_block, np.nan)
+                qout_var[block_start:block_end] = block
+        finally:
+            cube_nc.close()
+        os.rename(temp_cube_file, cube_file)
+    except Exception:
+        try:
+            os.remove(temp_cube_file)
+        except OSError:
+            pass
+        raise
+    finally:
+        for qout_nc in qout_ncs:
+            qout_nc.close()
+    return cube_file
+
+def consolidate_forecast_ensembles(forecast_directory, watershed, subbasin):
+    """
+    Writes the ensemble cube of a watershed forecast from its Qout files.
+    Returns the cube file or None if there are no Qout files.
+    """
+    qout_files = find_ensemble_qout_files(forecast_directory, watershed, subbasin)
+    if not qout_files:
+        print "No Qout files found in", forecast_directory, ". Skipping ensemble cube ..."
+        return None
+    return write_ensemble_cube(qout_files, get_ensemble_cube_file(forecast_directory, watershed, subbasin))
+
+def read_reach_ensembles(cube_file, comid):
+    """
+    Returns the times and the ensemble hydrographs (ensemble, time) of a reach
+    """
+    cube_nc = NET.Dataset(cube_file)
+    try:
+        comid_index = np.where(cube_nc.variables['COMID'][:] == comid)[0][0]
+        return cube_nc.variables['time'][:], np.ma.filled(cube_nc.variables['Qout'][comid_index], np.nan)
+    finally:
+        cube_nc.close()
+
+if __name__ == "__main__":
+    consolidate_forecast_ensembles(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Statistics of the ensembles of a watershed forecast for each reach and
+time step: mean, std, min, max and the 25th, 50th and 75th percentiles.
+
+The statistics are written to statistics_<watershed>_<subbasin>.nc with
+a (COMID, time) variable for each statistic. The ensembles are read from
+the ensemble cube or the Qout files in blocks of reaches that fit in
+memory and each block is computed in one vectorized pass. Times missing
+in an ensemble (NaN) are left out of the statistics of that time.
+
+Usage:
+    python ensemble_statistics.py forecast_directory watershed subbasin
+"""
+import os
+import sys
+
+import netCDF4 as NET
+import numpy as np
+
+#local imports
+from stage_profiler import profiled_stage
+
+#percentiles of the ensemble statistics
+STATISTIC_PERCENTILES = (25, 50, 75)
+STATISTIC_NAMES = ['mean', 'std', 'min', 'max'] + ['p%s' % percentile for percentile in STATISTIC_PERCENTILES]
+
+def compute_ensemble_statistics(ensemble_values, axis=1):
+    """
+    Returns the mean, std, min, max and percentiles (linear interpolation
+    as numpy.percentile) over the ensemble axis ignoring NaN. Values
+    without any ensemble are NaN.
+    """
+    ensemble_values = np.rollaxis(np.asarray(ensemble_values, dtype=np.float64), axis)
+    #NaN are sorted to the end
+    sorted_values = np.sort(ensemble_values, axis=0)
+    num_values = np.sum(~np.isnan(sorted_values), axis=0)
+    has_values = num_values > 0
+    valid_count = np.maximum(num_values, 1)
+
+    def get_sorted_value(positions):
+        return np.take_along_axis(sorted_values, positions[np.newaxis], axis=0)[0]
+
+    mean = np.where(has_values, np.nansum(sorted_values, axis=0)/valid_count, np.nan)
+    deviation = np.where(np.isnan(sorted_values), 0, sorted_values - mean)
+    statistics = {'mean' : mean,
+                  'std' : np.where(has_values, np.sqrt(np.sum(deviation*deviation, axis=0)/valid_count), np.nan),
+                  'min' : sorted_values[0],
+                  'max' : get_sorted_value(valid_count - 1),
+                  }
+    for percentile in STATISTIC_PERCENTILES:
+        position = (percentile/100.0)*(valid_count - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, valid_count - 1)
+        lower_value = get_sorted_value(lower)
+        statistics['p%s' % percentile] = lower_value + (position - lower)*(get_sorted_value(upper) - lower_value)
+    return statistics
+
+def get_statistics_file(forecast_directory, watershed, subbasin):
+    """
+    Returns the statistics file of a watershed forecast
+    """
+    return os.path.join(forecast_directory, 'statistics_%s_%s.nc' % (watershed.lower(), subbasin.lower()))
+
+@profiled_stage('ensemble_statistics')
+def write_ensemble_statistics(forecast_directory, watershed, subbasin, statistics_file=None,
+                              reach_chunk_size=256, memory_limit_mb=256, complevel=4):
+    """
+    Writes the ensemble statistics of each reach and time step of a
+    watershed forecast. Returns the statistics file.
+    """
+    #imported here as forecast_query uses the statistics of this module
+    from forecast_query import ForecastQuery
+    if statistics_file is None:
+        statistics_file = get_statistics_file(forecast_directory, watershed, subbasin)
+    forecast_query = ForecastQuery(forecast_directory, watershed, subbasin)
+    temp_statistics_file = "%s.tmp" % statistics_file
+    try:
+        num_reaches = forecast_query.get_num_reaches()
+        times = forecast_query.get_times()
+        source_nc = forecast_query.get_dataset(forecast_query.cube_file or forecast_query.qout_files[0])
+        reach_chunk_size = max(1, min(reach_chunk_size, num_reaches))
+
+        statistics_nc = NET.Dataset(temp_statistics_file, "w", format="NETCDF4")
+        try:
+            statistics_nc.createDimension('COMID', num_reaches)
+            statistics_nc.createDimension('time', len(times))
+            statistics_nc.num_ensembles = len(forecast_query.ensemble_numbers)
+            comid_var = statistics_nc.createVariable('COMID', 'i4', ('COMID',))
+            comid_var.long_name = 'unique identifier for each river reach feature'
+            comid_var.cf_role = 'timeseries_id'
+            comid_var[:] = source_nc.variables['COMID'][:]
+            time_var = statistics_nc.createVariable('time', 'i4', ('time',))
+            time_var.long_name = 'time'
+            time_var.standard_name = 'time'
+            time_var.axis = 'T'
+            if 'time' in source_nc.variables:
+                time_var.units = source_nc.variables['time'].units
+            else:
+                time_var.units = 'seconds since forecast start'
+            time_var[:] = times
+            for coordinate_name in ('lat', 'lon', 'z'):
+                if coordinate_name in source_nc.variables:
+                    coordinate_var = statistics_nc.createVariable(coordinate_name, 'f8', ('COMID',))
+                    coordinate_var[:] = source_nc.variables[coordinate_name][:]
+
+            statistic_vars = {}
+            for statistic_name in STATISTIC_NAMES:
+                statistic_var = statistics_nc.createVariable(statistic_name, 'f4', ('COMID', 'time'),
+                                                             zlib=True, complevel=complevel, shuffle=True,
+                                                             chunksizes=(reach_chunk_size, len(times)),
+                                                             fill_value=np.nan)
+                statistic_var.long_name = 'ensemble %s of discharge' % statistic_name
+                statistic_var.units = 'm^3/s'
+                statistic_vars[statistic_name] = statistic_var
+
+            #sorted float64 copies of the block dominate the memory used
+            reach_bytes = len(forecast_query.ensemble_numbers)*len(times)*8*3
+            block_size = max(1, int(memory_limit_mb*1024*1024/(reach_bytes*reach_chunk_size)))*reach_chunk_size
+            for block_start in xrange(0, num_reaches, block_size):
+                block_end = min(block_start + block_size, num_reaches)
+                block_statistics = compute_ensemble_statistics(
+                    forecast_query.read_reaches(slice(block_start, block_end), block_end - block_start), axis=1)
+                for statistic_name, statistic_var in statistic_vars.iteritems():
+                    statistic_var[block_start:block_end] = block_statistics[statistic_name]
+        finally:
+            statistics_nc.close()
+        os.rename(temp_statistics_file, statistics_file)
+    except Exception:
+        try:
+            os.remove(temp_statistics_file)
+        except OSError:
+            pass
+        raise
+    finally:
+        forecast_query.close()
+    return statistics_file
+
+if __name__ == "__main__":
+    write_ensemble_statistics(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Local archive of the ensemble statistics of past forecasts of a
+watershed, kept after the forecast output is removed.
+
+The archive of a watershed is one NetCDF4 file with the statistics of
+each forecast (see ensemble_statistics.py) appended along the unlimited
+forecast_date dimension:
+    forecast_date(forecast_date) -- seconds since 1970 of the forecast
+    <statistic>(forecast_date, COMID, lead_time) -- ensemble statistics
+The position of each forecast date is indexed when the archive is opened
+and a forecast archived again replaces its earlier entry. Appends to an
+archive are serialized with a lock file.
+
+Usage:
+    python forecast_archive.py archive_file comid [start_date end_date]
+"""
+import datetime
+import fcntl
+import json
+import os
+import sys
+
+import netCDF4 as NET
+import numpy as np
+
+#local imports
+from ensemble_statistics import STATISTIC_NAMES
+from stage_profiler import profiled_stage
+
+FORECAST_DATE_UNITS = 'seconds since 1970-01-01 00:00:00 0:00'
+
+def get_forecast_archive_file(archive_location, rapid_input_directory):
+    """
+    Returns the archive file of a watershed (<watershed>-<subbasin>)
+    """
+    watershed, subbasin = rapid_input_directory.split("-")
+    return os.path.join(archive_location, rapid_input_directory,
+                        'forecast_archive_%s_%s.nc' % (watershed.lower(), subbasin.lower()))
+
+def get_forecast_date_seconds(forecast_date):
+    """
+    Returns the seconds since 1970 of a forecast datetime or
+    forecast_date_timestep (e.g. 20150730.0)
+    """
+    if not isinstance(forecast_date, datetime.datetime):
+        forecast_date = datetime.datetime.strptime(forecast_date[:11], "%Y%m%d.%H")
+    return int((forecast_date - datetime.datetime(1970, 1, 1)).total_seconds())
+
+class ForecastArchive(object):
+    """
+    Appendable store of the ensemble statistics of a watershed's forecasts
+    """
+    def __init__(self, archive_file):
+        self.archive_file = archive_file
+        self.date_index = None
+        self.comid_index = None
+
+    def load_index(self, archive_nc):
+        """
+        Reads the position of each forecast date and COMID in the archive
+        """
+        self.date_index = dict([(int(forecast_date), index) for index, forecast_date \
+                                in enumerate(archive_nc.variables['forecast_date'][:])])
+        self.comid_index = dict([(int(comid), index) for index, comid \
+                                 in enumerate(archive_nc.variables['COMID'][:])])
+
+    def create(self, statistics_nc, reach_chunk_size=256, dates_per_chunk=8, complevel=4):
+        """
+        Creates the archive with the reaches and lead times of a statistics file
+        """
+        comids = statistics_nc.variables['COMID'][:]
+        times = statistics_nc.variables['time'][:]
+        num_lead_times = len(times)
+        archive_nc = NET.Dataset(self.archive_file, "w", format="NETCDF4")
+        try:
+            archive_nc.createDimension('forecast_date', None)
+            archive_nc.createDimension('COMID', len(comids))
+            archive_nc.createDimension('lead_time', num_lead_times)
+            forecast_date_var = archive_nc.createVariable('forecast_date', 'i4', ('forecast_date',))
+            forecast_date_var.long_name = 'forecast start time'
+            forecast_date_var.units = FORECAST_DATE_UNITS
+            comid_var = archive_nc.createVariable('COMID', 'i4', ('COMID',))
+            comid_var.long_name = 'unique identifier for each river reach feature'
+            comid_var.cf_role = 'timeseries_id'
+            comid_var[:] = comids
+            lead_time_var = archive_nc.createVariable('lead_time', 'i4', ('lead_time',))
+            lead_time_var.long_name = 'time since forecast start'
+            lead_time_var.units = 'seconds'
+            lead_time_var[:] = times - times[0]
+            for coordinate_name in ('lat', 'lon', 'z'):
+                if coordinate_name in statistics_nc.variables:
+                    coordinate_var = archive_nc.createVariable(coordinate_name, 'f8', ('COMID',))
+                    coordinate_var[:] = statistics_nc.variables[coordinate_name][:]
+            for statistic_name in STATISTIC_NAMES:
+                statistic_var = archive_nc.createVariable(statistic_name, 'f4',
+                                                          ('forecast_date', 'COMID', 'lead_time'),
+                                                          zlib=True, complevel=complevel, shuffle=True,
+                                                          chunksizes=(dates_per_chunk,
+                                                                      max(1, min(reach_chunk_size, len(comids))),
+                                                                      num_lead_times),
+                                                          fill_value=np.nan)
+                statistic_var.long_name = 'ensemble %s of discharge' % statistic_name
+                statistic_var.units = 'm^3/s'
+        finally:
+            archive_nc.close()
+
+    def append_statistics(self, statistics_file, forecast_date_timestep, block_size=4096):
+        """
+        Appends the statistics of a forecast to the archive (replacing the
+        forecast if already archived). Returns the forecast date position.
+        """
+        archive_directory = os.path.dirname(self.archive_file)
+        try:
+            os.makedirs(archive_directory)
+        except OSError:
+            pass
+        forecast_date = get_forecast_date_seconds(forecast_date_timestep)
+        lock_file = open("%s.lock" % self.archive_file, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            statistics_nc = NET.Dataset(statistics_file)
+            try:
+                if not os.path.exists(self.archive_file):
+                    self.create(statistics_nc)
+                archive_nc = NET.Dataset(self.archive_file, "a")
+                try:
+                    self.load_index(archive_nc)
+                    comids = statistics_nc.variables['COMID'][:]
+                    if not np.array_equal(archive_nc.variables['COMID'][:], comids):
+                        raise Exception("Reaches of %s differ from the archive %s" % (statistics_file,
+                                                                                     self.archive_file))
+                    num_lead_times = min(len(archive_nc.dimensions['lead_time']),
+                                         len(statistics_nc.dimensions['time']))
+                    date_position = self.date_index.get(forecast_date, len(self.date_index))
+                    archive_nc.variables['forecast_date'][date_position] = forecast_date
+                    for statistic_name in STATISTIC_NAMES:
+                        archive_var = archive_nc.variables[statistic_name]
+                        statistic_var = statistics_nc.variables[statistic_name]
+                        for block_start in xrange(0, len(comids), block_size):
+                            block_end = min(block_start + block_size, len(comids))
+                            block = np.empty((block_end - block_start, len(archive_nc.dimensions['lead_time'])),
+                                             dtype=np.float32)
+                            block.fill(np.nan)
+                            block[:, :num_lead_times] = np.ma.filled(statistic_var[block_start:block_end,
+                                                                                   :num_lead_times], np.nan)
+                            archive_var[date_position, block_start:block_end, :] = block
+                    self.date_index[forecast_date] = date_position
+                finally:
+                    archive_nc.close()
+            finally:
+                statistics_nc.close()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        return date_position
+
+    def get_forecast_dates(self):
+        """
+        Returns the archived forecast dates in order
+        """
+        archive_nc = NET.Dataset(self.archive_file)
+        try:
+            self.load_index(archive_nc)
+        finally:
+            archive_nc.close()
+        return [datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=forecast_date) \
+                for forecast_date in sorted(self.date_index.keys())]
+
+    def get_reach_statistics(self, comid, statistic_names=None, start_date=None, end_date=None):
+        """
+        Returns the forecast dates in order and for each statistic an array
+        (forecast_date, lead_time) of the reach between the dates
+        (forecast_date_timestep or datetime, inclusive)
+        """
+        archive_nc = NET.Dataset(self.archive_file)
+        try:
+            self.load_index(archive_nc)
+            try:
+                comid_index = self.comid_index[int(comid)]
+            except KeyError:
+                raise Exception("COMID %s not found in archive %s" % (comid, self.archive_file))
+            forecast_dates = sorted([forecast_date for forecast_date in self.date_index.keys() \
+                                     if (start_date is None or forecast_date >= get_forecast_date_seconds(start_date)) \
+                                     and (end_date is None or forecast_date <= get_forecast_date_seconds(end_date))])
+            date_positions = [self.date_index[forecast_date] for forecast_date in forecast_dates]
+            reach_statistics = {}
+            for statistic_name in (statistic_names or STATISTIC_NAMES):
+                statistic_var = archive_nc.variables[statistic_name]
+                if date_positions:
+                    #one slice over the archived dates ordered after reading
+                    first_position = min(date_positions)
+                    values = statistic_var[first_position:max(date_positions)+1, comid_index, :]
+                    values = np.ma.filled(values, np.nan)[np.array(date_positions) - first_position]
+                else:
+                    values = np.empty((0, len(archive_nc.dimensions['lead_time'])), dtype=np.float32)
+                reach_statistics[statistic_name] = values
+        finally:
+            archive_nc.close()
+        return [datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=forecast_date) \
+                for forecast_date in forecast_dates], reach_statistics
+
+@profiled_stage('forecast_archive')
+def archive_forecast_statistics(statistics_file, archive_location, rapid_input_directory,
+                                forecast_date_timestep):
+    """
+    Appends the statistics of a watershed forecast to the watershed archive
+    """
+    archive_file = get_forecast_archive_file(archive_location, rapid_input_directory)
+    ForecastArchive(archive_file).append_statistics(statistics_file, forecast_date_timestep)
+    return archive_file
+
+if __name__ == "__main__":
+    forecast_archive = ForecastArchive(sys.argv[1])
+    archive_dates, archive_statistics = forecast_archive.get_reach_statistics(int(sys.argv[2]),
+                                                                              start_date=sys.argv[3] if len(sys.argv) > 3 else None,
+                                                                              end_date=sys.argv[4] if len(sys.argv) > 4 else None)
+    print json.dumps({'forecast_dates' : [archive_date.strftime("%Y%m%d.%H") for archive_date in archive_dates],
+                      'statistics' : dict([(name, np.where(np.isnan(values), None, values).tolist()) \
+                                           for name, values in archive_statistics.iteritems()]),
+                      }, indent=2)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Queries the ensemble hydrographs of reaches from the output of a
+watershed forecast (output/<watershed>-<subbasin>/<forecast date>).
+
+The layout read is the ensemble cube (see ensemble_cube.py) or the Qout
+files of the ensembles, both memory mapped if they are NetCDF classic
+files (see netcdf3_memmap.py). By default the cube is read if it exists.
+A ForecastQuery keeps the COMID index of the forecast, a limited number
+of open files (least recently used are closed first) and the recently
+queried reach hydrographs up to a memory limit in memory. None of it is
+written to disk, so the index is only read once for as long as the
+ForecastQuery is kept open to serve many requests.
+
+Usage:
+    python forecast_query.py forecast_directory comid [comid ...]
+"""
+from collections import OrderedDict
+import json
+import os
+import sys
+
+import netCDF4 as NET
+import numpy as np
+
+#local imports
+from ensemble_cube import (find_ensemble_qout_files,
+                           get_ensemble_cube_file,
+                           get_ensemble_number,
+                           get_qout_comid_axis,
+                           get_qout_times)
+from ensemble_statistics import compute_ensemble_statistics
+from netcdf3_memmap import (open_netcdf_variable,
+                            read_netcdf_variable)
+
+class LRUCache(object):
+    """
+    Least recently used cache limited by the total size of its values.
+    on_evict is called with each value removed from the cache.
+    """
+    def __init__(self, max_size, size_function=None, on_evict=None):
+        self.max_size = max_size
+        self.size_function = size_function or (lambda value: 1)
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key and marks it as most recently used
+        """
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Adds the value and evicts the least recently used values over the size limit
+        """
+        self.pop(key)
+        self.items[key] = value
+        self.size += self.size_function(value)
+        while self.size > self.max_size and len(self.items) > 1:
+            self.pop(self.items.iterkeys().next())
+
+    def pop(self, key):
+        """
+        Removes the value of the key if in the cache
+        """
+        if key in self.items:
+            value = self.items.pop(key)
+            self.size -= self.size_function(value)
+            if self.on_evict is not None:
+                self.on_evict(value)
+
+    def clear(self):
+        """
+        Removes all values
+        """
+        for key in list(self.items.keys()):
+            self.pop(key)
+
+class ForecastQuery(object):
+    """
+    Ensemble hydrographs and statistics of the reaches of a watershed forecast.
+    layout is 'cube' or 'qout_files' (by default the cube if it exists).
+    """
+    def __init__(self, forecast_directory, watershed=None, subbasin=None,
+                 max_open_files=64, max_cached_series_mb=64, layout=None):
+        self.forecast_directory = forecast_directory
+        if watershed is None or subbasin is None:
+            watershed, subbasin = os.path.basename(os.path.dirname(os.path.abspath(forecast_directory))).split("-")
+        self.watershed = watershed
+        self.subbasin = subbasin
+        if layout not in (None, 'cube', 'qout_files'):
+            raise Exception("Invalid forecast layout %s" % layout)
+        self.cube_file = get_ensemble_cube_file(forecast_directory, watershed, subbasin)
+        if not os.path.exists(self.cube_file):
+            if layout == 'cube':
+                raise Exception("No ensemble cube found in %s" % forecast_directory)
+            self.cube_file = None
+        elif layout == 'qout_files':
+            self.cube_file = None
+        if self.cube_file is None:
+            self.qout_files = find_ensemble_qout_files(forecast_directory, watershed, subbasin)
+            if not self.qout_files:
+                raise Exception("No forecast output found in %s" % forecast_directory)
+        self.open_files = LRUCache(max_open_files, on_evict=lambda data_nc: data_nc.close())
+        self.series_cache = LRUCache(max_cached_series_mb*1024*1024, size_function=lambda series: series.nbytes)
+        self.comid_index = None
+        self.ensemble_numbers = None
+        self.times = None
+        self.ensemble_time_indices = None
+
+    def get_qout_variable(self, qout_file):
+        """
+        Returns the open Qout variable of an ensemble file
+        """
+        qout_variable = self.open_files.get((qout_file, 'Qout'))
+        if qout_variable is None:
+            qout_variable = open_netcdf_variable(qout_file, 'Qout')
+            self.open_files.put((qout_file, 'Qout'), qout_variable)
+        return qout_variable
+
+    def load_index(self):
+        """
+        Reads the COMIDs, ensembles and time axis of the forecast once
+        """
+        if self.comid_index is not None:
+            return
+        if self.cube_file:
+            comids = read_netcdf_variable(self.cube_file, 'COMID')
+            self.ensemble_numbers = [int(ensemble) for ensemble in read_netcdf_variable(self.cube_file, 'ensemble')]
+            self.times = np.array(read_netcdf_variable(self.cube_file, 'time'), dtype=np.int64)
+        else:
+            comids = read_netcdf_variable(self.qout_files[0], 'COMID')
+            self.ensemble_numbers = [get_ensemble_number(qout_file) for qout_file in self.qout_files]
+            ensemble_times = []
+            for qout_file in self.qout_files:
+                qout_nc = NET.Dataset(qout_file)
+                try:
+                    ensemble_times.append(get_qout_times(qout_nc))
+                finally:
+                    qout_nc.close()
+            self.times = np.unique(np.concatenate(ensemble_times))
+            self.ensemble_time_indices = [np.searchsorted(self.times, ensemble_time) \
+                                          for ensemble_time in ensemble_times]
+        self.comid_index = dict([(int(comid), index) for index, comid in enumerate(comids)])
+
+    def get_times(self):
+        """
+        Returns the times of the forecast
+        """
+        self.load_index()
+        return self.times
+
+    def get_comid_indices(self, comids):
+        """
+        Returns the index of each COMID in the forecast
+        """
+        self.load_index()
+        try:
+            return [self.comid_index[int(comid)] for comid in comids]
+        except KeyError as ex:
+            raise Exception("COMID %s not found in forecast %s" % (ex, self.forecast_directory))
+
+    def get_num_reaches(self):
+        """
+        Returns the number of reaches in the forecast
+        """
+        self.load_index()
+        return len(self.comid_index)
+
+    def read_reaches(self, reach_selection, num_reaches):
+        """
+        Reads the ensemble hydrographs (reach, ensemble, time) of the
+        reaches selected by a slice or sorted indices
+        """
+        self.load_index()
+        if self.cube_file:
+            return np.ma.filled(self.get_qout_variable(self.cube_file)[reach_selection],
+                                np.nan).astype(np.float32)
+        series = np.empty((num_reaches, len(self.qout_files), len(self.times)), dtype=np.float32)
+        series.fill(np.nan)
+        for ensemble_index, qout_file in enumerate(self.qout_files):
+            qout_variable = self.get_qout_variable(qout_file)
+            if get_qout_comid_axis(qout_variable) == 0:
+                ensemble_series = qout_variable[reach_selection, :]
+            else:
+                ensemble_series = qout_variable[:, reach_selection].transpose()
+            series[:, ensemble_index, self.ensemble_time_indices[ensemble_index]] = \
+                np.ma.filled(ensemble_series, np.nan)
+        return series
+
+    def read_series(self, comid_indices):
+        """
+        Reads the ensemble hydrographs (reach, ensemble, time) of the reaches
+        """
+        sorted_indices = np.unique(comid_indices)
+        sorted_series = self.read_reaches(sorted_indices, len(sorted_indices))
+        return sorted_series[np.searchsorted(sorted_indices, comid_indices)]
+
+    def get_hydrographs(self, comids):
+        """
+        Returns the ensemble hydrographs (ensemble, time) of each COMID as a dictionary
+        """
+        comid_indices = self.get_comid_indices(comids)
+        hydrographs = {}
+        missing_comids = []
+        missing_indices = []
+        for comid, comid_index in zip(comids, comid_indices):
+            series = self.series_cache.get(comid_index)
+            if series is None:
+                missing_comids.append(comid)
+                missing_indices.append(comid_index)
+            else:
+                hydrographs[comid] = series
+        if missing_indices:
+            for comid, comid_index, series in zip(missing_comids, missing_indices, self.read_series(missing_indices)):
+                self.series_cache.put(comid_index, series)
+                hydrographs[comid] = series
+        return hydrographs
+
+    def get_hydrograph(self, comid):
+        """
+        Returns the ensemble hydrographs (ensemble, time) of a COMID
+        """
+        return self.get_hydrographs([comid])[comid]
+
+    def get_statistics(self, comids):
+        """
+        Returns the ensemble statistics over time of each COMID as a dictionary
+        """
+        return dict([(comid, compute_ensemble_statistics(series, axis=0)) \
+                     for comid, series in self.get_hydrographs(comids).iteritems()])
+
+    def get_cache_stats(self):
+        """
+        Returns the hit and miss counts of the caches
+        """
+        return {'open_files' : len(self.open_files),
+                'file_hits' : self.open_files.hits,
+                'file_misses' : self.open_files.misses,
+                'cached_series' : len(self.series_cache),
+                'cached_series_bytes' : self.series_cache.size,
+                'series_hits' : self.series_cache.hits,
+                'series_misses' : self.series_cache.misses,
+                }
+
+    def close(self):
+        """
+        Closes the open files and clears the cached series
+        """
+        self.open_files.clear()
+        self.series_cache.clear()
+
+if __name__ == "__main__":
+    forecast_query = ForecastQuery(sys.argv[1])
+    try:
+        query_comids = [int(comid) for comid in sys.argv[2:]]
+        statistics = forecast_query.get_statistics(query_comids)
+        print json.dumps({'time' : forecast_query.get_times().tolist(),
+                          'ensembles' : forecast_query.ensemble_numbers,
+                          'statistics' : dict([(str(comid), dict([(name, np.where(np.isnan(values), None,
+                                                                                  values).tolist()) \
+                                                                  for name, values in comid_statistics.iteritems()])) \
+                                               for comid, comid_statistics in statistics.iteritems()]),
+                          }, indent=2)
+    finally:
+        forecast_query.close()
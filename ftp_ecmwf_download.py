@@ -1,196 +1,891 @@
-import datetime
-from glob import glob
-import os
-from shutil import rmtree
-import tarfile
-
-"""
-This section adapted from https://github.com/keepitsimple/pyFTPclient
-"""
-import threading
-import ftplib
-import socket
-import time
-
-
-def setInterval(interval, times = -1):
-    # This will be the actual decorator,
-    # with fixed interval and times parameter
-    def outer_wrap(function):
-        # This will be the function to be
-        # called
-        def wrap(*args, **kwargs):
-            stop = threading.Event()
-
-            # This is another function to be executed
-            # in a different thread to simulate setInterval
-            def inner_wrap():
-                i = 0
-                while i != times and not stop.isSet():
-                    stop.wait(interval)
-                    function(*args, **kwargs)
-                    i += 1
-
-            t = threading.Timer(0, inner_wrap)
-            t.daemon = True
-            t.start()
-            return stop
-        return wrap
-    return outer_wrap
-
-
-class PyFTPclient:
-    def __init__(self, host, login, passwd, directory="", monitor_interval = 30):
-        self.host = host
-        self.login = login
-        self.passwd = passwd
-        self.directory = directory
-        self.monitor_interval = monitor_interval
-        self.ptr = None
-        self.max_attempts = 15
-        self.waiting = True
-        self.ftp = ftplib.FTP(self.host)
-
-    def connect(self):
-        """
-        Connect to ftp site
-        """
-        self.ftp = ftplib.FTP(self.host)
-        self.ftp.set_debuglevel(1)
-        self.ftp.set_pasv(True)
-        self.ftp.login(self.login, self.passwd)
-        if self.directory:
-            self.ftp.cwd(self.directory)
-        # optimize socket params for download task
-        self.ftp.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        self.ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 75)
-        self.ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
-
-    def download_file(self, dst_filename, local_filename = None):
-        res = ''
-        if local_filename is None:
-            local_filename = dst_filename
-
-        with open(local_filename, 'w+b') as f:
-            self.ptr = f.tell()
-
-            @setInterval(self.monitor_interval)
-            def monitor():
-                if not self.waiting:
-                    i = f.tell()
-                    if self.ptr < i:
-                        print "DEBUG: %d  -  %0.1f Kb/s" % (i, (i-self.ptr)/(1024*self.monitor_interval))
-                        self.ptr = i
-                    else:
-                        self.ftp.close()
-
-            self.connect()
-            self.ftp.voidcmd('TYPE I')
-            dst_filesize = self.ftp.size(dst_filename)
-
-            mon = monitor()
-            while dst_filesize > f.tell():
-                try:
-                    self.connect()
-                    self.waiting = False
-                    # retrieve file from position where we were disconnected
-                    res = self.ftp.retrbinary('RETR %s' % dst_filename, f.write) if f.tell() == 0 else \
-                              self.ftp.retrbinary('RETR %s' % dst_filename, f.write, rest=f.tell())
-
-                except:
-                    self.max_attempts -= 1
-                    if self.max_attempts == 0:
-                        mon.set()
-                        raise
-                    self.waiting = True
-                    print 'INFO: waiting 30 sec...'
-                    time.sleep(30)
-                    print 'INFO: reconnect'
-
-
-            mon.set() #stop monitor
-            self.ftp.close()
-
-            if not res.startswith('226'): #file successfully transferred
-                print 'ERROR: Downloaded file {0} is not full.'.format(dst_filename)
-                print res
-                return False
-            return True
-"""
-end pyFTPclient adapation section
-"""
-
-def remove_old_ftp_downloads(folder):
-    """
-    remove files/folders older than 1 days old
-    """
-    date_now = datetime.datetime.utcnow()
-    all_paths = glob(os.path.join(folder,'Runoff*netcdf*'))
-    for path in all_paths:
-        date_file = datetime.datetime.strptime(os.path.basename(path).split('.')[1],'%Y%m%d')
-        if date_now - date_file > datetime.timedelta(1):
-            if os.path.isdir(path):
-                rmtree(path)
-            else:
-                os.remove(path)
-                
-def download_all_ftp(download_dir, file_match):
-    """
-    Remove downloads from before 2 days ago
-    Download all files from the ftp site matching date
-    Extract downloaded files
-    """
-    remove_old_ftp_downloads(download_dir)
-    #init FTPClient
-    ftp_client = PyFTPclient(host='ftp.ecmwf.int',
-                             login='',
-                             passwd='',
-                             directory='tcyc')
-    ftp_client.connect()
-    #open the file for writing in binary mode
-    print 'Opening local file'
-    file_list = ftp_client.ftp.nlst(file_match)
-    ftp_client.ftp.quit()
-    all_files_downloaded = []
-    for dst_filename in file_list:
-        local_path = os.path.join(download_dir,dst_filename)
-        #get correct local_dir
-        if local_path.endswith('.tar.gz'):
-            local_dir = local_path[:-7]
-        else:
-            local_dir = download_dir
-        #download and unzip file
-        try:
-            #download from ftp site
-            unzip_file = False
-            if not os.path.exists(local_path) and not os.path.exists(local_dir):
-                print "Downloading from ftp site: " + dst_filename
-                unzip_file = ftp_client.download_file(dst_filename, local_path)
-            else:
-                print dst_filename + ' already exists. Skipping download.'
-            #extract from tar.gz
-            if unzip_file:
-                os.mkdir(local_dir)
-                print "Extracting: " + dst_filename
-                tar = tarfile.open(local_path)
-                tar.extractall(local_dir)
-                tar.close()
-                #add successfully downloaded file to list
-                all_files_downloaded.append(local_dir)
-            else:
-                print dst_filename + ' already extracted. Skipping extraction.'
-            #remove the tarfile
-            if os.path.exists(local_path):
-                os.remove(local_path)
-        except Exception as ex:
-            print ex
-            continue
-        
-    print "All downloads completed!"
-    return all_files_downloaded
-
-if __name__ == "__main__":
-    ecmwf_forecast_location = "C:/Users/byu_rapid/Documents/RAPID/ECMWF"
-    time_string = datetime.datetime.utcnow().strftime('%Y%m%d')
-    #time_string = datetime.datetime(2014,11,2).strftime('%Y%m%d')
-    all_ecmwf_files = download_all_ftp(ecmwf_forecast_location,'Runoff.'+time_string+'*.netcdf.tar.gz')
+import datetime
+from fnmatch import fnmatch
+from glob import glob
+import hashlib
+import json
+import os
+from Queue import Queue
+from shutil import rmtree
+import tarfile
+
+"""
+This section adapted from https://github.com/keepitsimple/pyFTPclient
+"""
+import threading
+import ftplib
+import socket
+import time
+
+
+def setInterval(interval, times = -1):
+    # This will be the actual decorator,
+    # with fixed interval and times parameter
+    def outer_wrap(function):
+        # This will be the function to be
+        # called
+        def wrap(*args, **kwargs):
+            stop = threading.Event()
+
+            # This is another function to be executed
+            # in a different thread to simulate setInterval
+            def inner_wrap():
+                i = 0
+                while i != times and not stop.isSet():
+                    stop.wait(interval)
+                    if stop.isSet():
+                        break
+                    function(*args, **kwargs)
+                    i += 1
+
+            t = threading.Timer(0, inner_wrap)
+            t.daemon = True
+            t.start()
+            return stop
+        return wrap
+    return outer_wrap
+
+
+class PyFTPclient:
+    def __init__(self, host, login, passwd, directory="", monitor_interval = 30,
+                 port=21, debug_level=0, max_attempts=15, retry_wait=30):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.passwd = passwd
+        self.directory = directory
+        self.monitor_interval = monitor_interval
+        self.debug_level = debug_level
+        self.ptr = None
+        self.max_attempts = max_attempts
+        self.retry_wait = retry_wait
+        self.waiting = True
+        self.ftp = ftplib.FTP()
+
+    def connect(self):
+        """
+        Connect to ftp site
+        """
+        self.ftp = ftplib.FTP()
+        self.ftp.set_debuglevel(self.debug_level)
+        self.ftp.connect(self.host, self.port)
+        self.ftp.set_pasv(True)
+        self.ftp.login(self.login, self.passwd)
+        if self.directory:
+            self.ftp.cwd(self.directory)
+        # optimize socket params for download task
+        self.ftp.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 75)
+        self.ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+
+    def download_file(self, dst_filename, local_filename = None, resume=False):
+        """
+        Downloads the file and resumes after a disconnect. With resume, an
+        existing local file is taken as the start of the file and only the
+        rest is downloaded.
+        """
+        res = ''
+        if local_filename is None:
+            local_filename = dst_filename
+
+        if resume and os.path.exists(local_filename):
+            f = open(local_filename, 'r+b')
+            f.seek(0, os.SEEK_END)
+            print 'INFO: resuming {0} from byte {1}'.format(dst_filename, f.tell())
+        else:
+            f = open(local_filename, 'w+b')
+        with f:
+            self.ptr = f.tell()
+
+            @setInterval(self.monitor_interval)
+            def monitor():
+                if not self.waiting:
+                    i = f.tell()
+                    if self.ptr < i:
+                        print "DEBUG: %s %d  -  %0.1f Kb/s" % (dst_filename, i, (i-self.ptr)/(1024*self.monitor_interval))
+                        self.ptr = i
+                    else:
+                        self.ftp.close()
+
+            self.connect()
+            self.ftp.voidcmd('TYPE I')
+            dst_filesize = self.ftp.size(dst_filename)
+            if f.tell() > dst_filesize:
+                #local file is not a part of the remote file
+                f.seek(0)
+                f.truncate()
+                self.ptr = 0
+
+            mon = monitor()
+            attempts_left = self.max_attempts
+            #the connection used for the size is reused for the first attempt
+            reconnect = False
+            while dst_filesize > f.tell():
+                try:
+                    if reconnect:
+                        self.ftp.close()
+                        self.connect()
+                        self.ftp.voidcmd('TYPE I')
+                    self.waiting = False
+                    # retrieve file from position where we were disconnected
+                    res = self.ftp.retrbinary('RETR %s' % dst_filename, f.write) if f.tell() == 0 else \
+                              self.ftp.retrbinary('RETR %s' % dst_filename, f.write, rest=f.tell())
+
+                except:
+                    attempts_left -= 1
+                    if attempts_left == 0:
+                        mon.set()
+                        raise
+                    self.waiting = True
+                    reconnect = True
+                    print 'INFO: waiting %s sec...' % self.retry_wait
+                    time.sleep(self.retry_wait)
+                    print 'INFO: reconnect'
+
+
+            mon.set() #stop monitor
+            self.ftp.close()
+
+            #226 - file successfully transferred (no transfer if already complete)
+            if f.tell() != dst_filesize or (res and not res.startswith('226')):
+                print 'ERROR: Downloaded file {0} is not full.'.format(dst_filename)
+                print res
+                return False
+            return True
+
+    def copy(self):
+        """
+        Returns a new client with the same settings for another connection
+        """
+        return PyFTPclient(host=self.host,
+                           login=self.login,
+                           passwd=self.passwd,
+                           directory=self.directory,
+                           monitor_interval=self.monitor_interval,
+                           port=self.port,
+                           debug_level=self.debug_level,
+                           max_attempts=self.max_attempts,
+                           retry_wait=self.retry_wait)
+
+    def download_segment(self, dst_filename, local_filename, segment_start, segment_end):
+        """
+        Downloads the bytes from segment_start up to segment_end of the file
+        into the same position of the local file. The transfer starts at
+        the segment with REST and is aborted at the end of the segment.
+        After a disconnect or stall it resumes from the last byte written.
+        """
+        position = segment_start
+        attempts_left = self.max_attempts
+        with open(local_filename, 'r+b') as f:
+            while position < segment_end:
+                try:
+                    self.connect()
+                    self.ftp.voidcmd('TYPE I')
+                    conn = self.ftp.transfercmd('RETR %s' % dst_filename, rest=position)
+                    try:
+                        #a stalled transfer raises socket.timeout
+                        conn.settimeout(self.monitor_interval)
+                        f.seek(position)
+                        while position < segment_end:
+                            data = conn.recv(min(64*1024, segment_end-position))
+                            if not data:
+                                break
+                            f.write(data)
+                            position += len(data)
+                    finally:
+                        conn.close()
+                    if position < segment_end:
+                        raise Exception("Transfer of segment ended early at byte %s" % position)
+                except Exception as ex:
+                    attempts_left -= 1
+                    if attempts_left == 0:
+                        raise
+                    print 'INFO: segment %s-%s of %s failed at byte %s (%s). Waiting %s sec...' % \
+                        (segment_start, segment_end, dst_filename, position, ex, self.retry_wait)
+                    time.sleep(self.retry_wait)
+                finally:
+                    #the rest of the file is not needed so the control connection is dropped
+                    self.ftp.close()
+        return True
+
+    def get_file_size(self, dst_filename):
+        """
+        Returns the size of the file on the ftp site
+        """
+        self.connect()
+        try:
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size(dst_filename)
+        finally:
+            self.ftp.close()
+
+    def download_file_segmented(self, dst_filename, local_filename = None,
+                                num_segments=4, min_segment_size=8*1024*1024,
+                                connection_semaphore=None, completed_segments=None,
+                                segment_callback=None):
+        """
+        Downloads the file in num_segments byte ranges at once, each on its
+        own connection, into a preallocated local file. Files too small to
+        split are downloaded with download_file.
+
+        If given, the size query and each segment hold connection_semaphore
+        while connected. The segments in completed_segments (list of
+        (segment_start, segment_end)) are kept from the local file of an
+        interrupted download and segment_callback(segment_start, segment_end)
+        is called when a segment is finished.
+        """
+        if local_filename is None:
+            local_filename = dst_filename
+
+        if connection_semaphore is None:
+            dst_filesize = self.get_file_size(dst_filename)
+        else:
+            with connection_semaphore:
+                dst_filesize = self.get_file_size(dst_filename)
+
+        num_segments = max(1, min(num_segments, dst_filesize // min_segment_size))
+        if num_segments == 1:
+            if connection_semaphore is None:
+                return self.download_file(dst_filename, local_filename)
+            with connection_semaphore:
+                return self.download_file(dst_filename, local_filename)
+
+        segment_size = -(-dst_filesize // num_segments)
+        segments = [(segment_start, min(segment_start+segment_size, dst_filesize)) \
+                    for segment_start in range(0, dst_filesize, segment_size)]
+        completed_segments = set([tuple(segment) for segment in completed_segments or []])
+        if completed_segments and os.path.exists(local_filename) \
+                and os.path.getsize(local_filename) == dst_filesize:
+            segments = [segment for segment in segments if segment not in completed_segments]
+            print 'INFO: resuming {0} with {1} segments left'.format(dst_filename, len(segments))
+        else:
+            #preallocate so the segments can be written in place
+            with open(local_filename, 'wb') as f:
+                f.truncate(dst_filesize)
+        errors = []
+
+        def download_segment(segment_start, segment_end):
+            try:
+                if connection_semaphore is None:
+                    self.copy().download_segment(dst_filename, local_filename,
+                                                 segment_start, segment_end)
+                else:
+                    with connection_semaphore:
+                        self.copy().download_segment(dst_filename, local_filename,
+                                                     segment_start, segment_end)
+            except Exception as ex:
+                errors.append((segment_start, segment_end, ex))
+                return
+            if segment_callback is not None:
+                segment_callback(segment_start, segment_end)
+
+        segment_threads = []
+        for segment_start, segment_end in segments:
+            segment_thread = threading.Thread(target=download_segment,
+                                              args=(segment_start, segment_end))
+            segment_thread.daemon = True
+            segment_thread.start()
+            segment_threads.append(segment_thread)
+        for segment_thread in segment_threads:
+            segment_thread.join()
+
+        if errors:
+            for segment_start, segment_end, ex in errors:
+                print 'ERROR: Segment %s-%s of %s failed: %s' % (segment_start, segment_end,
+                                                                dst_filename, ex)
+            return False
+        if os.path.getsize(local_filename) != dst_filesize:
+            print 'ERROR: Downloaded file {0} is not full.'.format(dst_filename)
+            return False
+        return True
+
+    def download_and_extract_stream(self, dst_filename, local_dir, member_callback=None,
+                                    local_filename=None):
+        """
+        Streams a tar.gz file from the ftp site through a pipe into a tar
+        stream reader that writes out the members as they arrive without
+        reading the archive back from disk. member_callback(path) is called
+        for each file as soon as it is extracted. If local_filename is
+        given, the archive is also written to it as it arrives so an
+        interrupted stream can be resumed with download_file.
+
+        Returns the number of bytes received, the md5 checksum of the
+        archive and the sizes of the extracted files by member name, which
+        is None if the whole archive was not extracted.
+        """
+        read_fd, write_fd = os.pipe()
+        extract_errors = []
+        extracted_members = {}
+
+        def extract():
+            with os.fdopen(read_fd, 'rb') as pipe_in:
+                try:
+                    with tarfile.open(fileobj=pipe_in, mode='r|gz') as tar:
+                        for member in tar:
+                            member_size = extract_member_verified(tar, member, local_dir)
+                            if member_size is not None:
+                                extracted_members[member.name] = member_size
+                                if member_callback is not None:
+                                    member_callback(os.path.join(local_dir, member.name))
+                except Exception as ex:
+                    extract_errors.append(ex)
+                    #drain the pipe so the download is not blocked
+                    while pipe_in.read(64*1024):
+                        pass
+
+        extract_thread = threading.Thread(target=extract)
+        extract_thread.daemon = True
+        extract_thread.start()
+
+        res = ''
+        bytes_received = [0]
+        file_hash = hashlib.md5()
+        local_file = None
+        try:
+            if local_filename is not None:
+                local_file = open(local_filename, 'wb')
+            with os.fdopen(write_fd, 'wb') as pipe_out:
+                def write_chunk(data):
+                    if local_file is not None:
+                        local_file.write(data)
+                    pipe_out.write(data)
+                    file_hash.update(data)
+                    bytes_received[0] += len(data)
+                self.connect()
+                #a stalled transfer raises socket.timeout
+                self.ftp.timeout = self.monitor_interval
+                self.ftp.voidcmd('TYPE I')
+                res = self.ftp.retrbinary('RETR %s' % dst_filename, write_chunk)
+        except Exception as ex:
+            print 'ERROR: Stream of {0} interrupted: {1}'.format(dst_filename, ex)
+        finally:
+            self.ftp.close()
+            if local_file is not None:
+                local_file.close()
+            extract_thread.join()
+
+        if extract_errors:
+            print 'ERROR: Extraction of stream {0} failed: {1}'.format(dst_filename, extract_errors[0])
+            return bytes_received[0], None, None
+        if not res.startswith('226'):
+            return bytes_received[0], None, None
+        return bytes_received[0], file_hash.hexdigest(), extracted_members
+"""
+end pyFTPclient adapation section
+"""
+
+def get_file_md5(file_path):
+    """
+    Returns the md5 checksum of the file contents
+    """
+    file_hash = hashlib.md5()
+    with open(file_path, 'rb') as file_con:
+        for chunk in iter(lambda: file_con.read(1024*1024), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def extract_member_verified(tar, member, local_dir):
+    """
+    Extracts a member of the tar file and checks the size of the
+    extracted file. Returns the size of the file or None if the
+    member is not a file.
+    """
+    tar.extract(member, local_dir)
+    if not member.isfile():
+        return None
+    extracted_size = os.path.getsize(os.path.join(local_dir, member.name))
+    if extracted_size != member.size:
+        raise Exception("Extracted %s is %s bytes instead of %s" % (member.name,
+                                                                     extracted_size,
+                                                                     member.size))
+    return member.size
+
+class DownloadManifest(object):
+    """
+    Record of the expected size, bytes received, completed segments, md5
+    checksum and extracted files of each download in the download directory.
+
+    Partial downloads are resumed from the bytes on disk (or the completed
+    segments of a segmented download) and a file is only taken as done
+    when all of its extracted members are on disk with their size in the
+    archive.
+    """
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.download_dir = os.path.dirname(manifest_file)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file, 'rb') as manifest_con:
+                    self.entries = json.load(manifest_con)
+            except ValueError:
+                print "Invalid download manifest", manifest_file, ". Starting new manifest ..."
+        #only keep entries of downloads still on disk
+        self.entries = dict([(dst_filename, entry) for dst_filename, entry in self.entries.iteritems() \
+                             if os.path.exists(self.get_local_path(dst_filename)) \
+                             or os.path.exists(self.get_local_dir(dst_filename))])
+
+    def get_local_path(self, dst_filename):
+        """
+        Returns the local path of the downloaded file
+        """
+        return os.path.join(self.download_dir, dst_filename)
+
+    def get_local_dir(self, dst_filename):
+        """
+        Returns the directory the file is extracted into
+        """
+        local_path = self.get_local_path(dst_filename)
+        if local_path.endswith('.tar.gz'):
+            return local_path[:-7]
+        return self.download_dir
+
+    def write(self):
+        """
+        Writes the manifest (call with lock held)
+        """
+        temp_manifest_file = "%s.tmp" % self.manifest_file
+        with open(temp_manifest_file, 'wb') as manifest_con:
+            json.dump(self.entries, manifest_con)
+        os.rename(temp_manifest_file, self.manifest_file)
+
+    def get_entry(self, dst_filename):
+        """
+        Returns a copy of the entry of the file or None
+        """
+        with self.lock:
+            entry = self.entries.get(dst_filename)
+            if entry is None:
+                return None
+            return dict(entry)
+
+    def update(self, dst_filename, **values):
+        """
+        Updates the entry of the file
+        """
+        with self.lock:
+            self.entries.setdefault(dst_filename, {}).update(values)
+            self.write()
+
+    def start_download(self, dst_filename, expected_size):
+        """
+        Creates the entry of the file unless one for the same size exists.
+        Returns True if the entry is new.
+        """
+        entry = self.get_entry(dst_filename)
+        if entry is not None and entry.get('expected_size') == expected_size:
+            return False
+        with self.lock:
+            self.entries[dst_filename] = {'expected_size' : expected_size,
+                                          'bytes_received' : 0,
+                                          'md5' : None,
+                                          'complete' : False,
+                                          'segmented' : False,
+                                          'segments' : [],
+                                          'extracted' : False,
+                                          'members' : {},
+                                          }
+            self.write()
+        return True
+
+    def add_segment(self, dst_filename, segment_start, segment_end):
+        """
+        Records a completed segment of a segmented download
+        """
+        with self.lock:
+            entry = self.entries.setdefault(dst_filename, {})
+            entry.setdefault('segments', []).append([segment_start, segment_end])
+            entry['bytes_received'] = sum([end - start for start, end in entry['segments']])
+            self.write()
+
+    def is_download_complete(self, dst_filename):
+        """
+        Checks if the local file is complete and matches its checksum
+        """
+        entry = self.get_entry(dst_filename)
+        local_path = self.get_local_path(dst_filename)
+        if entry is None or not entry.get('complete') or not os.path.exists(local_path):
+            return False
+        return os.path.getsize(local_path) == entry['expected_size'] \
+            and get_file_md5(local_path) == entry['md5']
+
+    def is_extracted(self, dst_filename):
+        """
+        Checks if all members of the file are extracted with their size
+        """
+        entry = self.get_entry(dst_filename)
+        if entry is None or not entry.get('extracted'):
+            return False
+        local_dir = self.get_local_dir(dst_filename)
+        for member_name, member_size in entry['members'].iteritems():
+            member_path = os.path.join(local_dir, member_name)
+            if not os.path.exists(member_path) or os.path.getsize(member_path) != member_size:
+                print "Extracted file", member_path, "missing or incomplete"
+                return False
+        return True
+
+#maximum number of simultaneous connections to an ftp host
+HOST_CONNECTION_LIMITS = {'ftp.ecmwf.int' : 4}
+DEFAULT_HOST_CONNECTION_LIMIT = 2
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+def get_host_semaphore(host):
+    """
+    Returns the semaphore limiting the connections to the host
+    """
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(HOST_CONNECTION_LIMITS.get(host,
+                                                                   DEFAULT_HOST_CONNECTION_LIMIT))
+        return host_semaphores[host]
+
+class ConcurrentFTPDownloader(object):
+    """
+    Downloads several files at once over a pool of FTP connections.
+
+    The number of simultaneous connections to a host is capped by
+    HOST_CONNECTION_LIMITS across all downloaders in the process. Each
+    connection resumes its file after a disconnect as in
+    PyFTPclient.download_file. Use with a local FTP server by passing
+    its host and port.
+
+    With segments_per_file above 1, large files are split into byte
+    ranges downloaded on separate connections. The segments count
+    against the connection limit of the host while the pool limits the
+    number of files in flight.
+    """
+    def __init__(self, host, login, passwd, directory="", port=21,
+                 num_connections=4, debug_level=0, monitor_interval=30,
+                 segments_per_file=1, retry_wait=30):
+        self.host = host
+        self.segments_per_file = segments_per_file
+        self.host_semaphore = get_host_semaphore(host)
+        self.num_connections = min(num_connections,
+                                   HOST_CONNECTION_LIMITS.get(host, DEFAULT_HOST_CONNECTION_LIMIT))
+        self.client_pool = Queue()
+        for i in range(self.num_connections):
+            self.client_pool.put(PyFTPclient(host=host,
+                                             login=login,
+                                             passwd=passwd,
+                                             directory=directory,
+                                             monitor_interval=monitor_interval,
+                                             retry_wait=retry_wait,
+                                             port=port,
+                                             debug_level=debug_level))
+        self.lock = threading.Lock()
+        self.download_stats = []
+        self.time_start = None
+        self.time_end = None
+
+    def list_files(self, file_match):
+        """
+        Returns the names of the files on the ftp site matching the pattern
+        """
+        ftp_client = self.client_pool.get()
+        try:
+            with self.host_semaphore:
+                ftp_client.connect()
+                try:
+                    #match locally as not all servers support patterns in NLST
+                    return [file_name for file_name in ftp_client.ftp.nlst() \
+                            if fnmatch(file_name, file_match)]
+                finally:
+                    ftp_client.ftp.quit()
+        finally:
+            self.client_pool.put(ftp_client)
+
+    def get_file_sizes(self, file_list):
+        """
+        Returns the sizes of the files on the ftp site by name
+        """
+        ftp_client = self.client_pool.get()
+        try:
+            with self.host_semaphore:
+                ftp_client.connect()
+                try:
+                    ftp_client.ftp.voidcmd('TYPE I')
+                    return dict([(dst_filename, ftp_client.ftp.size(dst_filename)) \
+                                 for dst_filename in file_list])
+                finally:
+                    ftp_client.ftp.quit()
+        finally:
+            self.client_pool.put(ftp_client)
+
+    def download_file(self, dst_filename, local_filename, resume=False,
+                      completed_segments=None, segment_callback=None):
+        """
+        Downloads a file with a connection from the pool. With resume, a
+        partial local file is continued. With segments, the completed
+        segments of the local file are kept (see download_file_segmented).
+        """
+        ftp_client = self.client_pool.get()
+        try:
+            time_start = time.time()
+            if self.segments_per_file > 1:
+                success = ftp_client.download_file_segmented(dst_filename, local_filename,
+                                                             num_segments=self.segments_per_file,
+                                                             connection_semaphore=self.host_semaphore,
+                                                             completed_segments=completed_segments,
+                                                             segment_callback=segment_callback)
+            else:
+                with self.host_semaphore:
+                    success = ftp_client.download_file(dst_filename, local_filename, resume)
+            seconds = time.time() - time_start
+        finally:
+            self.client_pool.put(ftp_client)
+        file_size = os.path.getsize(local_filename)
+        self.record_download(dst_filename, file_size, seconds)
+        return success
+
+    def download_and_extract_stream(self, dst_filename, local_dir, member_callback=None,
+                                    local_filename=None):
+        """
+        Streams and extracts a tar.gz file with a connection from the pool.
+        Returns the md5 checksum and the extracted member sizes or None.
+        """
+        ftp_client = self.client_pool.get()
+        try:
+            with self.host_semaphore:
+                time_start = time.time()
+                bytes_received, md5, extracted_members = \
+                    ftp_client.download_and_extract_stream(dst_filename,
+                                                           local_dir,
+                                                           member_callback,
+                                                           local_filename)
+                seconds = time.time() - time_start
+        finally:
+            self.client_pool.put(ftp_client)
+        self.record_download(dst_filename, bytes_received, seconds)
+        return bytes_received, md5, extracted_members
+
+    def record_download(self, dst_filename, file_size, seconds):
+        """
+        Records the size and time of a download for the throughput summary
+        """
+        with self.lock:
+            self.download_stats.append((dst_filename, file_size, seconds))
+        print "Downloaded %s (%0.1f MB in %0.1f s - %0.1f MB/s)" % (dst_filename,
+                                                                  file_size/(1024.0*1024.0), seconds,
+                                                                  file_size/(1024.0*1024.0*max(seconds, 1e-6)))
+
+    def run(self, items, process_item):
+        """
+        Calls process_item(item) for each item with one thread per
+        connection and returns the results in the order of the items.
+        Failed items have a result of None.
+        """
+        item_queue = Queue()
+        for index, item in enumerate(items):
+            item_queue.put((index, item))
+        results = [None]*len(items)
+
+        def worker():
+            while True:
+                try:
+                    index, item = item_queue.get_nowait()
+                except Exception:
+                    return
+                try:
+                    results[index] = process_item(item)
+                except Exception as ex:
+                    print item, ex
+                    pass
+
+        self.time_start = time.time()
+        workers = []
+        for i in range(min(self.num_connections, len(items))):
+            worker_thread = threading.Thread(target=worker)
+            worker_thread.daemon = True
+            worker_thread.start()
+            workers.append(worker_thread)
+        for worker_thread in workers:
+            worker_thread.join()
+        self.time_end = time.time()
+        return results
+
+    def print_throughput_summary(self):
+        """
+        Prints the aggregate throughput of the downloads
+        """
+        if not self.download_stats or self.time_start is None:
+            return
+        total_bytes = sum([file_size for dst_filename, file_size, seconds in self.download_stats])
+        wall_seconds = max(self.time_end - self.time_start, 1e-6)
+        print "Downloaded %s files (%0.1f MB) in %0.1f s with %s connections to %s" % \
+            (len(self.download_stats), total_bytes/(1024.0*1024.0), wall_seconds,
+             self.num_connections, self.host)
+        print "Aggregate throughput: %0.1f MB/s" % (total_bytes/(1024.0*1024.0*wall_seconds))
+
+def remove_old_ftp_downloads(folder):
+    """
+    remove files/folders older than 1 days old
+    """
+    date_now = datetime.datetime.utcnow()
+    all_paths = glob(os.path.join(folder,'Runoff*netcdf*'))
+    for path in all_paths:
+        date_file = datetime.datetime.strptime(os.path.basename(path).split('.')[1],'%Y%m%d')
+        if date_now - date_file > datetime.timedelta(1):
+            if os.path.isdir(path):
+                rmtree(path)
+            else:
+                os.remove(path)
+                
+def print_extracted_member(member_path):
+    """
+    Reports a file extracted from a tarball
+    """
+    print "Extracted: " + member_path
+
+def download_and_extract_ftp_file(downloader, download_manifest, dst_filename, expected_size,
+                                  stream_extract=False, member_callback=print_extracted_member):
+    """
+    Downloads and extracts a tarball from the ftp site.
+    Returns the extracted directory or None if it was not downloaded.
+
+    A partial tarball from an earlier run is resumed and each extracted
+    file is checked against its size in the archive. The download is
+    skipped only if the manifest shows all files were extracted.
+
+    With stream_extract, the tarball is extracted while it is downloaded
+    and written to disk as it arrives. If the stream is interrupted, the
+    file download resumes from the bytes on disk.
+    member_callback(path) is called for each extracted file.
+    """
+    local_path = download_manifest.get_local_path(dst_filename)
+    local_dir = download_manifest.get_local_dir(dst_filename)
+    if download_manifest.is_extracted(dst_filename):
+        print dst_filename + ' already downloaded and extracted. Skipping download.'
+        #remove the tarfile
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return None
+
+    if download_manifest.start_download(dst_filename, expected_size):
+        #remove files of a different or unrecorded download
+        if os.path.exists(local_path):
+            os.remove(local_path)
+    #extraction is repeated from the start
+    if local_dir != os.path.dirname(local_path) and os.path.exists(local_dir):
+        rmtree(local_dir)
+    if not os.path.exists(local_dir):
+        os.mkdir(local_dir)
+
+    download_complete = download_manifest.is_download_complete(dst_filename)
+    if not download_complete and stream_extract and not os.path.exists(local_path):
+        print "Streaming from ftp site: " + dst_filename
+        download_manifest.update(dst_filename, segmented=False)
+        bytes_received, md5, extracted_members = downloader.download_and_extract_stream(dst_filename,
+                                                                                        local_dir,
+                                                                                        member_callback,
+                                                                                        local_path)
+        if extracted_members is not None and bytes_received == expected_size:
+            download_manifest.update(dst_filename,
+                                     bytes_received=bytes_received,
+                                     md5=md5,
+                                     complete=True,
+                                     extracted=True,
+                                     members=extracted_members)
+            #remove the tarfile
+            os.remove(local_path)
+            return local_dir
+        if os.path.exists(local_path):
+            download_manifest.update(dst_filename, bytes_received=os.path.getsize(local_path))
+        print "Stream of %s interrupted. Falling back to file download ..." % dst_filename
+
+    if not download_complete:
+        #download from ftp site
+        entry = download_manifest.get_entry(dst_filename)
+        segmented = downloader.segments_per_file > 1
+        resume = not entry['segmented'] and not segmented
+        completed_segments = []
+        if entry['segmented'] and segmented:
+            completed_segments = entry.get('segments', [])
+        print "Downloading from ftp site: " + dst_filename
+        download_manifest.update(dst_filename, segmented=segmented, segments=completed_segments)
+        try:
+            unzip_file = downloader.download_file(dst_filename, local_path, resume, completed_segments,
+                                                  lambda segment_start, segment_end: \
+                                                  download_manifest.add_segment(dst_filename,
+                                                                                segment_start,
+                                                                                segment_end))
+        finally:
+            if os.path.exists(local_path) and not segmented:
+                download_manifest.update(dst_filename, bytes_received=os.path.getsize(local_path))
+        if not unzip_file:
+            return None
+        download_manifest.update(dst_filename,
+                                 bytes_received=os.path.getsize(local_path),
+                                 md5=get_file_md5(local_path),
+                                 complete=True)
+    else:
+        print dst_filename + ' already downloaded. Skipping download.'
+
+    #extract from tar.gz
+    print "Extracting: " + dst_filename
+    extracted_members = {}
+    with tarfile.open(local_path) as tar:
+        for member in tar:
+            member_size = extract_member_verified(tar, member, local_dir)
+            if member_size is not None:
+                extracted_members[member.name] = member_size
+                if member_callback is not None:
+                    member_callback(os.path.join(local_dir, member.name))
+    download_manifest.update(dst_filename,
+                             extracted=True,
+                             members=extracted_members)
+    #remove the tarfile
+    os.remove(local_path)
+    return local_dir
+
+def download_all_ftp(download_dir, file_match, host='ftp.ecmwf.int', login='',
+                     passwd='', directory='tcyc', port=21, num_connections=4,
+                     debug_level=0, segments_per_file=1, stream_extract=False,
+                     member_callback=print_extracted_member, file_filter=None,
+                     monitor_interval=30, retry_wait=30):
+    """
+    Remove downloads from before 2 days ago
+    Download all files from the ftp site matching date
+    with num_connections files at once, each split into
+    segments_per_file byte ranges
+    Extract downloaded files (while downloading with stream_extract)
+    If given, only files where file_filter(file_name, file_size) is True are downloaded
+    A transfer without progress for monitor_interval seconds is retried after retry_wait seconds
+    """
+    remove_old_ftp_downloads(download_dir)
+    download_manifest = DownloadManifest(os.path.join(download_dir, 'download_manifest.json'))
+    #init pool of FTP connections
+    downloader = ConcurrentFTPDownloader(host=host,
+                                         login=login,
+                                         passwd=passwd,
+                                         directory=directory,
+                                         port=port,
+                                         num_connections=num_connections,
+                                         debug_level=debug_level,
+                                         segments_per_file=segments_per_file,
+                                         monitor_interval=monitor_interval,
+                                         retry_wait=retry_wait)
+    file_list = downloader.list_files(file_match)
+    file_sizes = downloader.get_file_sizes(file_list)
+    if file_filter is not None:
+        file_list = [dst_filename for dst_filename in file_list \
+                     if file_filter(dst_filename, file_sizes[dst_filename])]
+    extracted_dirs = downloader.run(file_list,
+                                    lambda dst_filename: download_and_extract_ftp_file(downloader,
+                                                                                       download_manifest,
+                                                                                       dst_filename,
+                                                                                       file_sizes[dst_filename],
+                                                                                       stream_extract,
+                                                                                       member_callback))
+    #add successfully downloaded files to list
+    all_files_downloaded = [local_dir for local_dir in extracted_dirs if local_dir]
+
+    downloader.print_throughput_summary()
+    print "All downloads completed!"
+    return all_files_downloaded
+
+if __name__ == "__main__":
+    ecmwf_forecast_location = "C:/Users/byu_rapid/Documents/RAPID/ECMWF"
+    time_string = datetime.datetime.utcnow().strftime('%Y%m%d')
+    #time_string = datetime.datetime(2014,11,2).strftime('%Y%m%d')
+    all_ecmwf_files = download_all_ftp(ecmwf_forecast_location,'Runoff.'+time_string+'*.netcdf.tar.gz')
@@ -5,6 +5,13 @@ import numpy as np
 import os
 from json import dumps
 
+#local imports
+from netcdf3_memmap import (open_netcdf_variable,
+                            read_netcdf_variable)
+from stage_profiler import profiled_stage
+
+#profiles are not written to the prediction folder as all its files are read
+@profiled_stage('warning_points_era_interim')
 def generate_warning_points(ecmwf_prediction_folder, era_interim_file, out_directory):
     """
     Create warning points from era interim data and ECMWD prediction data
@@ -14,13 +21,12 @@ def generate_warning_points(ecmwf_prediction_folder, era_interim_file, out_direc
     #Get list of prediciton files
 
     prediction_files = [os.path.join(ecmwf_prediction_folder,f) for f in os.listdir(ecmwf_prediction_folder) \
-                              if not os.path.isdir(os.path.join(ecmwf_prediction_folder, f))]
+                              if f.startswith("Qout") and f.endswith(".nc") \
+                              and not os.path.isdir(os.path.join(ecmwf_prediction_folder, f))]
 
     #get the comids in ECMWF files
-    data_nc = NET.Dataset(prediction_files[0], mode="r")
-    prediction_comids = data_nc.variables['COMID'][:]
+    prediction_comids = read_netcdf_variable(prediction_files[0], 'COMID')
     comid_list_length = len(prediction_comids)
-    data_nc.close()
     #get the comids in ERA Interim file
     data_nc = NET.Dataset(era_interim_file, mode="r")
     era_interim_comids = data_nc.variables['COMID'][:]
@@ -35,17 +41,17 @@ def generate_warning_points(ecmwf_prediction_folder, era_interim_file, out_direc
         try:
             ensemble_index = int(os.path.basename(prediction_file)[:-3].split("_")[-1])
             #Get hydrograph data from ECMWF Ensemble
-            data_nc = NET.Dataset(prediction_file, mode="r")
-            qout_dimensions = data_nc.variables['Qout'].dimensions
+            qout_variable = open_netcdf_variable(prediction_file, 'Qout')
+            qout_dimensions = qout_variable.dimensions
             if qout_dimensions[0].lower() == 'time' and qout_dimensions[1].lower() == 'comid':
-                data_values_2d_array = data_nc.variables['Qout'][:].transpose()
+                data_values_2d_array = qout_variable[:].transpose()
             elif qout_dimensions[0].lower() == 'comid' and qout_dimensions[1].lower() == 'time':
-                data_values_2d_array = data_nc.variables['Qout'][:]
+                data_values_2d_array = qout_variable[:]
             else:
                 print "Invalid ECMWF forecast file", prediction_file
-                data_nc.close()
+                qout_variable.close()
                 continue
-            data_nc.close()
+            qout_variable.close()
 
         except Exception, e:
             print e
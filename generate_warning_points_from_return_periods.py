@@ -4,6 +4,13 @@ import numpy as np
 import os
 from json import dumps
 
+#local imports
+from netcdf3_memmap import (open_netcdf_variable,
+                            read_netcdf_variable)
+from stage_profiler import profiled_stage
+
+#profiles are not written to the prediction folder as all its files are read
+@profiled_stage('warning_points_return_periods')
 def generate_warning_points(ecmwf_prediction_folder, return_period_file, out_directory, threshold=1):
     """
     Create warning points from return periods and ECMWD prediction data
@@ -13,13 +20,12 @@ def generate_warning_points(ecmwf_prediction_folder, return_period_file, out_dir
     #Get list of prediciton files
 
     prediction_files = [os.path.join(ecmwf_prediction_folder,f) for f in os.listdir(ecmwf_prediction_folder) \
-                              if not os.path.isdir(os.path.join(ecmwf_prediction_folder, f))]
+                              if f.startswith("Qout") and f.endswith(".nc") \
+                              and not os.path.isdir(os.path.join(ecmwf_prediction_folder, f))]
 
     #get the comids in ECMWF files
-    data_nc = nc.Dataset(prediction_files[0], mode="r")
-    prediction_comids = data_nc.variables['COMID'][:]
+    prediction_comids = read_netcdf_variable(prediction_files[0], 'COMID')
     comid_list_length = len(prediction_comids)
-    data_nc.close()
 
     print "Extracting Forecast Data ..."
     #get information from datasets
@@ -30,15 +36,15 @@ def generate_warning_points(ecmwf_prediction_folder, return_period_file, out_dir
         try:
             ensemble_index = int(os.path.basename(prediction_file)[:-3].split("_")[-1])
             #Get hydrograph data from ECMWF Ensemble
-            data_nc = nc.Dataset(prediction_file, mode="r")
-            qout_dimensions = data_nc.variables['Qout'].dimensions
+            qout_variable = open_netcdf_variable(prediction_file, 'Qout')
+            qout_dimensions = qout_variable.dimensions
             if qout_dimensions[0].lower() == 'time' and qout_dimensions[1].lower() == 'comid':
-                data_values_2d_array = data_nc.variables['Qout'][:].transpose()
+                data_values_2d_array = qout_variable[:].transpose()
             elif qout_dimensions[0].lower() == 'comid' and qout_dimensions[1].lower() == 'time':
-                data_values_2d_array = data_nc.variables['Qout'][:]
+                data_values_2d_array = qout_variable[:]
             else:
                 print "Invalid ECMWF forecast file", prediction_file
-                data_nc.close()
+            qout_variable.close()
 
         except Exception, e:
             print e
@@ -58,7 +64,7 @@ def generate_warning_points(ecmwf_prediction_folder, return_period_file, out_dir
     return_period_2_data = return_period_nc.variables['return_period_2'][:]
     return_period_lat_data = return_period_nc.variables['lat'][:]
     return_period_lon_data = return_period_nc.variables['lon'][:]
-    data_nc.close()
+    return_period_nc.close()
 
     print "Analyzing Forecast Data with Return Periods ..."
     return_20_points = []
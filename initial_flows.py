@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Initial flows (BS_opt_Qinit) of the next RAPID run computed from the
+forecast of a watershed on the master.
+
+This module does not import condorpy so the initial flows can be
+computed and benchmarked without HTCondor.
+"""
+import csv
+import datetime
+from glob import glob
+import netCDF4 as NET
+import numpy as np
+import os
+
+#local imports
+from netcdf3_memmap import (open_netcdf_variable,
+                            read_netcdf_variable)
+from stage_profiler import profiled_stage
+
+def csv_to_list(csv_file, delimiter=','):
+    """
+    Reads in a CSV file and returns the contents as list,
+    where every row is stored as a sublist, and each element
+    in the sublist represents 1 cell in the table.
+
+    """
+    with open(csv_file, 'rb') as csv_con:
+        reader = csv.reader(csv_con, delimiter=delimiter)
+        return list(reader)
+
+def get_comids_in_netcdf_file(reach_id_list, prediction_file):
+    """
+    Gets the subset comid_index_list, reordered_comid_list from the netcdf file
+    """
+    com_ids = read_netcdf_variable(prediction_file, 'COMID')
+    try:
+        #get where comids are in netcdf file
+        netcdf_reach_indices_list = np.where(np.in1d(com_ids, reach_id_list))[0]
+    except Exception as ex:
+        print ex
+
+    return netcdf_reach_indices_list, com_ids[netcdf_reach_indices_list]
+
+def get_init_flow_file(input_directory, forecast_date_timestep):
+    """
+    Returns the init flow file (BS_opt_Qinit) written from a forecast
+    """
+    current_forecast_date = datetime.datetime.strptime(forecast_date_timestep[:11],"%Y%m%d.%H").strftime("%Y%m%dt%H")
+    return os.path.join(input_directory,'Qinit_%s.csv' % current_forecast_date)
+
+@profiled_stage('initial_flows')
+def compute_initial_rapid_flows(prediction_files, input_directory, forecast_date_timestep):
+    """
+    Gets mean of all 52 ensembles 12-hrs in future and prints to csv as initial flow
+    Qinit_file (BS_opt_Qinit)
+    The assumptions are that Qinit_file is ordered the same way as rapid_connect_file
+    if subset of list, add zero where there is no flow
+    """
+    #remove old init files for this basin
+    past_init_flow_files = glob(os.path.join(input_directory, 'Qinit_*.csv'))
+    for past_init_flow_file in past_init_flow_files:
+        try:
+            os.remove(past_init_flow_file)
+        except:
+            pass
+    init_file_location = get_init_flow_file(input_directory, forecast_date_timestep)
+    #check to see if exists and only perform operation once
+    if prediction_files:
+        #get list of COMIDS
+        connectivity_file = csv_to_list(os.path.join(input_directory,'rapid_connect.csv'))
+        comid_list = np.array([int(row[0]) for row in connectivity_file])
+
+
+        print "Finding COMID indices ..."
+        comid_index_list, reordered_comid_list = get_comids_in_netcdf_file(comid_list, prediction_files[0])
+        print "Extracting data ..."
+        reach_prediciton_array = np.zeros((len(comid_list),len(prediction_files),1))
+        #get information from datasets
+        for file_index, prediction_file in enumerate(prediction_files):
+            try:
+                #Get hydrograph data from ECMWF Ensemble
+                qout_variable = open_netcdf_variable(prediction_file, 'Qout')
+                qout_dimensions = qout_variable.dimensions
+                if qout_dimensions[0].lower() == 'time' and qout_dimensions[1].lower() == 'comid':
+                    data_values_2d_array = qout_variable[2,comid_index_list].transpose()
+                elif qout_dimensions[1].lower() == 'time' and qout_dimensions[0].lower() == 'comid':
+                    data_values_2d_array = qout_variable[comid_index_list,2]
+                else:
+                    print "Invalid ECMWF forecast file", prediction_file
+                    qout_variable.close()
+                    continue
+                qout_variable.close()
+                #organize the data
+                for comid_index, comid in enumerate(reordered_comid_list):
+                    reach_prediciton_array[comid_index][file_index] = data_values_2d_array[comid_index]
+            except Exception, e:
+                print e
+                #pass
+
+        print "Analyzing data ..."
+        output_data = []
+        for comid in comid_list:
+            try:
+                #get where comids are in netcdf file
+                comid_index = np.where(reordered_comid_list==comid)[0][0]
+            except Exception as ex:
+                #comid not found in list. Adding zero init flow ...
+                output_data.append([0])
+                pass
+                continue
+
+            #get mean of series as init flow
+            output_data.append([np.mean(reach_prediciton_array[comid_index])])
+
+        print "Writing output ..."
+        with open(init_file_location, 'wb') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerows(output_data)
+    else:
+        print "No current forecasts found. Skipping ..."
+
+def find_current_qfinal_files(forecast_directory, watershed, subbasin):
+    """
+    Finds the Qfinal state files written by the jobs in warm start mode
+    """
+    qfinal_directory = os.path.join(forecast_directory, 'qfinal')
+    if os.path.exists(qfinal_directory):
+        qfinal_files = glob(os.path.join(qfinal_directory, "Qfinal_%s_%s_*.csv" % (watershed, subbasin)))
+        if len(qfinal_files) >0:
+            return qfinal_files
+    #there are none found
+    return None
+
+def read_qfinal_file(qfinal_file):
+    """
+    Reads in the flow state vector written by RAPID (BS_opt_Qfinal).
+    Handles both the text and netCDF variants of the file.
+    """
+    with open(qfinal_file, 'rb') as qfinal_con:
+        magic = qfinal_con.read(4)
+    if magic[:3] == 'CDF' or magic == '\x89HDF':
+        data_nc = NET.Dataset(qfinal_file, mode="r")
+        qout_variable = data_nc.variables['Qout']
+        if len(qout_variable.dimensions) > 1:
+            qfinal = qout_variable[-1,:]
+        else:
+            qfinal = qout_variable[:]
+        data_nc.close()
+        return np.array(qfinal, dtype=np.float64)
+    return np.array([float(row[0]) for row in csv_to_list(qfinal_file) if row],
+                    dtype=np.float64)
+
+@profiled_stage('initial_flows_from_qfinal')
+def compute_initial_rapid_flows_from_qfinal(qfinal_files, input_directory, forecast_date_timestep):
+    """
+    Gets mean of the 12-hr Qfinal state of all ensembles and prints to csv
+    as initial flow Qinit_file (BS_opt_Qinit). The Qfinal files are ordered
+    the same way as rapid_connect_file, so no COMID lookup is needed.
+    """
+    if not qfinal_files:
+        print "No current Qfinal files found. Skipping ..."
+        return
+
+    #remove old init files for this basin
+    past_init_flow_files = glob(os.path.join(input_directory, 'Qinit_*.csv'))
+    for past_init_flow_file in past_init_flow_files:
+        try:
+            os.remove(past_init_flow_file)
+        except:
+            pass
+    init_file_location = get_init_flow_file(input_directory, forecast_date_timestep)
+
+    connectivity_file = csv_to_list(os.path.join(input_directory,'rapid_connect.csv'))
+    num_reaches = len(connectivity_file)
+
+    print "Averaging Qfinal states ..."
+    qfinal_sum = np.zeros(num_reaches)
+    num_qfinal = 0
+    for qfinal_file in qfinal_files:
+        try:
+            qfinal = read_qfinal_file(qfinal_file)
+        except Exception, ex:
+            print ex
+            continue
+        if len(qfinal) != num_reaches:
+            print "Invalid Qfinal file", qfinal_file, "Skipping ..."
+            continue
+        qfinal_sum += qfinal
+        num_qfinal += 1
+
+    if num_qfinal == 0:
+        print "No valid Qfinal files found. Skipping ..."
+        return
+
+    print "Writing output ..."
+    with open(init_file_location, 'wb') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerows([[flow] for flow in qfinal_sum/num_qfinal])
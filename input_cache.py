@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Content addressed cache of the RAPID watershed inputs and the scripts on
+the execute nodes.
+
+On the master, directories are hashed by content and archived once into
+a staging directory named by the hash. On the node, a job looks up the
+hash in the local cache and only fetches the archive from the master
+with condor_chirp on a cache miss. The least recently used entries are
+evicted when the cache is larger than its quota.
+
+The init flow files (Qinit_*.csv) change every forecast cycle and are
+left out of the hashes and archives so the watershed input stays cached
+across cycles. They are transferred with each job instead.
+
+This module only uses the standard library as it is transferred alone
+with the job and runs before the scripts are available on the node.
+"""
+import errno
+import fcntl
+from fnmatch import fnmatch
+import hashlib
+import json
+import os
+from shutil import rmtree
+from subprocess import Popen, PIPE
+import tarfile
+import tempfile
+
+#names left out of hashes and archives
+EXCLUDED_NAMES = ['.git']
+EXCLUDED_EXTENSIONS = ['.pyc', '.pyo']
+#init flow files written every forecast cycle
+EXCLUDED_PATTERNS = ['Qinit_*.csv']
+
+def is_excluded(name):
+    """
+    Checks if the file or directory is left out of hashes and archives
+    """
+    return name in EXCLUDED_NAMES or os.path.splitext(name)[1] in EXCLUDED_EXTENSIONS \
+        or any([fnmatch(name, pattern) for pattern in EXCLUDED_PATTERNS])
+
+def get_directory_files(directory):
+    """
+    Returns the sorted relative paths of the files in the directory
+    """
+    relative_paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not is_excluded(d)]
+        for file_name in files:
+            if not is_excluded(file_name):
+                relative_paths.append(os.path.relpath(os.path.join(root, file_name), directory))
+    return sorted(relative_paths)
+
+def get_file_hash(file_path):
+    """
+    Returns the sha1 hash of the file contents
+    """
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as file_con:
+        for chunk in iter(lambda: file_con.read(1024*1024), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+#------------------------------------------------------------------------------
+#master functions
+#------------------------------------------------------------------------------
+def get_directory_hash(directory, hash_index):
+    """
+    Returns the hash of the directory contents. The hash of each file is
+    reused from the hash index if its size and modification time match.
+    """
+    directory_hash = hashlib.sha1()
+    for relative_path in get_directory_files(directory):
+        file_path = os.path.join(directory, relative_path)
+        file_stat = os.stat(file_path)
+        index_key = os.path.abspath(file_path)
+        index_entry = hash_index.get(index_key)
+        if index_entry is None or index_entry['size'] != file_stat.st_size \
+                or index_entry['mtime'] != file_stat.st_mtime:
+            index_entry = {'size' : file_stat.st_size,
+                           'mtime' : file_stat.st_mtime,
+                           'hash' : get_file_hash(file_path),
+                           }
+            hash_index[index_key] = index_entry
+        directory_hash.update("%s:%s\n" % (relative_path, index_entry['hash']))
+    return directory_hash.hexdigest()
+
+def stage_directories(directories, staging_directory):
+    """
+    Archives each directory into the staging directory by content hash.
+
+    Returns a dictionary of directory to (hash, archive file).
+    """
+    try:
+        os.makedirs(staging_directory)
+    except OSError:
+        pass
+    hash_index_file = os.path.join(staging_directory, 'hash_index.json')
+    hash_index = {}
+    if os.path.exists(hash_index_file):
+        try:
+            with open(hash_index_file, 'rb') as index_con:
+                hash_index = json.load(index_con)
+        except ValueError:
+            pass
+
+    staged_directories = {}
+    for directory in directories:
+        directory_hash = get_directory_hash(directory, hash_index)
+        archive_file = os.path.join(staging_directory, "%s.tar.gz" % directory_hash)
+        if not os.path.exists(archive_file):
+            print "Staging", directory, "as", directory_hash
+            temp_archive_file = "%s.tmp" % archive_file
+            with tarfile.open(temp_archive_file, "w:gz") as tar:
+                for relative_path in get_directory_files(directory):
+                    tar.add(os.path.join(directory, relative_path), arcname=relative_path)
+            os.rename(temp_archive_file, archive_file)
+        staged_directories[directory] = (directory_hash, archive_file)
+
+    #only keep hashes of files that still exist
+    hash_index = dict([(file_path, index_entry) for file_path, index_entry in hash_index.iteritems() \
+                       if os.path.exists(file_path)])
+    with open(hash_index_file, 'wb') as index_con:
+        json.dump(hash_index, index_con)
+
+    #remove archives no longer in use
+    staged_archives = [archive_file for directory_hash, archive_file in staged_directories.values()]
+    for file_name in os.listdir(staging_directory):
+        file_path = os.path.join(staging_directory, file_name)
+        if file_name.endswith('.tar.gz') and file_path not in staged_archives:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    return staged_directories
+
+def summarize_input_cache_stats(stats_files):
+    """
+    Prints the bytes transferred and cache hit rate from the stats
+    files written by the jobs
+    """
+    hits = 0
+    misses = 0
+    bytes_transferred = 0
+    for stats_file in stats_files:
+        try:
+            with open(stats_file, 'rb') as stats_con:
+                stats = json.load(stats_con)
+        except (IOError, ValueError):
+            continue
+        hits += stats['hits']
+        misses += stats['misses']
+        bytes_transferred += stats['bytes_transferred']
+    if hits + misses > 0:
+        print "Input cache hit rate: %0.1f%% (%s hits, %s misses)" % (100.0*hits/(hits+misses), hits, misses)
+        print "Input cache bytes transferred: %s" % bytes_transferred
+    return hits, misses, bytes_transferred
+
+#------------------------------------------------------------------------------
+#node functions
+#------------------------------------------------------------------------------
+def fetch_remote_file(remote_file, local_file):
+    """
+    Fetches a file from the submit machine with condor_chirp
+    (requires +WantIOProxy = true in the job)
+    """
+    process = Popen(['condor_chirp', 'fetch', remote_file, local_file],
+                    stdout=PIPE, stderr=PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise Exception("condor_chirp fetch of %s failed: %s" % (remote_file, err))
+
+def get_directory_size(directory):
+    """
+    Returns the size in bytes of all files in the directory
+    """
+    total_size = 0
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            try:
+                total_size += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+    return total_size
+
+class NodeInputCache(object):
+    """
+    Cache of directories on an execute node keyed by content hash.
+
+    Entries in use by a job hold a shared lock and are not evicted.
+    """
+    def __init__(self, cache_directory, quota_bytes, fetch_function=fetch_remote_file):
+        self.cache_directory = cache_directory
+        self.quota_bytes = quota_bytes
+        self.fetch_function = fetch_function
+        self.lock_files = []
+        self.stats = {'hits' : 0, 'misses' : 0, 'bytes_transferred' : 0}
+        try:
+            os.makedirs(cache_directory)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    def get_entry_directory(self, content_hash):
+        """
+        Returns the directory of the cache entry
+        """
+        return os.path.join(self.cache_directory, content_hash)
+
+    def open_lock(self, content_hash):
+        """
+        Opens the lock file of the cache entry
+        """
+        return open(os.path.join(self.cache_directory, "%s.lock" % content_hash), 'a')
+
+    def get(self, content_hash, remote_archive_file):
+        """
+        Returns the directory of the cache entry, fetching and extracting
+        the archive from the master on a cache miss. The entry stays
+        locked against eviction until release is called.
+        """
+        entry_directory = self.get_entry_directory(content_hash)
+        lock_file = self.open_lock(content_hash)
+        #exclusive lock while checking so only one job fetches the entry
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(entry_directory):
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+                temp_directory = tempfile.mkdtemp(dir=self.cache_directory)
+                try:
+                    local_archive_file = os.path.join(temp_directory, 'archive.tar.gz')
+                    self.fetch_function(remote_archive_file, local_archive_file)
+                    self.stats['bytes_transferred'] += os.path.getsize(local_archive_file)
+                    extract_directory = os.path.join(temp_directory, 'extract')
+                    with tarfile.open(local_archive_file) as tar:
+                        tar.extractall(extract_directory)
+                    os.rename(extract_directory, entry_directory)
+                finally:
+                    rmtree(temp_directory, ignore_errors=True)
+            #mark as recently used
+            os.utime(entry_directory, None)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+        self.lock_files.append(lock_file)
+        self.evict()
+        return entry_directory
+
+    def release(self):
+        """
+        Releases the locks on the entries used by this job
+        """
+        for lock_file in self.lock_files:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        self.lock_files = []
+
+    def evict(self):
+        """
+        Removes the least recently used entries not in use
+        until the cache is within its quota
+        """
+        entries = []
+        for name in os.listdir(self.cache_directory):
+            entry_directory = os.path.join(self.cache_directory, name)
+            if os.path.isdir(entry_directory) and not name.startswith('tmp'):
+                entries.append((os.path.getmtime(entry_directory), name,
+                                get_directory_size(entry_directory)))
+        total_size = sum([entry[2] for entry in entries])
+        for mtime, name, size in sorted(entries):
+            if total_size <= self.quota_bytes:
+                break
+            lock_file = self.open_lock(name)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                #entry in use
+                lock_file.close()
+                continue
+            try:
+                print "Evicting", name, "from input cache"
+                rmtree(self.get_entry_directory(name), ignore_errors=True)
+                total_size -= size
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def write_stats(self, stats_file):
+        """
+        Writes the cache hits, misses and bytes transferred of the job
+        """
+        with open(stats_file, 'wb') as stats_con:
+            json.dump(self.stats, stats_con)
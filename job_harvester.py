@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Harvests HTCondor job results in the order the jobs finish instead of
+the order they were submitted.
+
+The status of all pending jobs is read with one condor_q call per poll
+(and one condor_history call for the jobs that left the queue) instead
+of one condor_q call per job. A job whose ad is in neither for
+MAX_MISSING_JOB_AD_POLLS polls in a row is given up as removed.
+"""
+import datetime
+from subprocess import Popen, PIPE
+import time
+
+#condor job status strings that mean the job will not run again
+FINISHED_JOB_STATUSES = ['Completed', 'Removed', 'Submission_err']
+
+#status strings of the HTCondor JobStatus codes
+JOB_STATUS_CODES = {
+    1 : 'Idle',
+    2 : 'Running',
+    3 : 'Removed',
+    4 : 'Completed',
+    5 : 'Held',
+    6 : 'Transferring_output',
+    7 : 'Suspended',
+}
+
+#job ClassAd attributes read for each job
+JOB_AD_ATTRIBUTES = ['ClusterId', 'JobStatus', 'JobCurrentStartDate', 'CompletionDate']
+
+#number of polls in a row without a job ad before a job is given up
+MAX_MISSING_JOB_AD_POLLS = 10
+
+def get_job_status(job):
+    """
+    Returns the status string of a condorpy job or None if it cannot be queried
+    """
+    try:
+        return job.status
+    except Exception, ex:
+        print "Unable to get status for job", job, ex
+        return None
+
+def get_job_cluster_id(job):
+    """
+    Returns the cluster id of a condorpy job or of a job given by its
+    cluster id, None if unknown
+    """
+    if isinstance(job, (int, long)):
+        return job
+    try:
+        return int(job.cluster_id)
+    except Exception:
+        return None
+
+def get_job_ad_datetime(value):
+    """
+    Returns the UTC datetime of a job ClassAd date (seconds since 1970),
+    None if undefined or not set
+    """
+    try:
+        seconds = int(value)
+    except ValueError:
+        return None
+    if seconds <= 0:
+        return None
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+def parse_job_ads(autoformat_output):
+    """
+    Returns the ClassAd attributes (JOB_AD_ATTRIBUTES) of each job by
+    cluster id from the output of condor_q/condor_history -autoformat
+    """
+    job_ads = {}
+    for line in autoformat_output.splitlines():
+        values = line.split()
+        if len(values) != len(JOB_AD_ATTRIBUTES):
+            continue
+        try:
+            cluster_id = int(values[0])
+            status_code = int(values[1])
+        except ValueError:
+            continue
+        job_ads[cluster_id] = {'status' : JOB_STATUS_CODES.get(status_code),
+                               'start_date' : get_job_ad_datetime(values[2]),
+                               'completion_date' : get_job_ad_datetime(values[3]),
+                               }
+    return job_ads
+
+def run_job_ad_query(command):
+    """
+    Runs a condor_q or condor_history command and returns the parsed job ads
+    """
+    process = Popen(command + ['-autoformat'] + JOB_AD_ATTRIBUTES, stdout=PIPE, stderr=PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise Exception("%s failed: %s" % (command[0], err))
+    return parse_job_ads(out)
+
+def query_job_ads(cluster_ids):
+    """
+    Returns the job ads of the clusters by cluster id. The queue is read
+    with one condor_q call and the clusters no longer in the queue with
+    one condor_history call. Clusters found in neither are left out.
+    """
+    if not cluster_ids:
+        return {}
+    job_ads = run_job_ad_query(['condor_q'] + [str(cluster_id) for cluster_id in cluster_ids])
+    missing_cluster_ids = [cluster_id for cluster_id in cluster_ids if cluster_id not in job_ads]
+    if missing_cluster_ids:
+        history_ads = run_job_ad_query(['condor_history', '-constraint',
+                                        'ClusterId >= %s && ClusterId <= %s' % (min(missing_cluster_ids),
+                                                                                max(missing_cluster_ids))])
+        for cluster_id in missing_cluster_ids:
+            if cluster_id in history_ads:
+                job_ads[cluster_id] = history_ads[cluster_id]
+    return job_ads
+
+def query_history_job_ads(cluster_ids):
+    """
+    Returns the job ads of the clusters from condor_history by cluster id
+    without the ClusterId range constraint of query_job_ads
+    """
+    if not cluster_ids:
+        return {}
+    return run_job_ad_query(['condor_history'] + [str(cluster_id) for cluster_id in cluster_ids])
+
+def harvest_jobs_in_completion_order(job_list, job_info_list, process_job_output,
+                                     poll_interval=30, max_missing_polls=MAX_MISSING_JOB_AD_POLLS):
+    """
+    Polls the status of all submitted jobs and calls
+    process_job_output(job_info) as soon as each job finishes.
+    A job is a condorpy job or the cluster id of a job submitted by an
+    earlier run. If condor_q cannot be run, the status of each condorpy
+    job is read from the job. A job without an ad in condor_q or
+    condor_history for max_missing_polls polls in a row is looked up once
+    more in condor_history without the range constraint and marked as
+    Removed if it is still not found.
+
+    Returns the timeline of the harvest as a list of dictionaries in
+    submission order with the keys: index, status, running, completed,
+    processing_start, processing_end (as seen by the harvester) and
+    start_date, completion_date (JobCurrentStartDate and CompletionDate
+    of the job ClassAd, None if condor_q could not be read).
+    """
+    timeline = [{'index' : index,
+                 'status' : None,
+                 'running' : None,
+                 'completed' : None,
+                 'processing_start' : None,
+                 'processing_end' : None,
+                 'start_date' : None,
+                 'completion_date' : None,
+                 } for index in range(len(job_list))]
+    cluster_ids = [get_job_cluster_id(job) for job in job_list]
+    missing_polls = [0] * len(job_list)
+    pending_indices = range(len(job_list))
+    while pending_indices:
+        try:
+            job_ads = query_job_ads([cluster_ids[index] for index in pending_indices \
+                                     if cluster_ids[index] is not None])
+        except Exception, ex:
+            print "Unable to query job status with condor_q", ex
+            job_ads = None
+        if job_ads is not None:
+            for index in pending_indices:
+                if cluster_ids[index] is None or cluster_ids[index] in job_ads:
+                    missing_polls[index] = 0
+                else:
+                    missing_polls[index] += 1
+            lost_cluster_ids = [cluster_ids[index] for index in pending_indices \
+                                if missing_polls[index] >= max_missing_polls]
+            if lost_cluster_ids:
+                try:
+                    job_ads.update(query_history_job_ads(lost_cluster_ids))
+                except Exception, ex:
+                    print "Unable to query job history with condor_history", ex
+        finished_indices = []
+        for index in pending_indices:
+            if job_ads is not None and cluster_ids[index] is not None:
+                job_ad = job_ads.get(cluster_ids[index], {})
+                status = job_ad.get('status')
+                if not job_ad and missing_polls[index] >= max_missing_polls:
+                    print "Job", index, "(cluster %s)" % cluster_ids[index], "not found in condor_q or", \
+                        "condor_history after", missing_polls[index], "polls. Marking as Removed ..."
+                    status = 'Removed'
+                for date_key in ('start_date', 'completion_date'):
+                    if job_ad.get(date_key) is not None:
+                        timeline[index][date_key] = job_ad[date_key]
+            elif isinstance(job_list[index], (int, long)):
+                status = None
+            else:
+                status = get_job_status(job_list[index])
+            timeline[index]['status'] = status
+            if status == 'Running' and timeline[index]['running'] is None:
+                timeline[index]['running'] = datetime.datetime.utcnow()
+            elif status in FINISHED_JOB_STATUSES:
+                timeline[index]['completed'] = datetime.datetime.utcnow()
+                finished_indices.append(index)
+
+        for index in finished_indices:
+            pending_indices.remove(index)
+            timeline[index]['processing_start'] = datetime.datetime.utcnow()
+            if timeline[index]['status'] == 'Completed':
+                try:
+                    process_job_output(job_info_list[index])
+                except Exception, ex:
+                    print ex
+                    pass
+            else:
+                print "Job", index, "finished with status", timeline[index]['status'], ". Skipping ..."
+            timeline[index]['processing_end'] = datetime.datetime.utcnow()
+
+        if pending_indices and not finished_indices:
+            time.sleep(poll_interval)
+
+    return timeline
+
+def get_harvest_idle_time_removed(timeline):
+    """
+    Compares the harvest timeline with the one sequential job.wait() calls
+    in submission order would have produced with the same completion and
+    processing times.
+
+    Returns (idle time removed summed over all jobs, makespan reduction)
+    as timedelta objects.
+    """
+    idle_time_removed = datetime.timedelta(0)
+    sequential_end = None
+    actual_end = None
+    for event in timeline:
+        if event['completed'] is None or event['processing_start'] is None:
+            continue
+        processing_time = event['processing_end'] - event['processing_start']
+        sequential_start = event['completed']
+        if sequential_end is not None and sequential_end > sequential_start:
+            sequential_start = sequential_end
+        sequential_end = sequential_start + processing_time
+        idle_time_removed += sequential_start - event['processing_start']
+        if actual_end is None or event['processing_end'] > actual_end:
+            actual_end = event['processing_end']
+
+    if sequential_end is None:
+        return idle_time_removed, datetime.timedelta(0)
+    return idle_time_removed, sequential_end - actual_end
+
+def print_harvest_timeline(timeline):
+    """
+    Prints the time each job waited to be harvested and the idle time
+    removed compared to harvesting in submission order
+    """
+    idle_time_removed, makespan_reduction = get_harvest_idle_time_removed(timeline)
+    print "Harvest order:", ", ".join([str(event['index']) for event in \
+                                       sorted([e for e in timeline if e['processing_start']],
+                                              key=lambda e: e['processing_start'])])
+    print "Idle time removed by completion order harvest:", idle_time_removed
+    print "Makespan reduction of harvest:", makespan_reduction
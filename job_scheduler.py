@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Orders ECMWF-RAPID jobs longest first across all forecasts and watersheds
+from a cost model refit with the timings of previous runs.
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+
+#number of runoff time steps read for downscaling
+RUNOFF_TIME_STEPS = {"LowRes": 61, "HighRes": 125}
+#number of 6-hr RAPID output time steps
+ROUTING_TIME_STEPS = {"LowRes": 60, "HighRes": 40}
+
+def count_file_lines(file_path):
+    """
+    Counts the lines in a file
+    """
+    num_lines = 0
+    with open(file_path, 'rb') as file_con:
+        for line in file_con:
+            num_lines += 1
+    return num_lines
+
+def get_ensemble_resolution(ensemble_number):
+    """
+    Ensemble 52 is the high resolution forecast
+    """
+    if int(ensemble_number) == 52:
+        return "HighRes"
+    return "LowRes"
+
+class JobCostModel(object):
+    """
+    Predicts the run time of a job in seconds.
+
+    Jobs for a watershed and resolution seen before are predicted from the
+    mean of their recent run times. Other jobs are predicted from a linear
+    fit of all recorded run times to the number of reaches routed and the
+    number of weight table rows downscaled.
+    """
+    def __init__(self, history_file, max_history_per_job=10, max_history_records=5000):
+        self.history_file = history_file
+        self.max_history_per_job = max_history_per_job
+        self.max_history_records = max_history_records
+        self.watershed_features = {}
+        self.history = []
+        if os.path.exists(history_file):
+            with open(history_file, 'rb') as history_con:
+                for line in history_con:
+                    try:
+                        self.history.append(json.loads(line))
+                    except ValueError:
+                        pass
+        self.history = self.history[-max_history_records:]
+        self.coefficients = self.fit_coefficients()
+
+    def get_watershed_features(self, input_directory):
+        """
+        Returns the number of reaches and weight table rows for the watershed
+        """
+        if input_directory not in self.watershed_features:
+            features = {'num_reaches' : 0, 'LowRes' : 0, 'HighRes' : 0}
+            for file_name in os.listdir(input_directory):
+                file_path = os.path.join(input_directory, file_name)
+                if file_name.lower() == 'rapid_connect.csv':
+                    features['num_reaches'] = count_file_lines(file_path)
+                elif file_name.lower() == 'weight_low_res.csv':
+                    features['LowRes'] = count_file_lines(file_path) - 1
+                elif file_name.lower() == 'weight_high_res.csv':
+                    features['HighRes'] = count_file_lines(file_path) - 1
+            self.watershed_features[input_directory] = features
+        return self.watershed_features[input_directory]
+
+    def get_job_features(self, job_info):
+        """
+        Returns the cost features of a job
+        """
+        resolution = get_ensemble_resolution(job_info['ensemble_number'])
+        features = self.get_watershed_features(job_info['master_watershed_input_directory'])
+        return {'watershed' : "%s-%s" % (job_info['watershed'], job_info['subbasin']),
+                'resolution' : resolution,
+                'routing_units' : features['num_reaches']*ROUTING_TIME_STEPS[resolution],
+                'downscale_units' : features[resolution]*RUNOFF_TIME_STEPS[resolution],
+                }
+
+    def fit_coefficients(self):
+        """
+        Fits seconds = a*routing_units + b*downscale_units + c to the history
+        """
+        if len(self.history) < 3:
+            #rough defaults until there are timings to fit
+            return np.array([1e-4, 1e-5, 60.0])
+        design_matrix = np.array([[record['routing_units'], record['downscale_units'], 1.0] \
+                                  for record in self.history], dtype=np.float64)
+        actual = np.array([record['actual'] for record in self.history], dtype=np.float64)
+        coefficients = np.linalg.lstsq(design_matrix, actual, rcond=-1)[0]
+        return coefficients
+
+    def predict(self, job_info):
+        """
+        Returns the predicted run time of the job in seconds
+        """
+        features = self.get_job_features(job_info)
+        job_history = [record['actual'] for record in self.history \
+                       if record['watershed'] == features['watershed'] \
+                       and record['resolution'] == features['resolution']]
+        if job_history:
+            return float(np.mean(job_history[-self.max_history_per_job:]))
+        return float(max(0.0, np.dot(self.coefficients, [features['routing_units'],
+                                                         features['downscale_units'],
+                                                         1.0])))
+
+    def record(self, job_info, actual_seconds):
+        """
+        Appends the actual run time of a job to the history
+        """
+        record = self.get_job_features(job_info)
+        record['predicted'] = job_info.get('predicted_cost')
+        record['actual'] = actual_seconds
+        record['date'] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        self.history.append(record)
+        with open(self.history_file, 'ab') as history_con:
+            history_con.write("%s\n" % json.dumps(record))
+        print "Job cost", record['watershed'], job_info['forecast_date_timestep'], \
+            job_info['ensemble_number'], "predicted: %0.1f s" % (record['predicted'] or 0), \
+            "actual: %0.1f s" % actual_seconds
+
+def order_jobs_longest_first(job_info_list, cost_model):
+    """
+    Sets the predicted cost of each job and returns the jobs ordered
+    longest first (LPT) to minimize the makespan of the run
+    """
+    for job_info in job_info_list:
+        try:
+            job_info['predicted_cost'] = cost_model.predict(job_info)
+        except Exception, ex:
+            print "Unable to predict cost of job", ex
+            job_info['predicted_cost'] = 0.0
+    return sorted(job_info_list, key=lambda job_info: job_info['predicted_cost'], reverse=True)
+
+def record_job_costs(job_info_list, harvest_timeline, cost_model):
+    """
+    Records the run time of each completed job from the start and
+    completion dates of its job ClassAd, so jobs that ran between two
+    polls of the harvester are recorded with their actual run time
+    """
+    for event in harvest_timeline:
+        if event['status'] == 'Completed' and event['start_date'] is not None \
+                and event['completion_date'] is not None \
+                and event['completion_date'] >= event['start_date']:
+            try:
+                cost_model.record(job_info_list[event['index']],
+                                  (event['completion_date'] - event['start_date']).total_seconds())
+            except Exception, ex:
+                print ex
+                pass
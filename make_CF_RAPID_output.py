@@ -69,6 +69,9 @@ import shutil
 from netCDF4 import Dataset
 import numpy as np
 
+#local imports
+from stage_profiler import profiled_stage
+
 
 def csv_to_list(csv_file, delimiter=','):
     """
@@ -368,6 +371,7 @@ def write_comid_lat_lon_z(cf_nc, lookup_filename, id_var_name):
     if z_max is not None:
         cf_nc.geospatial_vertical_max = z_max
 
+@profiled_stage('cf_conversion', 'start_folder')
 def convert_ecmwf_rapid_output_to_cf_compliant(start_date,
                                                start_folder=None,
                                                time_step=6*3600, #time step in seconds
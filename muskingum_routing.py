@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Muskingum routing with NumPy as an in-process alternative to the RAPID
+executable for small basins, where starting RAPID and the file round
+trips take longer than the routing, and as a RAPID stand-in for offline
+testing.
+
+The router reads the same inputs as RAPID and follows its conventions
+(IS_opt_routing = 1):
+    - rapid_connect.csv, k.csv, x.csv, the lateral inflow (Vlat_file, m3
+      over each ZS_TauR interval), Qinit_file and Qfinal_file are in the
+      order of rapid_connect.csv
+    - only the reaches in riv_bas_id.csv are routed and Qout_file is in
+      the order of riv_bas_id.csv
+    - for each routing time step ZS_dtR the flows solve
+          (I - C1*N)*Q(t+dtR) = C1*Qe + C2*(N*Q(t) + Qe) + C3*Q(t)
+      where N is the river network matrix and Qe the lateral inflow rate
+    - Qout is the average of the flows at the end of the routing time
+      steps of each ZS_TauR interval and Qfinal the flow at the end of
+      the run
+
+The linear system is solved exactly by computing the reaches in
+topological levels: each level only has reaches whose upstream reaches
+are in earlier levels and is computed as one vectorized operation.
+
+The partitions of a basin (see river_network.py) can be routed by stage
+with route_partitions, which hands off the flow leaving a partition after
+each routing time step to the reach below the cut like the flow of an
+upstream reach, so the flows are the same as routing the whole basin.
+"""
+import csv
+import os
+import sys
+
+import netCDF4 as NET
+import numpy as np
+
+#local imports
+from netcdf3_memmap import open_netcdf_variable
+from river_network import RiverNetwork
+
+def csv_to_list(csv_file, delimiter=','):
+    """
+    Reads in a CSV file and returns the contents as list,
+    where every row is stored as a sublist, and each element
+    in the sublist represents 1 cell in the table.
+
+    """
+    with open(csv_file, 'rb') as csv_con:
+        reader = csv.reader(csv_con, delimiter=delimiter)
+        return list(reader)
+
+def read_csv_column(csv_file, dtype=np.float64):
+    """
+    Reads the first column of a CSV file without header
+    """
+    return np.array([float(row[0]) for row in csv_to_list(csv_file) if row], dtype=dtype)
+
+def read_rapid_namelist(namelist_file):
+    """
+    Reads the values of a RAPID namelist file as a dictionary
+    """
+    namelist = {}
+    with open(namelist_file) as namelist_con:
+        for line in namelist_con:
+            line = line.strip()
+            if not line or line.startswith('!') or '=' not in line:
+                continue
+            name, value = [part.strip() for part in line.split('=', 1)]
+            value = value.strip("'\"")
+            if value.lower() in ('.true.', '.false.'):
+                value = value.lower() == '.true.'
+            namelist[name] = value
+    return namelist
+
+class MuskingumRouter(object):
+    """
+    Routes lateral inflow through the reaches of riv_bas_id_file with the
+    Muskingum method of RAPID. The flows can have extra trailing
+    dimensions (e.g. ensembles) that are routed at the same time.
+    """
+    def __init__(self, rapid_connect_file, riv_bas_id_file, k_file, x_file,
+                 routing_time_step=900):
+        connect_table = csv_to_list(rapid_connect_file)
+        self.connect_comids = np.array([int(float(row[0])) for row in connect_table], dtype=np.int64)
+        connect_downstream_comids = np.array([int(float(row[1])) for row in connect_table], dtype=np.int64)
+        self.basin_comids = read_csv_column(riv_bas_id_file, np.int64)
+        self.num_reaches = len(self.basin_comids)
+
+        #index of each basin reach in rapid_connect order
+        connect_index = dict([(comid, index) for index, comid in enumerate(self.connect_comids)])
+        try:
+            self.connect_indices = np.array([connect_index[comid] for comid in self.basin_comids], dtype=np.int64)
+        except KeyError as ex:
+            raise Exception("COMID %s in %s not found in %s" % (ex, riv_bas_id_file, rapid_connect_file))
+
+        self.network = RiverNetwork(self.basin_comids, connect_downstream_comids[self.connect_indices])
+        self.routing_time_step = float(routing_time_step)
+        self.set_parameters(read_csv_column(k_file)[self.connect_indices],
+                            read_csv_column(x_file)[self.connect_indices])
+        self.set_levels()
+
+    def set_parameters(self, k, x):
+        """
+        Sets the Muskingum coefficients of the basin reaches from k (s) and x
+        """
+        half_time_step = self.routing_time_step/2.0
+        denominator = k*(1.0 - x) + half_time_step
+        self.c1 = (half_time_step - k*x)/denominator
+        self.c2 = (half_time_step + k*x)/denominator
+        self.c3 = (k*(1.0 - x) - half_time_step)/denominator
+
+    def set_levels(self):
+        """
+        Sets the levels of the river network from upstream to downstream
+        as a list of (reach indices, indices of the reaches in the level
+        with a downstream reach, downstream reach indices)
+        """
+        self.downstream_indices = self.network.downstream_indices
+        self.reaches_with_downstream = self.network.reaches_with_downstream
+        self.levels = []
+        for level in self.network.levels:
+            level_with_downstream = level[self.downstream_indices[level] >= 0]
+            self.levels.append((level, level_with_downstream, self.downstream_indices[level_with_downstream]))
+
+    def get_partition_router(self, reach_indices):
+        """
+        Returns a router for the reaches of a partition of the basin
+        (see RiverNetwork.partition) with the same rapid_connect order
+        """
+        reach_indices = np.asarray(reach_indices, dtype=np.int64)
+        partition_router = object.__new__(MuskingumRouter)
+        partition_router.connect_comids = self.connect_comids
+        partition_router.basin_comids = self.basin_comids[reach_indices]
+        partition_router.num_reaches = len(reach_indices)
+        partition_router.connect_indices = self.connect_indices[reach_indices]
+        downstream_comids = np.where(self.downstream_indices >= 0,
+                                     self.basin_comids[self.downstream_indices], 0)[reach_indices]
+        partition_router.network = RiverNetwork(partition_router.basin_comids, downstream_comids)
+        partition_router.routing_time_step = self.routing_time_step
+        partition_router.c1 = self.c1[reach_indices]
+        partition_router.c2 = self.c2[reach_indices]
+        partition_router.c3 = self.c3[reach_indices]
+        partition_router.set_levels()
+        return partition_router
+
+    def get_coefficients(self, flow):
+        """
+        Returns the coefficients shaped to broadcast against the flow
+        """
+        shape = (self.num_reaches,) + (1,)*(flow.ndim - 1)
+        return self.c1.reshape(shape), self.c2.reshape(shape), self.c3.reshape(shape)
+
+    def get_upstream_flow(self, flow):
+        """
+        Returns the sum of the flow of the upstream reaches of each reach (N*Q)
+        """
+        upstream_flow = np.zeros_like(flow)
+        np.add.at(upstream_flow, self.downstream_indices[self.reaches_with_downstream],
+                  flow[self.reaches_with_downstream])
+        return upstream_flow
+
+    def route_step(self, flow, lateral_inflow_rate, boundary_flow=None, new_boundary_flow=None):
+        """
+        Returns the flow after one routing time step. The boundary flow
+        (m3/s) enters each reach from outside of the basin at the start
+        and the end of the time step like the flow of an upstream reach.
+        """
+        c1, c2, c3 = self.get_coefficients(flow)
+        upstream_flow = self.get_upstream_flow(flow)
+        if boundary_flow is not None:
+            upstream_flow += boundary_flow
+        right_hand_side = c1*lateral_inflow_rate + \
+                          c2*(upstream_flow + lateral_inflow_rate) + \
+                          c3*flow
+        #solve (I - C1*N)*Q = rhs from upstream to downstream
+        new_flow = np.empty_like(flow)
+        upstream_flow = np.zeros_like(flow)
+        if new_boundary_flow is not None:
+            upstream_flow += new_boundary_flow
+        for level, level_with_downstream, level_downstream in self.levels:
+            new_flow[level] = right_hand_side[level] + c1[level]*upstream_flow[level]
+            np.add.at(upstream_flow, level_downstream, new_flow[level_with_downstream])
+        return new_flow
+
+    def route_steps(self, lateral_inflow_volume, interval=6*3600, initial_flow=None, boundary_flow=None):
+        """
+        Routes the lateral inflow volume (m3 per interval in basin order with
+        time as the first dimension) and yields the interval index and the
+        flow after each routing time step. The boundary flow (m3/s) has the
+        flow entering each reach from outside of the basin at the start of
+        the run and after each routing time step as the first dimension.
+        """
+        lateral_inflow_volume = np.asarray(lateral_inflow_volume, dtype=np.float64)
+        num_steps_per_interval = int(round(interval/self.routing_time_step))
+        if num_steps_per_interval < 1 or abs(num_steps_per_interval*self.routing_time_step - interval) > 1e-6:
+            raise Exception("Interval %s s is not a multiple of the routing time step %s s" % \
+                            (interval, self.routing_time_step))
+        flow = np.zeros(lateral_inflow_volume.shape[1:], dtype=np.float64)
+        if initial_flow is not None:
+            flow[:] = initial_flow
+        step_index = 0
+        for interval_index in range(lateral_inflow_volume.shape[0]):
+            lateral_inflow_rate = lateral_inflow_volume[interval_index]/float(interval)
+            for step in range(num_steps_per_interval):
+                if boundary_flow is None:
+                    flow = self.route_step(flow, lateral_inflow_rate)
+                else:
+                    flow = self.route_step(flow, lateral_inflow_rate,
+                                           boundary_flow[step_index], boundary_flow[step_index+1])
+                step_index += 1
+                yield interval_index, flow
+
+    def route(self, lateral_inflow_volume, interval=6*3600, initial_flow=None, boundary_flow=None):
+        """
+        Routes the lateral inflow volume (see route_steps) and returns the
+        average flow of each interval (m3/s) and the flow at the end of the run
+        """
+        lateral_inflow_volume = np.asarray(lateral_inflow_volume, dtype=np.float64)
+        num_steps_per_interval = int(round(interval/self.routing_time_step))
+        flow = np.zeros(lateral_inflow_volume.shape[1:], dtype=np.float64)
+        if initial_flow is not None:
+            flow[:] = initial_flow
+        average_flow = np.zeros(lateral_inflow_volume.shape, dtype=np.float64)
+        for interval_index, flow in self.route_steps(lateral_inflow_volume, interval,
+                                                     initial_flow, boundary_flow):
+            average_flow[interval_index] += flow
+        average_flow /= num_steps_per_interval
+        return average_flow, flow
+
+    def route_partitions(self, partitions, lateral_inflow_volume, interval=6*3600, initial_flow=None):
+        """
+        Routes the partitions of the basin (from self.network.partition) by
+        stage, handing off the flow at the cuts after each routing time step
+        to the partition downstream, and returns the average flow of each
+        interval and the flow at the end of the run of the basin (the same
+        as routing the whole basin)
+        """
+        lateral_inflow_volume = np.asarray(lateral_inflow_volume, dtype=np.float64)
+        num_steps_per_interval = int(round(interval/self.routing_time_step))
+        num_steps = lateral_inflow_volume.shape[0]*num_steps_per_interval
+        average_flow = np.empty(lateral_inflow_volume.shape, dtype=np.float64)
+        final_flow = np.empty(lateral_inflow_volume.shape[1:], dtype=np.float64)
+        #flow of the reaches above the cuts at the start and after each routing time step
+        handoff_flows = {}
+        for partition in sorted(partitions, key=lambda partition: partition['stage']):
+            reach_indices = partition['reach_indices']
+            partition_router = self.get_partition_router(reach_indices)
+            partition_index = dict([(comid, index) for index, comid in enumerate(partition_router.basin_comids)])
+            boundary_flow = None
+            if partition['boundary_inflows']:
+                boundary_flow = np.zeros((num_steps + 1, len(reach_indices)) + lateral_inflow_volume.shape[2:],
+                                         dtype=np.float64)
+                for upstream_comid, comid in partition['boundary_inflows']:
+                    boundary_flow[:, partition_index[comid]] += handoff_flows.pop(upstream_comid)
+            partition_initial_flow = np.zeros((len(reach_indices),) + lateral_inflow_volume.shape[2:],
+                                              dtype=np.float64)
+            if initial_flow is not None:
+                partition_initial_flow[:] = np.asarray(initial_flow)[reach_indices]
+            handoff_indices = [partition_index[comid] for comid, downstream_comid, downstream_partition \
+                               in partition['outlet_handoffs']]
+            step_flows = [partition_initial_flow[handoff_indices]]
+
+            partition_average_flow = np.zeros((lateral_inflow_volume.shape[0], len(reach_indices)) + \
+                                              lateral_inflow_volume.shape[2:], dtype=np.float64)
+            flow = partition_initial_flow
+            for interval_index, flow in partition_router.route_steps(lateral_inflow_volume[:, reach_indices],
+                                                                     interval, partition_initial_flow,
+                                                                     boundary_flow):
+                partition_average_flow[interval_index] += flow
+                step_flows.append(flow[handoff_indices])
+            average_flow[:, reach_indices] = partition_average_flow/num_steps_per_interval
+            final_flow[reach_indices] = flow
+
+            step_flows = np.array(step_flows)
+            for handoff_number, handoff in enumerate(partition['outlet_handoffs']):
+                handoff_flows[handoff[0]] = step_flows[:, handoff_number]
+        return average_flow, final_flow
+
+    def read_lateral_inflow(self, vlat_file, num_intervals=None):
+        """
+        Reads the lateral inflow volume (Time, reach) in basin order
+        from a file in rapid_connect order
+        """
+        try:
+            lateral_inflow_variable = open_netcdf_variable(vlat_file, 'm3_riv')
+        except Exception:
+            lateral_inflow_variable = open_netcdf_variable(vlat_file, 'Qout')
+        try:
+            lateral_inflow_volume = lateral_inflow_variable[:num_intervals].astype(np.float64)
+        finally:
+            lateral_inflow_variable.close()
+        lateral_inflow_volume[np.isnan(lateral_inflow_volume)] = 0
+        if lateral_inflow_volume.shape[1] != len(self.connect_comids):
+            raise Exception("%s has %s reaches instead of the %s in rapid_connect" % \
+                            (vlat_file, lateral_inflow_volume.shape[1], len(self.connect_comids)))
+        return lateral_inflow_volume[:, self.connect_indices]
+
+    def to_basin_order(self, connect_values):
+        """
+        Returns values in rapid_connect order in basin order
+        """
+        return np.asarray(connect_values)[self.connect_indices]
+
+    def to_connect_order(self, basin_values):
+        """
+        Returns values in basin order in rapid_connect order
+        (zero for reaches outside of the basin)
+        """
+        connect_values = np.zeros((len(self.connect_comids),) + basin_values.shape[1:], dtype=basin_values.dtype)
+        connect_values[self.connect_indices] = basin_values
+        return connect_values
+
+    def write_qout(self, qout_file, average_flow):
+        """
+        Writes the average flows as a RAPID Qout file (Time, COMID)
+        """
+        data_nc = NET.Dataset(qout_file, "w", format="NETCDF3_CLASSIC")
+        try:
+            data_nc.createDimension('Time', None)
+            data_nc.createDimension('COMID', self.num_reaches)
+            comid_var = data_nc.createVariable('COMID', 'i4', ('COMID',))
+            comid_var[:] = self.basin_comids
+            qout_var = data_nc.createVariable('Qout', 'f4', ('Time', 'COMID'))
+            qout_var[:] = average_flow
+        finally:
+            data_nc.close()
+
+    def write_qfinal(self, qfinal_file, flow):
+        """
+        Writes the final flows in rapid_connect order as RAPID does
+        """
+        with open(qfinal_file, 'wb') as qfinal_con:
+            writer = csv.writer(qfinal_con)
+            writer.writerows([[value] for value in self.to_connect_order(flow)])
+
+def run_muskingum_routing(rapid_namelist_file):
+    """
+    Routes with the inputs and outputs of a RAPID namelist file
+    in place of running RAPID
+    """
+    namelist = read_rapid_namelist(rapid_namelist_file)
+    router = MuskingumRouter(namelist['rapid_connect_file'], namelist['riv_bas_id_file'],
+                             namelist['k_file'], namelist['x_file'],
+                             routing_time_step=float(namelist['ZS_dtR']))
+    interval = float(namelist['ZS_TauR'])
+    num_intervals = int(round(float(namelist['ZS_TauM'])/interval))
+    lateral_inflow_volume = router.read_lateral_inflow(namelist['Vlat_file'], num_intervals)
+    if lateral_inflow_volume.shape[0] < num_intervals:
+        print "Warning:", namelist['Vlat_file'], "only has", lateral_inflow_volume.shape[0], "intervals"
+
+    initial_flow = None
+    if namelist.get('BS_opt_Qinit') and namelist.get('Qinit_file'):
+        initial_flow = router.to_basin_order(read_csv_column(namelist['Qinit_file']))
+
+    average_flow, final_flow = router.route(lateral_inflow_volume, interval, initial_flow)
+    router.write_qout(namelist['Qout_file'], average_flow)
+    if namelist.get('BS_opt_Qfinal') and namelist.get('Qfinal_file'):
+        router.write_qfinal(namelist['Qfinal_file'], final_flow)
+
+if __name__ == "__main__":
+    run_muskingum_routing(sys.argv[1] if len(sys.argv) > 1 else
+                          os.path.join(os.getcwd(), 'rapid_namelist'))
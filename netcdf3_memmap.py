@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Reads variables of NetCDF classic files (CDF-1 and CDF-2, e.g.
+NETCDF3_CLASSIC Qout and m3_riv files) as numpy memory maps.
+
+The data of a fixed size variable of a classic file is stored
+contiguously in big-endian order at an offset given in the header, so
+slices of single reaches or time steps are read straight from the file
+without the copy and masking of netCDF4-python. Record variables
+(unlimited dimension), variables with scale_factor or add_offset and
+other formats (NetCDF4/HDF5, CDF-5) are read with netCDF4-python.
+Floating point values equal to _FillValue (or the default NetCDF fill
+value without it) or missing_value are NaN as in netCDF4-python reads
+with the masked values filled.
+
+Usage:
+    python netcdf3_memmap.py netcdf_file
+"""
+import os
+import struct
+import sys
+
+import numpy as np
+
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+#big-endian data type and size of each classic NetCDF type
+NC_TYPES = {
+    1 : np.dtype('>i1'),
+    2 : np.dtype('S1'),
+    3 : np.dtype('>i2'),
+    4 : np.dtype('>i4'),
+    5 : np.dtype('>f4'),
+    6 : np.dtype('>f8'),
+}
+
+#default fill value of floating point variables without _FillValue
+NC_FILL_DOUBLE = 9.9692099683868690e+36
+
+#headers by file with the modification time and size they were read at
+_header_cache = {}
+
+class NetCDF3FormatError(Exception):
+    """
+    The file is not a NetCDF classic (CDF-1 or CDF-2) file
+    """
+    pass
+
+class HeaderReader(object):
+    """
+    Reads the big-endian values of a classic NetCDF header
+    """
+    def __init__(self, netcdf_con, offset_size):
+        self.netcdf_con = netcdf_con
+        self.offset_size = offset_size
+
+    def read(self, num_bytes):
+        data = self.netcdf_con.read(num_bytes)
+        if len(data) != num_bytes:
+            raise NetCDF3FormatError("Unexpected end of NetCDF header")
+        return data
+
+    def read_int(self):
+        return struct.unpack('>i', self.read(4))[0]
+
+    def read_offset(self):
+        return struct.unpack('>q' if self.offset_size == 8 else '>i', self.read(self.offset_size))[0]
+
+    def read_padded(self, num_bytes):
+        data = self.read(num_bytes)
+        self.read((4 - num_bytes % 4) % 4)
+        return data
+
+    def read_name(self):
+        return self.read_padded(self.read_int())
+
+    def read_list_header(self, list_tag):
+        tag = self.read_int()
+        num_elements = self.read_int()
+        if tag not in (0, list_tag):
+            raise NetCDF3FormatError("Invalid NetCDF header list tag %s" % tag)
+        return num_elements
+
+    def read_attributes(self):
+        attributes = {}
+        for attribute_index in range(self.read_list_header(NC_ATTRIBUTE)):
+            name = self.read_name()
+            nc_type = self.read_int()
+            if nc_type not in NC_TYPES:
+                raise NetCDF3FormatError("Invalid NetCDF type %s" % nc_type)
+            num_values = self.read_int()
+            values = np.frombuffer(self.read_padded(num_values*NC_TYPES[nc_type].itemsize), NC_TYPES[nc_type])
+            attributes[name] = values.tostring() if nc_type == 2 else values
+        return attributes
+
+def read_netcdf3_header(netcdf_file):
+    """
+    Reads the header of a NetCDF classic file as a dictionary with the
+    keys version, numrecs, dimensions (list of (name, length), length
+    None for the record dimension), attributes and variables (name:
+    dimensions, shape, dtype, begin, is_record, attributes).
+    The header of each file is read once while it is unchanged.
+    """
+    file_stat = os.stat(netcdf_file)
+    cache_key = os.path.abspath(netcdf_file)
+    cached_header = _header_cache.get(cache_key)
+    if cached_header is not None and cached_header[0] == (file_stat.st_mtime, file_stat.st_size):
+        return cached_header[1]
+
+    with open(netcdf_file, 'rb') as netcdf_con:
+        magic = netcdf_con.read(4)
+        if len(magic) != 4 or magic[:3] != 'CDF' or magic[3] not in ('\x01', '\x02'):
+            raise NetCDF3FormatError("%s is not a NetCDF classic file" % netcdf_file)
+        version = ord(magic[3])
+        reader = HeaderReader(netcdf_con, 8 if version == 2 else 4)
+        numrecs = reader.read_int()
+
+        dimensions = []
+        for dimension_index in range(reader.read_list_header(NC_DIMENSION)):
+            name = reader.read_name()
+            length = reader.read_int()
+            dimensions.append((name, length if length > 0 else None))
+        attributes = reader.read_attributes()
+
+        variables = {}
+        for variable_index in range(reader.read_list_header(NC_VARIABLE)):
+            name = reader.read_name()
+            dimension_ids = [reader.read_int() for dimension_id_index in range(reader.read_int())]
+            variable_attributes = reader.read_attributes()
+            nc_type = reader.read_int()
+            if nc_type not in NC_TYPES:
+                raise NetCDF3FormatError("Invalid NetCDF type %s" % nc_type)
+            reader.read_int()
+            begin = reader.read_offset()
+            is_record = bool(dimension_ids) and dimensions[dimension_ids[0]][1] is None
+            variables[name] = {'dimensions' : tuple([dimensions[dimension_id][0] for dimension_id in dimension_ids]),
+                               'shape' : tuple([numrecs if dimensions[dimension_id][1] is None \
+                                                else dimensions[dimension_id][1] for dimension_id in dimension_ids]),
+                               'dtype' : NC_TYPES[nc_type],
+                               'begin' : begin,
+                               'is_record' : is_record,
+                               'attributes' : variable_attributes,
+                               }
+
+    header = {'version' : version,
+              'numrecs' : numrecs,
+              'dimensions' : dimensions,
+              'attributes' : attributes,
+              'variables' : variables,
+              }
+    _header_cache[cache_key] = ((file_stat.st_mtime, file_stat.st_size), header)
+    return header
+
+class NetCDFVariable(object):
+    """
+    Read only variable of a NetCDF file. Fixed size variables of classic
+    files are memory mapped, others are read with netCDF4-python. Slices
+    are returned as native byte order arrays (masked values filled with
+    NaN for floating point variables).
+    """
+    def __init__(self, netcdf_file, variable_name):
+        self.netcdf_file = netcdf_file
+        self.variable_name = variable_name
+        self.memmap = None
+        self.dataset = None
+        try:
+            variable = read_netcdf3_header(netcdf_file)['variables'][variable_name]
+        except NetCDF3FormatError:
+            variable = None
+        except KeyError:
+            raise Exception("Variable %s not found in %s" % (variable_name, netcdf_file))
+
+        if variable is not None and not variable['is_record'] and variable['shape'] and all(variable['shape']) and \
+                'scale_factor' not in variable['attributes'] and 'add_offset' not in variable['attributes']:
+            self.dimensions = variable['dimensions']
+            self.memmap = np.memmap(netcdf_file, dtype=variable['dtype'], mode='r',
+                                    offset=variable['begin'], shape=variable['shape'])
+            self.dtype = variable['dtype'].newbyteorder('=')
+            self.shape = variable['shape']
+            self.missing_values = []
+            if self.dtype.kind == 'f':
+                missing_values = list(variable['attributes'].get('_FillValue', [NC_FILL_DOUBLE])) + \
+                                 list(variable['attributes'].get('missing_value', []))
+                self.missing_values = [missing_value for missing_value in np.array(missing_values, dtype=self.dtype) \
+                                       if not np.isnan(missing_value)]
+        else:
+            #imported here so memory mapped files can be read without netCDF4
+            import netCDF4 as NET
+            self.dataset = NET.Dataset(netcdf_file)
+            try:
+                self.variable = self.dataset.variables[variable_name]
+            except KeyError:
+                self.close()
+                raise Exception("Variable %s not found in %s" % (variable_name, netcdf_file))
+            self.dimensions = self.variable.dimensions
+            self.dtype = self.variable.dtype
+            self.shape = self.variable.shape
+
+    def is_memory_mapped(self):
+        """
+        Checks if the variable is read from a memory map
+        """
+        return self.memmap is not None
+
+    def __getitem__(self, index):
+        if self.memmap is not None:
+            values = np.array(self.memmap[index], dtype=self.dtype)
+            for missing_value in self.missing_values:
+                values[values == missing_value] = np.nan
+            return values
+        values = self.variable[index]
+        if np.ma.isMaskedArray(values):
+            values = np.ma.filled(values, np.nan if values.dtype.kind == 'f' else values.fill_value)
+        return np.asarray(values)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        """
+        Closes the memory map or dataset
+        """
+        #the file is unmapped when the memory map is released
+        self.memmap = None
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+
+def open_netcdf_variable(netcdf_file, variable_name):
+    """
+    Opens a variable of a NetCDF file for reading
+    """
+    return NetCDFVariable(netcdf_file, variable_name)
+
+def read_netcdf_variable(netcdf_file, variable_name, index=Ellipsis):
+    """
+    Reads the slice of a variable of a NetCDF file
+    """
+    netcdf_variable = open_netcdf_variable(netcdf_file, variable_name)
+    try:
+        return netcdf_variable[index]
+    finally:
+        netcdf_variable.close()
+
+if __name__ == "__main__":
+    netcdf_header = read_netcdf3_header(sys.argv[1])
+    print "CDF-%s, %s records" % (netcdf_header['version'], netcdf_header['numrecs'])
+    for dimension_name, dimension_length in netcdf_header['dimensions']:
+        print "dimension", dimension_name, dimension_length if dimension_length is not None else "(record)"
+    for netcdf_variable_name, netcdf_variable in sorted(netcdf_header['variables'].iteritems()):
+        print "variable", netcdf_variable_name, netcdf_variable['dimensions'], netcdf_variable['shape'], \
+            netcdf_variable['dtype'], "offset", netcdf_variable['begin'], \
+            "(record)" if netcdf_variable['is_record'] else ""
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Packages RAPID output files for upload in a pool of processes.
+"""
+import multiprocessing
+import os
+import tarfile
+import threading
+
+#archive extension and tarfile mode for each compression codec
+COMPRESSION_CODECS = {
+    'gz' : ('tar.gz', 'w:gz'),
+    'bz2' : ('tar.bz2', 'w:bz2'),
+    'none' : ('tar', 'w'),
+}
+
+#signature at the start of HDF5 based (NetCDF4) files
+HDF5_SIGNATURE = '\x89HDF\r\n\x1a\n'
+
+def is_compressed_netcdf(netcdf_file):
+    """
+    Checks if the file is NetCDF4 (HDF5) and is therefore likely compressed
+    already. NETCDF3 files have no internal compression.
+    """
+    with open(netcdf_file, 'rb') as netcdf_con:
+        return netcdf_con.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE
+
+def get_archive_file(archive_base, codec):
+    """
+    Returns the archive file name for the codec
+    """
+    return "%s.%s" % (archive_base, COMPRESSION_CODECS[codec][0])
+
+def package_file(output_file, archive_base, codec='gz', compression_level=6):
+    """
+    Writes the output file into a tar archive with the codec and level.
+    NetCDF4 files are written with the lowest compression level of the
+    codec (0 for gz, 1 for bz2) so the archive keeps the name and format
+    of the codec.
+
+    Returns the archive file or None if it failed.
+    """
+    try:
+        if codec != 'none' and is_compressed_netcdf(output_file):
+            compression_level = 0 if codec == 'gz' else 1
+        archive_file = get_archive_file(archive_base, codec)
+        extension, mode = COMPRESSION_CODECS[codec]
+        if codec == 'none':
+            tar = tarfile.open(archive_file, mode)
+        else:
+            tar = tarfile.open(archive_file, mode, compresslevel=compression_level)
+        try:
+            tar.add(output_file, arcname=os.path.basename(output_file))
+        finally:
+            tar.close()
+        return archive_file
+    except Exception, ex:
+        print "Error packaging", output_file, ex
+        try:
+            os.remove(get_archive_file(archive_base, codec))
+        except OSError:
+            pass
+        return None
+
+class OutputPackager(object):
+    """
+    Compresses output files in a process pool and hands each archive
+    to a callback as soon as it is written.
+
+    Create before starting any threads as the pool forks on creation.
+    """
+    def __init__(self, num_processes=None, codec='gz', compression_level=6):
+        if codec not in COMPRESSION_CODECS:
+            raise Exception("Invalid compression codec %s. Valid codecs: %s" % \
+                            (codec, ", ".join(sorted(COMPRESSION_CODECS.keys()))))
+        self.codec = codec
+        self.compression_level = compression_level
+        self.pool = multiprocessing.Pool(num_processes)
+        self.num_pending = 0
+        self.pending_condition = threading.Condition()
+
+    def package_output(self, output_file, archive_base, callback):
+        """
+        Packages the file asynchronously and calls callback(archive_file)
+        when done. The archive file is None if packaging failed.
+        """
+        with self.pending_condition:
+            self.num_pending += 1
+
+        def package_callback(archive_file):
+            try:
+                callback(archive_file)
+            finally:
+                with self.pending_condition:
+                    self.num_pending -= 1
+                    self.pending_condition.notify_all()
+
+        self.pool.apply_async(package_file,
+                              (output_file, archive_base, self.codec, self.compression_level),
+                              callback=package_callback)
+
+    def wait_for_packages(self):
+        """
+        Blocks until all packaging is done
+        """
+        with self.pending_condition:
+            while self.num_pending > 0:
+                self.pending_condition.wait(1)
+
+    def close(self):
+        """
+        Stops the process pool
+        """
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Post processing node of the ECMWF-RAPID DAG. Uploads the RAPID output of
+all ensembles of a watershed forecast, creates the init flow file,
+generates the warning points and optionally writes the ensemble cube.
+
+Usage:
+    postprocess_watershed.py rapid_input_directory forecast_date_timestep
+        rapid_io_files_location era_interim_data_location initialize_flows
+        create_warning_points warm_start_from_qfinal manifest_file
+        num_ensembles num_upload_workers num_package_processes package_codec
+        package_compression_level create_ensemble_cube [data_store_credentials_file]
+
+    num_package_processes is None to use one process per CPU. The data store
+    credentials file is written by write_data_store_credentials.
+"""
+import sys
+
+#local imports
+from rapid_process_async_ubuntu import (read_data_store_credentials,
+                                        upload_and_post_process_watershed)
+from run_manifest import RunManifest
+
+def str_to_bool(value):
+    """
+    Converts the string of a boolean argument
+    """
+    return value.lower() == "true"
+
+def str_to_optional_int(value):
+    """
+    Converts the string of an integer argument that may be None
+    """
+    if value == "None":
+        return None
+    return int(value)
+
+if __name__ == "__main__":
+    data_store_url = None
+    data_store_api_key = None
+    if len(sys.argv) > 15:
+        data_store_url, data_store_api_key = read_data_store_credentials(sys.argv[15])
+    upload_and_post_process_watershed(rapid_input_directory=sys.argv[1],
+                                      forecast_date_timestep=sys.argv[2],
+                                      rapid_io_files_location=sys.argv[3],
+                                      era_interim_data_location=sys.argv[4],
+                                      initialize_flows=str_to_bool(sys.argv[5]),
+                                      create_warning_points=str_to_bool(sys.argv[6]),
+                                      warm_start_from_qfinal=str_to_bool(sys.argv[7]),
+                                      run_manifest=RunManifest(sys.argv[8]),
+                                      num_ensembles=int(sys.argv[9]),
+                                      data_store_url=data_store_url,
+                                      data_store_api_key=data_store_api_key,
+                                      num_upload_workers=int(sys.argv[10]),
+                                      num_package_processes=str_to_optional_int(sys.argv[11]),
+                                      package_codec=sys.argv[12],
+                                      package_compression_level=int(sys.argv[13]),
+                                      create_ensemble_cube=str_to_bool(sys.argv[14]))
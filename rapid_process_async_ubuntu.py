@@ -1,20 +1,50 @@
 #!/usr/bin/env python
 from condorpy import Job as CJob
 from condorpy import Templates as tmplt
-import csv
 import datetime
 from glob import glob
 import itertools
-import netCDF4 as NET
-import numpy as np
+import json
 import os
 import re
 from shutil import rmtree
-import tarfile
 
 #local imports
 import ftp_ecmwf_download
+from condor_dag import (create_ecmwf_rapid_dag,
+                        submit_dag)
+from crop_ecmwf_runoff import (crop_ecmwf_folders,
+                               get_regional_forecast_file)
+from ecmwf_watch import ECMWFForecastWatcher
+from ensemble_cube import consolidate_forecast_ensembles
+from ensemble_statistics import (get_statistics_file,
+                                 write_ensemble_statistics)
+from forecast_archive import archive_forecast_statistics
 from generate_warning_points_from_return_periods import generate_warning_points
+from initial_flows import (compute_initial_rapid_flows,
+                           compute_initial_rapid_flows_from_qfinal,
+                           find_current_qfinal_files,
+                           get_init_flow_file)
+from input_cache import (stage_directories,
+                         summarize_input_cache_stats)
+from job_harvester import (FINISHED_JOB_STATUSES,
+                           get_job_cluster_id,
+                           harvest_jobs_in_completion_order,
+                           print_harvest_timeline,
+                           query_job_ads)
+from job_scheduler import (JobCostModel,
+                           order_jobs_longest_first,
+                           record_job_costs)
+from output_packager import OutputPackager
+from run_manifest import (ForecastRunManifests,
+                          get_run_manifest_file,
+                          get_watershed_unit_key,
+                          remove_old_run_manifests)
+from stage_profiler import (enable_profiling,
+                            PROFILE_ENVIRONMENT_VARIABLE,
+                            profiling_enabled,
+                            write_hotspot_report)
+from upload_manager import UploadManager
 from sfpt_dataset_manager.dataset_manager import (ECMWFRAPIDDatasetManager,
                                                   RAPIDInputDatasetManager)
 
@@ -52,110 +82,539 @@ def find_current_rapid_output(forecast_directory, watershed, subbasin):
     #there are none found
     return None
 
-def csv_to_list(csv_file, delimiter=','):
+def get_ecmwf_rapid_job_info_list(ecmwf_folders, rapid_input_directories, rapid_io_files_location):
     """
-    Reads in a CSV file and returns the contents as list,
-    where every row is stored as a sublist, and each element
-    in the sublist represents 1 cell in the table.
+    Creates the information for every combination of ECMWF forecast
+    ensemble and watershed and the output directories for the jobs.
+    The forecast of a job is the runoff cropped to the watershed if available.
+    """
+    job_info_list = []
+    for ecmwf_folder in ecmwf_folders:
+        ecmwf_forecasts = glob(os.path.join(ecmwf_folder,'*.runoff.netcdf'))
+        for forecast, input_folder in itertools.product(ecmwf_forecasts, rapid_input_directories):
+            input_folder_split = input_folder.split("-")
+            watershed = input_folder_split[0]
+            subbasin = input_folder_split[1]
+            forecast_split = os.path.basename(forecast).split(".")
+            forecast_date_timestep = ".".join(forecast_split[:2])
+            ensemble_number = int(forecast_split[2])
+            master_watershed_input_directory = os.path.join(rapid_io_files_location, "input", input_folder)
+            master_watershed_outflow_directory = os.path.join(rapid_io_files_location, 'output',
+                                                              input_folder, forecast_date_timestep)
+            try:
+                os.makedirs(master_watershed_outflow_directory)
+            except OSError:
+                pass
+            #get basin names
+            outflow_file_name = 'Qout_%s_%s_%s.nc' % (watershed.lower(), subbasin.lower(), ensemble_number)
+            master_rapid_outflow_file = os.path.join(master_watershed_outflow_directory, outflow_file_name)
+            regional_forecast = get_regional_forecast_file(ecmwf_folder, input_folder, forecast)
+            if os.path.exists(regional_forecast):
+                forecast = regional_forecast
+            job_info_list.append({'watershed' : watershed,
+                                  'subbasin' : subbasin,
+                                  'forecast' : forecast,
+                                  'outflow_file_name' : master_rapid_outflow_file,
+                                  'forecast_date_timestep' : forecast_date_timestep,
+                                  'ensemble_number': ensemble_number,
+                                  'master_watershed_input_directory': master_watershed_input_directory,
+                                  'master_watershed_outflow_directory': master_watershed_outflow_directory,
+                                  })
+    return job_info_list
 
+def get_ensemble_batch_job_info_list(job_info_list):
+    """
+    Groups the ensemble jobs of each watershed forecast into one job that
+    routes all ensembles at once. The job information of the ensembles of
+    a batch job is in ensemble_job_infos and its forecast is the comma
+    separated list of their forecasts. The order of the job list is kept.
     """
-    with open(csv_file, 'rb') as csv_con:
-        reader = csv.reader(csv_con, delimiter=delimiter)
-        return list(reader)
+    batch_keys = []
+    batch_ensemble_job_infos = {}
+    for job_info in job_info_list:
+        batch_key = (job_info['forecast_date_timestep'], job_info['watershed'], job_info['subbasin'])
+        if batch_key not in batch_ensemble_job_infos:
+            batch_keys.append(batch_key)
+            batch_ensemble_job_infos[batch_key] = []
+        batch_ensemble_job_infos[batch_key].append(job_info)
+
+    batch_job_info_list = []
+    for batch_key in batch_keys:
+        ensemble_job_infos = sorted(batch_ensemble_job_infos[batch_key],
+                                    key=lambda job_info: job_info['ensemble_number'])
+        batch_job_info = dict(ensemble_job_infos[0])
+        del batch_job_info['outflow_file_name']
+        batch_job_info.update({'forecast' : ",".join([job_info['forecast'] for job_info in ensemble_job_infos]),
+                               'ensemble_number' : "all" if len(ensemble_job_infos) > 1 \
+                                                   else ensemble_job_infos[0]['ensemble_number'],
+                               'predicted_cost' : sum([job_info.get('predicted_cost', 0) \
+                                                       for job_info in ensemble_job_infos]),
+                               'ensemble_job_infos' : ensemble_job_infos,
+                               })
+        batch_job_info_list.append(batch_job_info)
+    return batch_job_info_list
+
+def get_ensemble_job_infos(job_info):
+    """
+    Returns the job information of each ensemble routed by the job
+    """
+    return job_info.get('ensemble_job_infos', [job_info])
 
-def get_comids_in_netcdf_file(reach_id_list, prediction_file):
+def get_ecmwf_rapid_job_attributes(job_info, rapid_scripts_location, rapid_executable_location,
+                                   initialize_flows, warm_start_from_qfinal, input_cache=None,
+                                   routing_engine="rapid"):
     """
-    Gets the subset comid_index_list, reordered_comid_list from the netcdf file
+    Returns the HTCondor submit attributes of the job to downscale the
+    forecast and run RAPID for the watershed as a list of (name, value)
+
+    If input_cache is given, the job takes the watershed input and the
+    scripts from the node input cache instead of transferring them.
+    input_cache is a dictionary with the keys directory, quota_gb and
+    staged_directories (from input_cache.stage_directories). The init
+    flow files are not cached and are transferred with the job.
+
+    routing_engine is "rapid" for the RAPID executable or "muskingum" for
+    the NumPy Muskingum routing in the job process. Batch jobs from
+    get_ensemble_batch_job_info_list always route all their ensembles
+    at once with the NumPy Muskingum routing.
+
+    If stage profiling is enabled, it is enabled in the job and the profiles
+    are transferred back to the initial directory of the job.
     """
-    data_nc = NET.Dataset(prediction_file, mode="r")
-    com_ids = data_nc.variables['COMID'][:]
-    data_nc.close()
+    watershed = job_info['watershed']
+    subbasin = job_info['subbasin']
+    ensemble_number = job_info['ensemble_number']
+    forecast = job_info['forecast']
+    ensemble_job_infos = get_ensemble_job_infos(job_info)
+    output_remaps = ["%s = %s" % (os.path.basename(ensemble_job_info['outflow_file_name']),
+                                  ensemble_job_info['outflow_file_name']) \
+                     for ensemble_job_info in ensemble_job_infos]
+    if warm_start_from_qfinal:
+        master_qfinal_directory = os.path.join(job_info['master_watershed_outflow_directory'], 'qfinal')
+        try:
+            os.makedirs(master_qfinal_directory)
+        except OSError:
+            pass
+        for ensemble_job_info in ensemble_job_infos:
+            qfinal_file_name = 'Qfinal_%s_%s_%s.csv' % (watershed.lower(), subbasin.lower(),
+                                                        ensemble_job_info['ensemble_number'])
+            output_remaps.append("%s = %s" % (qfinal_file_name,
+                                              os.path.join(master_qfinal_directory, qfinal_file_name)))
+
+    if 'ensemble_job_infos' in job_info:
+        routing_engine = "muskingum_ensemble"
+    arguments = '%s %s %s %s %s %s %s' % (forecast, watershed.lower(), subbasin.lower(),
+                                           rapid_executable_location, initialize_flows,
+                                           warm_start_from_qfinal, routing_engine)
+    profile_attributes = []
+    if profiling_enabled():
+        profile_attributes.append(('environment', "\"%s=true\"" % PROFILE_ENVIRONMENT_VARIABLE))
+    if input_cache is None:
+        return [('executable', os.path.join(rapid_scripts_location,'compute_ecmwf_rapid.py')),
+                ('transfer_input_files', "%s, %s, %s" % (forecast, job_info['master_watershed_input_directory'],
+                                                         rapid_scripts_location)),
+                ('arguments', arguments),
+                ('transfer_output_remaps', "\"%s\"" % "; ".join(output_remaps)),
+                ] + profile_attributes
+
+    master_job_stats_directory = os.path.join(job_info['master_watershed_outflow_directory'], 'job_stats')
+    try:
+        os.makedirs(master_job_stats_directory)
+    except OSError:
+        pass
+    cache_stats_file_name = 'input_cache_stats_%s_%s_%s.json' % (watershed.lower(), subbasin.lower(), ensemble_number)
+    output_remaps.append("%s = %s" % (cache_stats_file_name,
+                                      os.path.join(master_job_stats_directory, cache_stats_file_name)))
+    watershed_input_hash, watershed_input_archive = \
+        input_cache['staged_directories'][job_info['master_watershed_input_directory']]
+    scripts_hash, scripts_archive = input_cache['staged_directories'][rapid_scripts_location]
+    transfer_input_files = [forecast, os.path.join(rapid_scripts_location, 'input_cache.py')]
+    if initialize_flows:
+        transfer_input_files += glob(os.path.join(job_info['master_watershed_input_directory'], 'Qinit_*.csv'))
+    return [('executable', os.path.join(rapid_scripts_location,'cached_compute_ecmwf_rapid.py')),
+            ('transfer_input_files', ", ".join(transfer_input_files)),
+            ('arguments', '%s %s %s %s %s %s %s' % (input_cache['directory'], input_cache['quota_gb'],
+                                                    watershed_input_hash, watershed_input_archive,
+                                                    scripts_hash, scripts_archive, arguments)),
+            ('transfer_output_remaps', "\"%s\"" % "; ".join(output_remaps)),
+            ('+WantIOProxy', 'true'),
+            ] + profile_attributes
+
+def submit_ecmwf_rapid_job(job_info, iteration, condor_init_dir, rapid_scripts_location,
+                           rapid_executable_location, initialize_flows, warm_start_from_qfinal,
+                           input_cache=None, routing_engine="rapid"):
+    """
+    Submits the HTCondor job to downscale the forecast and run RAPID for the watershed
+    """
+    #create job to downscale forecasts for watershed
+    job = CJob('job_%s_%s_%s' % (job_info['forecast_date_timestep'], job_info['watershed'], iteration),
+               tmplt.vanilla_transfer_files)
+    job.set('initialdir',condor_init_dir)
+    for attribute, value in get_ecmwf_rapid_job_attributes(job_info, rapid_scripts_location,
+                                                           rapid_executable_location, initialize_flows,
+                                                           warm_start_from_qfinal, input_cache,
+                                                           routing_engine):
+        job.set(attribute, value)
+    job.submit()
+    return job
+
+def run_watershed_post_processing(rapid_input_directory, forecast_date_timestep,
+                                  rapid_io_files_location, era_interim_data_location,
+                                  initialize_flows, create_warning_points,
+                                  warm_start_from_qfinal=False, data_manager=None,
+                                  create_ensemble_cube=False):
+    """
+    Writes and archives the ensemble statistics, creates the init flow file,
+    generates and uploads the warning points and, if create_ensemble_cube is
+    set, consolidates the ensembles into the ensemble cube for the forecast
+    of a watershed. Returns True if every step succeeded.
+    """
+    input_directory = os.path.join(rapid_io_files_location, 'input', rapid_input_directory)
+    forecast_directory = os.path.join(rapid_io_files_location, 'output', rapid_input_directory,
+                                      forecast_date_timestep)
+    if not os.path.exists(forecast_directory):
+        return False
+    post_processing_success = True
+    input_folder_split = rapid_input_directory.split("-")
+    watershed = input_folder_split[0]
+    subbasin = input_folder_split[1]
+    print "Writing ensemble statistics for", watershed, subbasin, "from", forecast_date_timestep
     try:
-        #get where comids are in netcdf file
-        netcdf_reach_indices_list = np.where(np.in1d(com_ids, reach_id_list))[0]
-    except Exception as ex:
+        write_ensemble_statistics(forecast_directory, watershed, subbasin)
+    except Exception, ex:
         print ex
+        post_processing_success = False
 
-    return netcdf_reach_indices_list, com_ids[netcdf_reach_indices_list]
+    #the forecast output is removed after upload
+    statistics_file = get_statistics_file(forecast_directory, watershed, subbasin)
+    if os.path.exists(statistics_file):
+        print "Archiving ensemble statistics for", watershed, subbasin, "from", forecast_date_timestep
+        try:
+            archive_forecast_statistics(statistics_file, os.path.join(rapid_io_files_location, 'archive'),
+                                        rapid_input_directory, forecast_date_timestep)
+        except Exception, ex:
+            print ex
+            post_processing_success = False
+
+    if initialize_flows:
+        print "Initializing flows for", watershed, subbasin, "from", forecast_date_timestep
+        qfinal_files = None
+        if warm_start_from_qfinal:
+            qfinal_files = find_current_qfinal_files(forecast_directory, watershed, subbasin)
+        try:
+            if qfinal_files:
+                compute_initial_rapid_flows_from_qfinal(qfinal_files, input_directory,
+                                                        forecast_date_timestep)
+            else:
+                basin_files = find_current_rapid_output(forecast_directory, watershed, subbasin)
+                compute_initial_rapid_flows(basin_files, input_directory, forecast_date_timestep)
+        except Exception, ex:
+            print ex
+            pass
+        if not os.path.exists(get_init_flow_file(input_directory, forecast_date_timestep)):
+            print "Init flow file not written for", watershed, subbasin
+            post_processing_success = False
+
+    era_interim_watershed_directory = os.path.join(era_interim_data_location, rapid_input_directory)
+    if create_warning_points and os.path.exists(era_interim_watershed_directory):
+        print "Generating Warning Points for", watershed, subbasin, "from", forecast_date_timestep
+        era_interim_files = glob(os.path.join(era_interim_watershed_directory, "*.nc"))
+        if era_interim_files:
+            try:
+                generate_warning_points(forecast_directory, era_interim_files[0], forecast_directory, threshold=10)
+                if data_manager is not None:
+                    data_manager.initialize_run_ecmwf(watershed, subbasin, forecast_date_timestep)
+                    data_manager.zip_upload_warning_points_in_directory(forecast_directory)
+            except Exception, ex:
+                print ex
+                post_processing_success = False
+        else:
+            print "No ERA Interim file found. Skipping ..."
+    else:
+        print "No ERA Interim directory found for", rapid_input_directory, ". Skipping warning point generation..."
 
-def compute_initial_rapid_flows(prediction_files, input_directory, forecast_date_timestep):
+    #the ensemble cube is only for queries and does not hold up the next run
+    if create_ensemble_cube:
+        print "Consolidating ensembles for", watershed, subbasin, "from", forecast_date_timestep
+        try:
+            consolidate_forecast_ensembles(forecast_directory, watershed, subbasin)
+        except Exception, ex:
+            print ex
+            post_processing_success = False
+    return post_processing_success
+
+def record_watershed_post_processing(run_manifest, watershed_unit_key, post_processing_success,
+                                     ensembles_complete):
     """
-    Gets mean of all 52 ensembles 12-hrs in future and prints to csv as initial flow
-    Qinit_file (BS_opt_Qinit)
-    The assumptions are that Qinit_file is ordered the same way as rapid_connect_file
-    if subset of list, add zero where there is no flow
+    Records the watershed forecast as post processed only if every step
+    succeeded over all of its ensembles so a resumed cycle runs it again
     """
-    #remove old init files for this basin
-    past_init_flow_files = glob(os.path.join(input_directory, 'Qinit_*.csv'))
-    for past_init_flow_file in past_init_flow_files:
+    if post_processing_success and ensembles_complete:
+        run_manifest.set_state(watershed_unit_key, 'post_processed')
+    elif not ensembles_complete:
+        print watershed_unit_key, "post processed with missing ensembles. Not recorded as post processed ..."
+    else:
+        print watershed_unit_key, "post processing failed. Not recorded as post processed ..."
+
+def get_watershed_ensemble_counts(job_info_list):
+    """
+    Returns the number of ensemble jobs of each watershed forecast by
+    watershed unit key (see run_manifest.get_watershed_unit_key)
+    """
+    ensemble_counts = {}
+    for job_info in job_info_list:
+        for ensemble_job_info in get_ensemble_job_infos(job_info):
+            watershed_unit_key = get_watershed_unit_key("%s-%s" % (ensemble_job_info['watershed'],
+                                                                   ensemble_job_info['subbasin']),
+                                                        ensemble_job_info['forecast_date_timestep'])
+            ensemble_counts[watershed_unit_key] = ensemble_counts.get(watershed_unit_key, 0) + 1
+    return ensemble_counts
+
+def upload_and_post_process_watershed(rapid_input_directory, forecast_date_timestep,
+                                      rapid_io_files_location, era_interim_data_location,
+                                      initialize_flows, create_warning_points,
+                                      warm_start_from_qfinal, run_manifest, num_ensembles=None,
+                                      data_store_url=None, data_store_api_key=None,
+                                      num_upload_workers=4, num_package_processes=None,
+                                      package_codec='gz', package_compression_level=6,
+                                      create_ensemble_cube=False):
+    """
+    Uploads the RAPID output of all ensembles of a watershed forecast and
+    runs the post processing of the watershed. Used by the post processing
+    node of the DAG submission mode. The watershed forecast is recorded as
+    post processed if the output of num_ensembles ensembles was found
+    (never if num_ensembles is not given).
+    """
+    watershed, subbasin = rapid_input_directory.split("-")
+    forecast_directory = os.path.join(rapid_io_files_location, 'output', rapid_input_directory,
+                                      forecast_date_timestep)
+    job_info_list = []
+    for outflow_file in find_current_rapid_output(forecast_directory, watershed.lower(), subbasin.lower()) or []:
+        job_info = {'watershed' : watershed,
+                    'subbasin' : subbasin,
+                    'outflow_file_name' : outflow_file,
+                    'forecast_date_timestep' : forecast_date_timestep,
+                    'ensemble_number' : int(os.path.basename(outflow_file)[:-3].split("_")[-1]),
+                    'master_watershed_outflow_directory' : forecast_directory,
+                    }
+        run_manifest.set_job_state(job_info, 'finished')
+        job_info_list.append(job_info)
+
+    data_manager = None
+    if data_store_url and data_store_api_key:
+        data_manager = ECMWFRAPIDDatasetManager(data_store_url, data_store_api_key)
+        output_packager = OutputPackager(num_package_processes, package_codec,
+                                         package_compression_level)
+        upload_manager = UploadManager(lambda: ECMWFRAPIDDatasetManager(data_store_url,
+                                                                        data_store_api_key),
+                                       os.path.join(rapid_io_files_location, 'upload_record.json'),
+                                       num_workers=num_upload_workers,
+                                       packager=output_packager,
+                                       state_callback=run_manifest.set_job_state)
+        for job_info in job_info_list:
+            if not run_manifest.job_has_reached(job_info, 'uploaded'):
+                upload_manager.add_upload(job_info)
+        upload_manager.wait_for_uploads()
+        upload_manager.print_upload_summary()
+        output_packager.close()
+
+    watershed_unit_key = get_watershed_unit_key(rapid_input_directory, forecast_date_timestep)
+    if not run_manifest.has_reached(watershed_unit_key, 'post_processed'):
+        post_processing_success = run_watershed_post_processing(rapid_input_directory, forecast_date_timestep,
+                                                                rapid_io_files_location, era_interim_data_location,
+                                                                initialize_flows, create_warning_points,
+                                                                warm_start_from_qfinal, data_manager,
+                                                                create_ensemble_cube)
+        record_watershed_post_processing(run_manifest, watershed_unit_key, post_processing_success,
+                                         num_ensembles is not None and len(job_info_list) >= num_ensembles)
+
+    if data_manager is not None and job_info_list and \
+            all([run_manifest.job_has_reached(job_info, 'uploaded') for job_info in job_info_list]):
+        #delete local datasets
         try:
-            os.remove(past_init_flow_file)
-        except:
+            rmtree(forecast_directory)
+        except OSError:
             pass
-    current_forecast_date = datetime.datetime.strptime(forecast_date_timestep[:11],"%Y%m%d.%H").strftime("%Y%m%dt%H")
-    init_file_location = os.path.join(input_directory,'Qinit_%s.csv' % current_forecast_date)
-    #check to see if exists and only perform operation once
-    if prediction_files:
-        #get list of COMIDS
-        connectivity_file = csv_to_list(os.path.join(input_directory,'rapid_connect.csv'))
-        comid_list = np.array([int(row[0]) for row in connectivity_file])
-
-
-        print "Finding COMID indices ..."
-        comid_index_list, reordered_comid_list = get_comids_in_netcdf_file(comid_list, prediction_files[0])
-        print "Extracting data ..."
-        reach_prediciton_array = np.zeros((len(comid_list),len(prediction_files),1))
-        #get information from datasets
-        for file_index, prediction_file in enumerate(prediction_files):
-            try:
-                #Get hydrograph data from ECMWF Ensemble
-                data_nc = NET.Dataset(prediction_file, mode="r")
-                qout_dimensions = data_nc.variables['Qout'].dimensions
-                if qout_dimensions[0].lower() == 'time' and qout_dimensions[1].lower() == 'comid':
-                    data_values_2d_array = data_nc.variables['Qout'][2,comid_index_list].transpose()
-                elif qout_dimensions[1].lower() == 'time' and qout_dimensions[0].lower() == 'comid':
-                    data_values_2d_array = data_nc.variables['Qout'][comid_index_list,2]
-                else:
-                    print "Invalid ECMWF forecast file", prediction_file
-                    data_nc.close()
-                    continue
-                data_nc.close()
-                #organize the data
-                for comid_index, comid in enumerate(reordered_comid_list):
-                    reach_prediciton_array[comid_index][file_index] = data_values_2d_array[comid_index]
-            except Exception, e:
-                print e
-                #pass
-
-        print "Analyzing data ..."
-        output_data = []
-        for comid in comid_list:
-            try:
-                #get where comids are in netcdf file
-                comid_index = np.where(reordered_comid_list==comid)[0][0]
-            except Exception as ex:
-                #comid not found in list. Adding zero init flow ...
-                output_data.append([0])
-                pass
-                continue
 
-            #get mean of series as init flow
-            output_data.append([np.mean(reach_prediciton_array[comid_index])])
-
-        print "Writing output ..."
-        with open(init_file_location, 'wb') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerows(output_data)
-    else:
-        print "No current forecasts found. Skipping ..."
+def write_data_store_credentials(credentials_file, data_store_url, data_store_api_key):
+    """
+    Writes the data store url and API key to a file only readable by the
+    owner so that the key is not in the DAG or submit file arguments
+    """
+    credentials_descriptor = os.open(credentials_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    #the mode is only applied when the file is created
+    os.fchmod(credentials_descriptor, 0600)
+    with os.fdopen(credentials_descriptor, 'w') as credentials_fp:
+        json.dump({'data_store_url' : data_store_url,
+                   'data_store_api_key' : data_store_api_key}, credentials_fp)
+
+def read_data_store_credentials(credentials_file):
+    """
+    Reads the data store url and API key written by write_data_store_credentials
+    """
+    with open(credentials_file) as credentials_fp:
+        credentials = json.load(credentials_fp)
+    return credentials['data_store_url'], credentials['data_store_api_key']
+
+def submit_ecmwf_rapid_dag(job_info_list, rapid_input_directories, condor_init_dir,
+                           rapid_scripts_location, rapid_executable_location,
+                           rapid_io_files_location, era_interim_data_location,
+                           initialize_flows, create_warning_points, warm_start_from_qfinal,
+                           watershed_ensemble_counts, data_store_url, data_store_api_key, input_cache=None,
+                           routing_engine="rapid", num_upload_workers=4, num_package_processes=None,
+                           package_codec='gz', package_compression_level=6, profile_since=None,
+                           create_ensemble_cube=False):
+    """
+    Writes and submits a DAG where the ensemble jobs of each watershed
+    forecast are parents of the post processing node of that watershed
+    forecast so that each basin is finished as soon as its jobs are done.
+    watershed_ensemble_counts is the number of ensembles of each watershed
+    forecast of the cycle (see get_watershed_ensemble_counts), including
+    the ones finished before a restart. The upload and packaging settings
+    are passed on to the post processing nodes and the data store
+    credentials through a file only readable by the owner.
+
+    If stage profiling is enabled, a FINAL node merges the profiles of the
+    stages started after profile_since (seconds since epoch) into a
+    hotspot report in the condor init directory.
+    """
+    credentials_file = ""
+    if data_store_url and data_store_api_key:
+        credentials_file = os.path.join(condor_init_dir, 'data_store_credentials.json')
+        write_data_store_credentials(credentials_file, data_store_url, data_store_api_key)
+
+    dag_job_list = []
+    for iteration, job_info in enumerate(job_info_list):
+        job_name = 'job_%s_%s_%s' % (job_info['forecast_date_timestep'], job_info['watershed'], iteration)
+        dag_job_list.append((job_name,
+                             get_ecmwf_rapid_job_attributes(job_info, rapid_scripts_location,
+                                                            rapid_executable_location, initialize_flows,
+                                                            warm_start_from_qfinal, input_cache,
+                                                            routing_engine),
+                             job_info))
+
+    post_processing_list = []
+    forecast_date_timesteps = sorted(set([watershed_unit_key.split("/")[0] \
+                                          for watershed_unit_key in watershed_ensemble_counts]))
+    for forecast_date_timestep in forecast_date_timesteps:
+        for rapid_input_directory in rapid_input_directories:
+            num_ensembles = watershed_ensemble_counts.get(get_watershed_unit_key(rapid_input_directory,
+                                                                                 forecast_date_timestep), 0)
+            arguments = " ".join([str(argument) for argument in [rapid_input_directory, forecast_date_timestep,
+                                                                 rapid_io_files_location, era_interim_data_location,
+                                                                 initialize_flows, create_warning_points,
+                                                                 warm_start_from_qfinal,
+                                                                 get_run_manifest_file(rapid_io_files_location,
+                                                                                       forecast_date_timestep),
+                                                                 num_ensembles, num_upload_workers,
+                                                                 num_package_processes, package_codec,
+                                                                 package_compression_level,
+                                                                 create_ensemble_cube,
+                                                                 credentials_file]])
+            post_processing_list.append((rapid_input_directory, forecast_date_timestep,
+                                         [('executable', os.path.join(rapid_scripts_location,
+                                                                      'postprocess_watershed.py')),
+                                          ('arguments', arguments),
+                                          ('getenv', 'True'),
+                                          ]))
+
+    dag_file = os.path.join(condor_init_dir, 'ecmwf_rapid_%s.dag' % \
+                            datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+    final_attributes = None
+    if profiling_enabled() and profile_since is not None:
+        report_file = os.path.join(condor_init_dir, 'profile_report_%s.txt' % \
+                                   datetime.datetime.utcfromtimestamp(profile_since).strftime("%Y%m%d%H%M%S"))
+        final_attributes = [('executable', os.path.join(rapid_scripts_location, 'stage_profiler.py')),
+                            ('arguments', "%s %s %s" % (condor_init_dir, report_file, profile_since)),
+                            ('getenv', 'True'),
+                            ]
+    create_ecmwf_rapid_dag(dag_file, dag_job_list, post_processing_list, condor_init_dir,
+                           final_attributes)
+    submit_dag(dag_file)
+    print "Submitted DAG", dag_file
 
 def run_ecmwf_rapid_process(rapid_executable_location, rapid_io_files_location, ecmwf_forecast_location,
                             era_interim_data_location, condor_log_directory, main_log_directory, data_store_url,
                             data_store_api_key, app_instance_id, sync_rapid_input_with_ckan, download_ecmwf,
-                            upload_output_to_ckan, initialize_flows, create_warning_points):
+                            upload_output_to_ckan, initialize_flows, create_warning_points,
+                            warm_start_from_qfinal=False, num_upload_workers=4,
+                            num_package_processes=None, package_codec='gz', package_compression_level=6,
+                            submit_with_dag=False, node_input_cache_directory=None,
+                            node_input_cache_quota_gb=20, crop_runoff_to_regions=False,
+                            num_download_connections=4, download_segments_per_file=1,
+                            download_stream_extract=False, watch_ecmwf=False,
+                            watch_poll_interval_minutes=5, watch_hours=24,
+                            ecmwf_drop_directory=None, ecmwf_folders=None,
+                            profile_stages=False, routing_engine="rapid",
+                            batch_ensembles=False, create_ensemble_cube=False):
     """
     This it the main process
+
+    If warm_start_from_qfinal is set, each job writes the 12-hr RAPID Qfinal
+    state and the next Qinit file is averaged from those instead of from the
+    full Qout files.
+
+    If submit_with_dag is set, the jobs are submitted as an HTCondor DAG
+    with a post processing node per watershed forecast (Qinit, warning
+    points and upload) and this process returns after submission.
+
+    If node_input_cache_directory is set, the watershed inputs and scripts
+    are staged by content hash and the jobs use a cache in that directory
+    on the nodes, limited to node_input_cache_quota_gb.
+
+    If crop_runoff_to_regions is set, the global ECMWF runoff is cropped to
+    the weight table window of each watershed after download and each job
+    only receives the runoff of its watershed.
+
+    The ECMWF forecasts are downloaded with up to num_download_connections
+    files at once. With download_segments_per_file above 1, each large file
+    is downloaded in that many byte ranges on separate connections.
+    With download_stream_extract, the forecasts are extracted while they
+    are downloaded instead of after saving the tarball.
+
+    If watch_ecmwf is set, the ftp site (or ecmwf_drop_directory if given)
+    is polled every watch_poll_interval_minutes for watch_hours and each
+    forecast is processed as soon as its tarball is complete and extracted.
+
+    If ecmwf_folders is given, only those forecasts are processed.
+
+    If profile_stages is set, the stages of the jobs and of the post
+    processing are profiled (see stage_profiler) and the profiles of the
+    cycle in the HTCondor directory of the day are merged into a hotspot
+    report (by the FINAL node of the DAG in DAG submission mode).
+
+    routing_engine selects the routing of the jobs: "rapid" runs the RAPID
+    executable and "muskingum" the NumPy Muskingum routing in the job
+    process, which avoids starting RAPID for small watersheds.
+
+    If batch_ensembles is set, one job per watershed forecast downscales
+    all ensembles and routes them at once with the NumPy Muskingum routing
+    as a (time, reach, ensemble) array. The array of all ensembles is held
+    in memory, so this is meant for small and medium watersheds.
+
+    If create_ensemble_cube is set, the ensembles of each watershed forecast
+    are consolidated into an ensemble cube for hydrograph queries (see
+    ensemble_cube.py) after the init flow file and the warning points.
     """
+    process_kwargs = dict(locals())
+    if watch_ecmwf:
+        def process_forecasts(ready_ecmwf_folders):
+            forecast_kwargs = dict(process_kwargs)
+            forecast_kwargs.update(watch_ecmwf=False,
+                                   download_ecmwf=False,
+                                   ecmwf_folders=ready_ecmwf_folders)
+            run_ecmwf_rapid_process(**forecast_kwargs)
+        watcher = ECMWFForecastWatcher(ecmwf_forecast_location,
+                                       process_forecasts,
+                                       poll_interval=watch_poll_interval_minutes*60,
+                                       drop_directory=ecmwf_drop_directory,
+                                       download_kwargs={'num_connections' : num_download_connections,
+                                                        'segments_per_file' : download_segments_per_file,
+                                                        'stream_extract' : download_stream_extract,
+                                                        })
+        watcher.watch(watch_hours)
+        return
+
     time_begin_all = datetime.datetime.utcnow()
     date_string = time_begin_all.strftime('%Y%m%d')
     #date_string = datetime.datetime(2015,2,3).strftime('%Y%m%d')
@@ -179,6 +638,10 @@ def run_ecmwf_rapid_process(rapid_executable_location, rapid_io_files_location,
     except OSError:
         pass
 
+    if profile_stages:
+        #profiles of the jobs are transferred back to the HTCondor directory
+        enable_profiling(condor_init_dir)
+
     #get list of correclty formatted rapid input directories in rapid directory
     rapid_input_directories = []
     for directory in os.listdir(os.path.join(rapid_io_files_location,'input')):
@@ -188,164 +651,214 @@ def run_ecmwf_rapid_process(rapid_executable_location, rapid_io_files_location,
         else:
             print directory, "incorrectly formatted. Skipping ..."
 
-    if download_ecmwf:
+    if ecmwf_folders is not None:
+        #forecasts given by the watcher
+        pass
+    elif download_ecmwf:
         #download all files for today
         ecmwf_folders = ftp_ecmwf_download.download_all_ftp(ecmwf_forecast_location,
-           'Runoff.%s*.netcdf.tar.gz' % date_string)
+           'Runoff.%s*.netcdf.tar.gz' % date_string,
+           num_connections=num_download_connections,
+           segments_per_file=download_segments_per_file,
+           stream_extract=download_stream_extract)
     else:
         ecmwf_folders = glob(os.path.join(ecmwf_forecast_location,
             'Runoff.'+date_string+'*.netcdf'))
 
+    if crop_runoff_to_regions:
+        #crop global runoff to the watersheds
+        crop_ecmwf_folders(ecmwf_folders, rapid_io_files_location, rapid_input_directories)
+
+    #journal of each forecast cycle to resume only incomplete work after a crash
+    remove_old_run_manifests(rapid_io_files_location)
+    run_manifest = ForecastRunManifests(rapid_io_files_location)
+
+    data_manager = None
     if upload_output_to_ckan and data_store_url and data_store_api_key:
         #init data manager for CKAN
         data_manager = ECMWFRAPIDDatasetManager(data_store_url,
                                                 data_store_api_key)
+        #init parallel packaging and concurrent uploads of RAPID output
+        output_packager = OutputPackager(num_package_processes, package_codec,
+                                         package_compression_level)
+        upload_manager = UploadManager(lambda: ECMWFRAPIDDatasetManager(data_store_url,
+                                                                        data_store_api_key),
+                                       os.path.join(rapid_io_files_location, 'upload_record.json'),
+                                       num_workers=num_upload_workers,
+                                       packager=output_packager,
+                                       state_callback=run_manifest.set_job_state)
+
+    #prepare ECMWF jobs for all forecasts and watersheds
+    job_info_list = get_ecmwf_rapid_job_info_list(ecmwf_folders, rapid_input_directories,
+                                                  rapid_io_files_location)
+    input_cache = None
+    if node_input_cache_directory:
+        #stage inputs by content hash for the node input cache
+        staged_directories = stage_directories([os.path.join(rapid_io_files_location, 'input', directory) \
+                                                for directory in rapid_input_directories] + \
+                                               [rapid_scripts_location],
+                                               os.path.join(rapid_io_files_location, 'staging'))
+        input_cache = {'directory' : node_input_cache_directory,
+                       'quota_gb' : node_input_cache_quota_gb,
+                       'staged_directories' : staged_directories,
+                       }
+
+    #submit the longest jobs first across all forecasts
+    cost_model = JobCostModel(os.path.join(rapid_io_files_location, 'job_cost_history.jsonl'))
+    job_info_list = order_jobs_longest_first(job_info_list, cost_model)
+    submit_job_info_list = job_info_list
+    if batch_ensembles:
+        #one job routes all ensembles of a watershed forecast
+        submit_job_info_list = sorted(get_ensemble_batch_job_info_list(job_info_list),
+                                      key=lambda job_info: job_info['predicted_cost'], reverse=True)
+
+    if submit_with_dag:
+        submit_ecmwf_rapid_dag([job_info for job_info in submit_job_info_list \
+                                if not all([run_manifest.job_has_reached(ensemble_job_info, 'finished') \
+                                            for ensemble_job_info in get_ensemble_job_infos(job_info)])],
+                               rapid_input_directories, condor_init_dir, rapid_scripts_location,
+                               rapid_executable_location, rapid_io_files_location,
+                               era_interim_data_location, initialize_flows, create_warning_points,
+                               warm_start_from_qfinal, get_watershed_ensemble_counts(job_info_list),
+                               data_store_url if upload_output_to_ckan else None,
+                               data_store_api_key if upload_output_to_ckan else None,
+                               input_cache, routing_engine, num_upload_workers,
+                               num_package_processes, package_codec, package_compression_level,
+                               (time_begin_all - datetime.datetime(1970, 1, 1)).total_seconds(),
+                               create_ensemble_cube)
+        if upload_output_to_ckan and data_store_url and data_store_api_key:
+            output_packager.close()
+        return
+
+    #jobs of a restarted cycle still in the queue are harvested instead of submitted again
+    previous_cluster_ids = set([run_manifest.get_job_cluster_id(ensemble_job_info) \
+                                for job_info in submit_job_info_list \
+                                for ensemble_job_info in get_ensemble_job_infos(job_info) \
+                                if not run_manifest.job_has_reached(ensemble_job_info, 'finished')])
+    previous_cluster_ids.discard(None)
+    previous_job_ads = {}
+    if previous_cluster_ids:
+        try:
+            previous_job_ads = query_job_ads(sorted(previous_cluster_ids))
+        except Exception, ex:
+            print "Unable to query the jobs of the previous run", ex
+
+    #submit jobs to downsize ecmwf files to watershed
+    #skipping the jobs finished before a restart
+    job_list = []
+    submitted_job_info_list = []
+    finished_job_info_list = []
+    num_reattached_jobs = 0
+    for iteration, job_info in enumerate(submit_job_info_list):
+        ensemble_job_infos = get_ensemble_job_infos(job_info)
+        previous_cluster_id = run_manifest.get_job_cluster_id(ensemble_job_infos[0])
+        previous_status = previous_job_ads.get(previous_cluster_id, {}).get('status')
+        if previous_status is not None and previous_status not in FINISHED_JOB_STATUSES:
+            job_list.append(previous_cluster_id)
+            submitted_job_info_list.append(job_info)
+            num_reattached_jobs += 1
+            continue
+        if all([run_manifest.job_has_reached(ensemble_job_info, 'uploaded') or \
+                (run_manifest.job_has_reached(ensemble_job_info, 'submitted') and \
+                 os.path.exists(ensemble_job_info['outflow_file_name'])) \
+                for ensemble_job_info in ensemble_job_infos]):
+            for ensemble_job_info in ensemble_job_infos:
+                if not run_manifest.job_has_reached(ensemble_job_info, 'finished'):
+                    run_manifest.set_job_state(ensemble_job_info, 'finished')
+                finished_job_info_list.append(ensemble_job_info)
+            continue
+        job = submit_ecmwf_rapid_job(job_info, iteration, condor_init_dir, rapid_scripts_location,
+                                     rapid_executable_location, initialize_flows,
+                                     warm_start_from_qfinal, input_cache, routing_engine)
+        for ensemble_job_info in ensemble_job_infos:
+            run_manifest.set_job_state(ensemble_job_info, 'submitted', get_job_cluster_id(job))
+        job_list.append(job)
+        submitted_job_info_list.append(job_info)
+    if finished_job_info_list:
+        print len(finished_job_info_list), "jobs finished in a previous run. Skipping ..."
+    if num_reattached_jobs:
+        print num_reattached_jobs, "jobs of a previous run still in the queue. Waiting for them ..."
+
+    #queue files for upload as soon as each job finishes
+    def process_job_output(job_info):
+        for ensemble_job_info in get_ensemble_job_infos(job_info):
+            if not os.path.exists(ensemble_job_info['outflow_file_name']):
+                print "No output for", ensemble_job_info['outflow_file_name'], ". Skipping upload ..."
+                continue
+            run_manifest.set_job_state(ensemble_job_info, 'finished')
+            if upload_output_to_ckan and data_store_url and data_store_api_key \
+                    and not run_manifest.job_has_reached(ensemble_job_info, 'uploaded'):
+                upload_manager.add_upload(ensemble_job_info)
+
+    for job_info in finished_job_info_list:
+        process_job_output(job_info)
+
+    harvest_timeline = harvest_jobs_in_completion_order(job_list, submitted_job_info_list,
+                                                        process_job_output)
+    print_harvest_timeline(harvest_timeline)
+    if not batch_ensembles:
+        #the cost model predicts single ensemble jobs
+        record_job_costs(submitted_job_info_list, harvest_timeline, cost_model)
+    if input_cache is not None:
+        summarize_input_cache_stats([os.path.join(job_info['master_watershed_outflow_directory'], 'job_stats',
+                                                  'input_cache_stats_%s_%s_%s.json' % (job_info['watershed'].lower(),
+                                                                                       job_info['subbasin'].lower(),
+                                                                                       job_info['ensemble_number'])) \
+                                     for job_info in submitted_job_info_list])
+    if upload_output_to_ckan and data_store_url and data_store_api_key:
+        upload_manager.wait_for_uploads()
+        upload_manager.print_upload_summary()
+
+    #initialize flows for next run
+    if initialize_flows or create_warning_points or create_ensemble_cube:
+        #create new init flow files/generate warning point files
+        forecast_date_timesteps = sorted(set([job_info['forecast_date_timestep'] for job_info in job_info_list]))
+        for forecast_date_timestep in forecast_date_timesteps:
+            for rapid_input_directory in rapid_input_directories:
+                watershed_unit_key = get_watershed_unit_key(rapid_input_directory, forecast_date_timestep)
+                if run_manifest.has_reached(watershed_unit_key, 'post_processed'):
+                    print rapid_input_directory, forecast_date_timestep, "already post processed. Skipping ..."
+                    continue
+                post_processing_success = run_watershed_post_processing(rapid_input_directory,
+                                                                        forecast_date_timestep,
+                                                                        rapid_io_files_location,
+                                                                        era_interim_data_location,
+                                                                        initialize_flows, create_warning_points,
+                                                                        warm_start_from_qfinal, data_manager,
+                                                                        create_ensemble_cube)
+                ensembles_complete = all([run_manifest.job_has_reached(job_info, 'finished') \
+                                          for job_info in job_info_list \
+                                          if job_info['forecast_date_timestep'] == forecast_date_timestep \
+                                          and "%s-%s" % (job_info['watershed'],
+                                                         job_info['subbasin']) == rapid_input_directory])
+                record_watershed_post_processing(run_manifest, watershed_unit_key, post_processing_success,
+                                                 ensembles_complete)
 
-    #prepare ECMWF files
-    for ecmwf_folder in ecmwf_folders:
-        ecmwf_forecasts = glob(os.path.join(ecmwf_folder,'*.runoff.netcdf'))
-        #make the largest files first
-        ecmwf_forecasts.sort(key=os.path.getsize, reverse=True)
-
-        #submit jobs to downsize ecmwf files to watershed
-        iteration = 0
-        job_list = []
-        job_info_list = []
-        for forecast_combo in itertools.product(ecmwf_forecasts, rapid_input_directories):
-            forecast = forecast_combo[0]
-            input_folder = forecast_combo[1]
-            input_folder_split = input_folder.split("-")
-            watershed = input_folder_split[0]
-            subbasin = input_folder_split[1]
-            forecast_split = os.path.basename(forecast).split(".")
-            forecast_date_timestep = ".".join(forecast_split[:2])
-            ensemble_number = int(forecast_split[2])
-            master_watershed_input_directory = os.path.join(rapid_io_files_location, "input", input_folder)
-            master_watershed_outflow_directory = os.path.join(rapid_io_files_location, 'output',
-                                                              input_folder, forecast_date_timestep)
+    if upload_output_to_ckan and data_store_url and data_store_api_key:
+        #delete local datasets where all outputs were uploaded
+        outflow_directories = set([job_info['master_watershed_outflow_directory'] for job_info in job_info_list])
+        for outflow_directory in outflow_directories:
+            if not all([run_manifest.job_has_reached(job_info, 'uploaded') for job_info in job_info_list \
+                        if job_info['master_watershed_outflow_directory'] == outflow_directory]):
+                print "Not all outputs in", outflow_directory, "uploaded. Keeping for next run ..."
+                continue
             try:
-                os.makedirs(master_watershed_outflow_directory)
+                rmtree(outflow_directory)
             except OSError:
                 pass
-            #get basin names
-            outflow_file_name = 'Qout_%s_%s_%s.nc' % (watershed.lower(), subbasin.lower(), ensemble_number)
-            node_rapid_outflow_file = outflow_file_name
-            master_rapid_outflow_file = os.path.join(master_watershed_outflow_directory, outflow_file_name)
-
-            #create job to downscale forecasts for watershed
-            job = CJob('job_%s_%s_%s' % (forecast_date_timestep, watershed, iteration), tmplt.vanilla_transfer_files)
-            job.set('executable',os.path.join(rapid_scripts_location,'compute_ecmwf_rapid.py'))
-            job.set('transfer_input_files', "%s, %s, %s" % (forecast, master_watershed_input_directory, rapid_scripts_location))
-            job.set('initialdir',condor_init_dir)
-            job.set('arguments', '%s %s %s %s %s' % (forecast, watershed.lower(), subbasin.lower(),
-                                                        rapid_executable_location, initialize_flows))
-            job.set('transfer_output_remaps',"\"%s = %s\"" % (node_rapid_outflow_file, master_rapid_outflow_file))
-            job.submit()
-            job_list.append(job)
-            job_info_list.append({'watershed' : watershed,
-                                  'subbasin' : subbasin,
-                                  'outflow_file_name' : master_rapid_outflow_file,
-                                  'forecast_date_timestep' : forecast_date_timestep,
-                                  'ensemble_number': ensemble_number,
-                                  'master_watershed_outflow_directory': master_watershed_outflow_directory,
-                                  })
-            iteration += 1
-
-        #wait for jobs to finish then upload files
-        for index, job in enumerate(job_list):
-            job.wait()
-            #upload file when done
-            if upload_output_to_ckan and data_store_url and data_store_api_key:
-                job_info = job_info_list[index]
-                print "Uploading", job_info['watershed'], job_info['subbasin'], \
-                    job_info['forecast_date_timestep'], job_info['ensemble_number']
-                #Upload to CKAN
-                data_manager.initialize_run_ecmwf(job_info['watershed'], job_info['subbasin'], job_info['forecast_date_timestep'])
-                data_manager.update_resource_ensemble_number(job_info['ensemble_number'])
-                #upload file
-                try:
-                    #tar.gz file
-                    output_tar_file =  os.path.join(job_info['master_watershed_outflow_directory'], "%s.tar.gz" % data_manager.resource_name)
-                    if not os.path.exists(output_tar_file):
-                        with tarfile.open(output_tar_file, "w:gz") as tar:
-                            tar.add(job_info['outflow_file_name'], arcname=os.path.basename(job_info['outflow_file_name']))
-                    return_data = data_manager.upload_resource(output_tar_file)
-                    if not return_data['success']:
-                        print return_data
-                        print "Attempting to upload again"
-                        return_data = data_manager.upload_resource(output_tar_file)
-                        if not return_data['success']:
-                            print return_data
-                        else:
-                            print "Upload success"
-                    else:
-                        print "Upload success"
-                except Exception, e:
-                    print e
-                    pass
-                #remove tar.gz file
-                os.remove(output_tar_file)
-
-        #initialize flows for next run
-        if initialize_flows or create_warning_points:
-            #create new init flow files/generate warning point files
-            for rapid_input_directory in rapid_input_directories:
-                input_directory = os.path.join(rapid_io_files_location, 'input', rapid_input_directory)
-                path_to_watershed_files = os.path.join(rapid_io_files_location, 'output', rapid_input_directory)
-                forecast_date_timestep = None
-                #finds the current output from downscaled ECMWF forecasts
-                if os.path.exists(path_to_watershed_files):
-                    forecast_date_timestep = sorted([d for d in os.listdir(path_to_watershed_files) \
-                                            if os.path.isdir(os.path.join(path_to_watershed_files, d))],
-                                            reverse=True)[0]
-
-                if forecast_date_timestep:
-                    #loop through all the rapid_namelist files in directory
-                    forecast_directory = os.path.join(path_to_watershed_files, forecast_date_timestep)
-                    input_folder_split = rapid_input_directory.split("-")
-                    watershed = input_folder_split[0]
-                    subbasin = input_folder_split[1]
-                    if initialize_flows:
-                        print "Initializing flows for", watershed, subbasin, "from", forecast_date_timestep
-                        basin_files = find_current_rapid_output(forecast_directory, watershed, subbasin)
-                        try:
-                            compute_initial_rapid_flows(basin_files, input_directory, forecast_date_timestep)
-                        except Exception, ex:
-                            print ex
-                            pass
-
-                    era_interim_watershed_directory = os.path.join(era_interim_data_location, rapid_input_directory)
-                    if create_warning_points and os.path.exists(era_interim_watershed_directory):
-                        print "Generating Warning Points for", watershed, subbasin, "from", forecast_date_timestep
-                        era_interim_files = glob(os.path.join(era_interim_watershed_directory, "*.nc"))
-                        if era_interim_files:
-                            try:
-                                generate_warning_points(forecast_directory, era_interim_files[0], forecast_directory, threshold=10)
-                                if upload_output_to_ckan and data_store_url and data_store_api_key:
-                                    data_manager.initialize_run_ecmwf(watershed, subbasin, forecast_date_timestep)
-                                    data_manager.zip_upload_warning_points_in_directory(forecast_directory)
-                            except Exception, ex:
-                                print ex
-                                pass
-                        else:
-                            print "No ERA Interim file found. Skipping ..."
-                    else:
-                        print "No ERA Interim directory found for", rapid_input_directory, ". Skipping warning point generation..."
-
+        #delete watershed folder if empty
+        for item in os.listdir(os.path.join(rapid_io_files_location, 'output')):
+            try:
+                os.rmdir(os.path.join(rapid_io_files_location, 'output', item))
+            except OSError:
+                pass
+        output_packager.close()
 
-        if upload_output_to_ckan and data_store_url and data_store_api_key:
-            #delete local datasets
-            for job_info in job_info_list:
-                try:
-                    rmtree(job_info['master_watershed_outflow_directory'])
-                except OSError:
-                    pass
-            #delete watershed folder if empty
-            for item in os.listdir(os.path.join(rapid_io_files_location, 'output')):
-                try:
-                    os.rmdir(os.path.join(rapid_io_files_location, 'output', item))
-                except OSError:
-                    pass
+    if profile_stages:
+        write_hotspot_report(condor_init_dir,
+                             os.path.join(condor_init_dir,
+                                          'profile_report_%s.txt' % time_begin_all.strftime("%Y%m%d%H%M%S")),
+                             since=(time_begin_all - datetime.datetime(1970, 1, 1)).total_seconds())
 
     #print info to user
     time_end = datetime.datetime.utcnow()
@@ -372,4 +885,24 @@ if __name__ == "__main__":
         upload_output_to_ckan=True,
         initialize_flows=True,
         create_warning_points=True,
+        warm_start_from_qfinal=False,
+        num_upload_workers=4,
+        num_package_processes=None,
+        package_codec='gz',
+        package_compression_level=6,
+        submit_with_dag=False,
+        node_input_cache_directory=None,
+        node_input_cache_quota_gb=20,
+        crop_runoff_to_regions=False,
+        num_download_connections=4,
+        download_segments_per_file=1,
+        download_stream_extract=False,
+        watch_ecmwf=False,
+        watch_poll_interval_minutes=5,
+        watch_hours=24,
+        ecmwf_drop_directory=None,
+        profile_stages=False,
+        routing_engine="rapid",
+        batch_ensembles=False,
+        create_ensemble_cube=False,
     )
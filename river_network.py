@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Analysis of the river network in rapid_connect.csv as compact integer
+arrays and partitioning of large regions into subbasins that can be
+routed in parallel.
+
+A partition is routed after the partitions upstream of it (its stage is
+one more than the largest stage upstream, so all partitions of a stage
+can run in parallel). The flow leaving a partition at a cut reach is
+handed off to the reach below the cut at every routing time step, which
+only MuskingumRouter.route_partitions (muskingum_routing.py) does, so
+partitions can only be routed in-process. RAPID forcing (BS_opt_for)
+only takes the flow of each ZS_TauR interval and does not match routing
+the whole basin.
+"""
+import csv
+import heapq
+import json
+import os
+import sys
+
+import numpy as np
+
+def csv_to_list(csv_file, delimiter=','):
+    """
+    Reads in a CSV file and returns the contents as list,
+    where every row is stored as a sublist, and each element
+    in the sublist represents 1 cell in the table.
+
+    """
+    with open(csv_file, 'rb') as csv_con:
+        reader = csv.reader(csv_con, delimiter=delimiter)
+        return list(reader)
+
+class RiverNetwork(object):
+    """
+    Connectivity of a river network as integer arrays with the reaches
+    indexed in the order of comids.
+
+    downstream_indices is the index of the downstream reach of each reach
+    (-1 for the outlets of the network) and the upstream reaches of
+    reach i are upstream_indices[upstream_offsets[i]:upstream_offsets[i+1]]
+    (compressed sparse rows).
+    """
+    def __init__(self, comids, downstream_comids):
+        self.comids = np.asarray(comids, dtype=np.int64)
+        self.num_reaches = len(self.comids)
+        if len(np.unique(self.comids)) != self.num_reaches:
+            raise Exception("Duplicate COMIDs in river network")
+
+        #index of the downstream reach (-1 if not in the network)
+        downstream_comids = np.asarray(downstream_comids, dtype=np.int64)
+        comid_sorter = np.argsort(self.comids)
+        positions = np.searchsorted(self.comids, downstream_comids, sorter=comid_sorter)
+        positions[positions >= self.num_reaches] = 0
+        downstream_candidates = comid_sorter[positions] if self.num_reaches else positions
+        self.downstream_indices = np.where(self.comids[downstream_candidates] == downstream_comids,
+                                           downstream_candidates, -1).astype(np.int64)
+
+        has_downstream = self.downstream_indices >= 0
+        self.reaches_with_downstream = np.where(has_downstream)[0]
+        self.upstream_counts = np.bincount(self.downstream_indices[has_downstream],
+                                           minlength=self.num_reaches)
+        self.upstream_offsets = np.concatenate([[0], np.cumsum(self.upstream_counts)]).astype(np.int64)
+        self.upstream_indices = self.reaches_with_downstream[np.argsort(self.downstream_indices[has_downstream],
+                                                                        kind='mergesort')]
+        self.levels = self.get_topological_levels()
+
+    @classmethod
+    def from_rapid_connect(cls, rapid_connect_file, riv_bas_id_file=None):
+        """
+        Reads the river network from rapid_connect.csv. If riv_bas_id_file
+        is given, the network only has the reaches of the basin in the
+        order of riv_bas_id_file.
+        """
+        connect_table = csv_to_list(rapid_connect_file)
+        comids = np.array([int(float(row[0])) for row in connect_table], dtype=np.int64)
+        downstream_comids = np.array([int(float(row[1])) for row in connect_table], dtype=np.int64)
+        if riv_bas_id_file is None:
+            return cls(comids, downstream_comids)
+
+        basin_comids = np.array([int(float(row[0])) for row in csv_to_list(riv_bas_id_file) if row],
+                                dtype=np.int64)
+        connect_index = dict([(comid, index) for index, comid in enumerate(comids)])
+        try:
+            connect_indices = np.array([connect_index[comid] for comid in basin_comids], dtype=np.int64)
+        except KeyError as ex:
+            raise Exception("COMID %s in %s not found in %s" % (ex, riv_bas_id_file, rapid_connect_file))
+        return cls(basin_comids, downstream_comids[connect_indices])
+
+    def get_upstream_indices(self, reach_index):
+        """
+        Returns the indices of the reaches directly upstream of the reach
+        """
+        return self.upstream_indices[self.upstream_offsets[reach_index]:self.upstream_offsets[reach_index+1]]
+
+    def get_topological_levels(self):
+        """
+        Returns the reach indices of each level of the network from
+        upstream to downstream. All upstream reaches of a reach are in
+        earlier levels.
+        """
+        upstream_left = self.upstream_counts.copy()
+        frontier = np.where(upstream_left == 0)[0]
+        levels = []
+        num_scheduled = 0
+        while frontier.size:
+            levels.append(frontier)
+            num_scheduled += frontier.size
+            frontier_downstream = self.downstream_indices[frontier]
+            frontier_downstream = frontier_downstream[frontier_downstream >= 0]
+            np.subtract.at(upstream_left, frontier_downstream, 1)
+            frontier = np.unique(frontier_downstream[upstream_left[frontier_downstream] == 0])
+        if num_scheduled != self.num_reaches:
+            raise Exception("River network has a cycle. %s of %s reaches ordered." % (num_scheduled,
+                                                                                    self.num_reaches))
+        return levels
+
+    def get_topological_order(self):
+        """
+        Returns the reach indices ordered from upstream to downstream
+        """
+        if not self.levels:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(self.levels)
+
+    def get_outlet_indices(self):
+        """
+        Returns the indices of the reaches without a downstream reach
+        """
+        return np.where(self.downstream_indices < 0)[0]
+
+    def get_drainage_sizes(self):
+        """
+        Returns the number of reaches draining through each reach (itself included)
+        """
+        drainage_sizes = np.ones(self.num_reaches, dtype=np.int64)
+        for level in self.levels:
+            level_with_downstream = level[self.downstream_indices[level] >= 0]
+            np.add.at(drainage_sizes, self.downstream_indices[level_with_downstream],
+                      drainage_sizes[level_with_downstream])
+        return drainage_sizes
+
+    def get_root_indices(self, is_root):
+        """
+        Returns for each reach the index of the first root reach at or
+        downstream of it. Outlets must be roots.
+        """
+        root_indices = np.arange(self.num_reaches, dtype=np.int64)
+        for level in reversed(self.levels):
+            level_not_root = level[~is_root[level]]
+            root_indices[level_not_root] = root_indices[self.downstream_indices[level_not_root]]
+        return root_indices
+
+    def get_subtree_labels(self):
+        """
+        Returns the index of the outlet of each reach. Reaches with
+        different outlets are in independent subtrees.
+        """
+        return self.get_root_indices(self.downstream_indices < 0)
+
+    def get_max_level_width(self):
+        """
+        Returns the largest number of reaches in a level
+        """
+        return max([level.size for level in self.levels] + [0])
+
+    def get_summary(self):
+        """
+        Returns a summary of the network
+        """
+        return {'num_reaches' : self.num_reaches,
+                'max_upstream' : int(self.upstream_counts.max()) if self.num_reaches else 0,
+                'num_outlets' : len(self.get_outlet_indices()),
+                'num_levels' : len(self.levels),
+                'max_level_width' : self.get_max_level_width(),
+                'max_drainage_size' : int(self.get_drainage_sizes().max()) if self.num_reaches else 0,
+                }
+
+    def get_main_upstream_indices(self, sizes):
+        """
+        Returns for each reach the index of its upstream reach with the
+        largest size (-1 for headwater reaches)
+        """
+        main_upstream_indices = -np.ones(self.num_reaches, dtype=np.int64)
+        reaches = self.reaches_with_downstream
+        reach_order = np.lexsort((-sizes[reaches], self.downstream_indices[reaches]))
+        ordered_reaches = reaches[reach_order]
+        ordered_downstream = self.downstream_indices[ordered_reaches]
+        is_first = np.concatenate([[True], ordered_downstream[1:] != ordered_downstream[:-1]]) \
+            if ordered_reaches.size else np.array([], dtype=bool)
+        main_upstream_indices[ordered_downstream[is_first]] = ordered_reaches[is_first]
+        return main_upstream_indices
+
+    def partition(self, num_partitions):
+        """
+        Splits the network into about num_partitions subbasins with as few
+        stages as possible.
+
+        Reaches draining more than the target size (reaches/num_partitions)
+        are trunk reaches. The subtrees hanging off the trunks (and outlet
+        subtrees within the target size) do not depend on other partitions
+        and are routed in the first stage. The trunks are split at the
+        confluences of two trunks into mainstem segments, where the smaller
+        trunk hands off its outflow to the larger one, so a segment is
+        routed one stage after the deepest segment upstream of it. The
+        pieces of each stage are packed into partitions largest first with
+        a number of partitions in proportion to the reaches of the stage.
+
+        Returns a list of dictionaries with the keys:
+            index -- index of the partition
+            reach_indices -- reaches ordered from upstream to downstream
+            comids -- COMIDs of the reaches
+            stage -- partitions of a stage only depend on earlier stages
+            upstream_partitions -- indices of the partitions handing off flow to this one
+            boundary_inflows -- (upstream COMID, COMID in this partition) of each handoff in
+            outlet_handoffs -- (COMID in this partition, downstream COMID, downstream partition)
+        """
+        num_partitions = max(1, int(num_partitions))
+        target_size = int(np.ceil(self.num_reaches/float(num_partitions)))
+
+        #pieces start at the outlets, below trunk reaches and at the
+        #smaller trunk of a confluence of trunks
+        drainage_sizes = self.get_drainage_sizes()
+        is_trunk = drainage_sizes > target_size
+        main_upstream_indices = self.get_main_upstream_indices(drainage_sizes)
+        is_root = self.downstream_indices < 0
+        reaches = self.reaches_with_downstream
+        downstream_indices = self.downstream_indices[reaches]
+        is_root[reaches] = (is_trunk[reaches] != is_trunk[downstream_indices]) | \
+                           (is_trunk[reaches] & (main_upstream_indices[downstream_indices] != reaches))
+        root_indices = self.get_root_indices(is_root)
+        piece_sizes = np.bincount(root_indices, minlength=self.num_reaches)
+
+        #a piece is routed one stage after the pieces handing off flow to it
+        piece_stages = np.zeros(self.num_reaches, dtype=np.int64)
+        for level in self.levels:
+            level_cuts = level[is_root[level] & (self.downstream_indices[level] >= 0)]
+            np.maximum.at(piece_stages, root_indices[self.downstream_indices[level_cuts]],
+                          piece_stages[level_cuts] + 1)
+
+        #pack the pieces of each stage into partitions
+        piece_roots = np.where(is_root)[0]
+        root_partitions = np.empty(self.num_reaches, dtype=np.int64)
+        num_partitions = 0
+        for stage in range(int(piece_stages[piece_roots].max()) + 1 if piece_roots.size else 0):
+            stage_roots = piece_roots[piece_stages[piece_roots] == stage]
+            stage_size = piece_sizes[stage_roots].sum()
+            num_stage_partitions = min(len(stage_roots),
+                                       max(1, int(round(stage_size/float(max(target_size, 1))))))
+            partition_loads = [(0, num_partitions + bin_index) for bin_index in range(num_stage_partitions)]
+            for piece_root in stage_roots[np.argsort(-piece_sizes[stage_roots], kind='mergesort')]:
+                load, partition_index = heapq.heappop(partition_loads)
+                root_partitions[piece_root] = partition_index
+                heapq.heappush(partition_loads, (load + piece_sizes[piece_root], partition_index))
+            num_partitions += num_stage_partitions
+        reach_partitions = root_partitions[root_indices]
+
+        topological_order = self.get_topological_order()
+        cut_roots = topological_order[is_root[topological_order] & \
+                                      (self.downstream_indices[topological_order] >= 0)]
+        ordered_partitions = reach_partitions[topological_order]
+        partitions = []
+        for partition_index in range(num_partitions):
+            reach_indices = topological_order[ordered_partitions == partition_index]
+            partitions.append({'index' : partition_index,
+                               'reach_indices' : reach_indices,
+                               'comids' : self.comids[reach_indices],
+                               'stage' : 0,
+                               'upstream_partitions' : [],
+                               'boundary_inflows' : [],
+                               'outlet_handoffs' : [],
+                               })
+        for cut_root in cut_roots:
+            downstream_index = self.downstream_indices[cut_root]
+            upstream_partition = partitions[reach_partitions[cut_root]]
+            downstream_partition = partitions[reach_partitions[downstream_index]]
+            upstream_partition['outlet_handoffs'].append((int(self.comids[cut_root]),
+                                                          int(self.comids[downstream_index]),
+                                                          downstream_partition['index']))
+            downstream_partition['boundary_inflows'].append((int(self.comids[cut_root]),
+                                                             int(self.comids[downstream_index])))
+            if upstream_partition['index'] not in downstream_partition['upstream_partitions']:
+                downstream_partition['upstream_partitions'].append(upstream_partition['index'])
+
+        #partitions are numbered from upstream to downstream
+        for partition in partitions:
+            if partition['upstream_partitions']:
+                partition['stage'] = 1 + max([partitions[upstream_index]['stage'] \
+                                              for upstream_index in partition['upstream_partitions']])
+        return partitions
+
+def get_num_stages(partitions):
+    """
+    Returns the number of stages the partitions are routed in
+    """
+    return 1 + max([partition['stage'] for partition in partitions]) if partitions else 0
+
+def get_partition_summary(partitions):
+    """
+    Returns the partitions without their reach arrays for JSON
+    """
+    return [{'index' : partition['index'],
+             'num_reaches' : len(partition['reach_indices']),
+             'stage' : partition['stage'],
+             'upstream_partitions' : partition['upstream_partitions'],
+             'boundary_inflows' : partition['boundary_inflows'],
+             'outlet_handoffs' : partition['outlet_handoffs'],
+             } for partition in partitions]
+
+if __name__ == "__main__":
+    river_network = RiverNetwork.from_rapid_connect(os.path.join(sys.argv[1], 'rapid_connect.csv'))
+    print json.dumps(river_network.get_summary(), indent=2)
+    if len(sys.argv) > 2:
+        network_partitions = river_network.partition(int(sys.argv[2]))
+        print json.dumps({'num_partitions' : len(network_partitions),
+                          'num_stages' : get_num_stages(network_partitions),
+                          'partitions' : get_partition_summary(network_partitions),
+                          }, indent=2)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Journal of the state of every unit of work in a forecast cycle so that a
+restarted cycle only resumes incomplete work.
+
+Each forecast cycle (forecast_date_timestep, e.g. 20150730.0) has its own
+manifest run_manifest_<forecast_date_timestep>.jsonl, so a run restarted
+on another day still finds the manifest of the cycle it resumes.
+"""
+import datetime
+from glob import glob
+import json
+import os
+import threading
+
+#states of a unit in the order they are reached
+#converted means the output was packaged for upload
+UNIT_STATES = ['submitted', 'finished', 'converted', 'uploaded', 'post_processed']
+
+def get_job_unit_key(job_info):
+    """
+    Returns the manifest key of an ensemble-watershed job
+    """
+    return "%s/%s-%s/%s" % (job_info['forecast_date_timestep'], job_info['watershed'],
+                            job_info['subbasin'], job_info['ensemble_number'])
+
+def get_watershed_unit_key(rapid_input_directory, forecast_date_timestep):
+    """
+    Returns the manifest key of the post processing of a watershed forecast
+    """
+    return "%s/%s" % (forecast_date_timestep, rapid_input_directory)
+
+def is_state_reached(current_state, state):
+    """
+    Checks if a unit in current_state (None if not recorded) has reached the state
+    """
+    return current_state is not None and UNIT_STATES.index(current_state) >= UNIT_STATES.index(state)
+
+def get_unit_forecast_date_timestep(unit_key):
+    """
+    Returns the forecast cycle of a unit
+    """
+    return unit_key.split("/")[0]
+
+def get_run_manifest_file(manifest_directory, forecast_date_timestep):
+    """
+    Returns the manifest file of a forecast cycle
+    """
+    return os.path.join(manifest_directory, 'run_manifest_%s.jsonl' % forecast_date_timestep)
+
+def remove_old_run_manifests(manifest_directory, max_age_days=7):
+    """
+    Removes manifests of cycles older than max_age_days
+    """
+    date_limit = datetime.datetime.utcnow() - datetime.timedelta(max_age_days)
+    for manifest_file in glob(os.path.join(manifest_directory, 'run_manifest_*.jsonl')):
+        try:
+            manifest_date = datetime.datetime.strptime(os.path.basename(manifest_file)[len('run_manifest_'):][:8],
+                                                       "%Y%m%d")
+        except ValueError:
+            continue
+        if manifest_date < date_limit:
+            os.remove(manifest_file)
+
+class RunManifest(object):
+    """
+    Append-only JSON-lines journal of unit states. Each state change is
+    flushed to disk before returning so it survives a crash of the master.
+    The HTCondor cluster id of a submitted job is recorded with its state.
+    """
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.unit_states = {}
+        self.unit_cluster_ids = {}
+        self.lock = threading.Lock()
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'rb') as manifest_con:
+                lines = manifest_con.readlines()
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #partial line written during a crash
+                    continue
+                if record.get('cluster_id') is not None:
+                    self.unit_cluster_ids[record['unit']] = record['cluster_id']
+                #a job submitted again keeps the state reached before
+                if not is_state_reached(self.unit_states.get(record['unit']), record['state']):
+                    self.unit_states[record['unit']] = record['state']
+            if lines and not lines[-1].endswith("\n"):
+                #end the partial line so new records start on their own line
+                with open(manifest_file, 'ab') as manifest_con:
+                    manifest_con.write("\n")
+            print "Resuming run from manifest", manifest_file, \
+                "with", len(self.unit_states), "units recorded"
+
+    def get_state(self, unit_key):
+        """
+        Returns the current state of the unit or None
+        """
+        with self.lock:
+            return self.unit_states.get(unit_key)
+
+    def get_cluster_id(self, unit_key):
+        """
+        Returns the HTCondor cluster id last recorded for the unit or None
+        """
+        with self.lock:
+            return self.unit_cluster_ids.get(unit_key)
+
+    def has_reached(self, unit_key, state):
+        """
+        Checks if the unit has reached the state
+        """
+        return is_state_reached(self.get_state(unit_key), state)
+
+    def set_state(self, unit_key, state, cluster_id=None):
+        """
+        Records the new state of the unit and the cluster id of its job if
+        given. States never move backwards.
+        """
+        if state not in UNIT_STATES:
+            raise Exception("Invalid manifest state %s" % state)
+        if self.has_reached(unit_key, state) and \
+                (cluster_id is None or cluster_id == self.get_cluster_id(unit_key)):
+            return
+        record = {'unit' : unit_key,
+                  'state' : state,
+                  'time' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                  }
+        if cluster_id is not None:
+            record['cluster_id'] = cluster_id
+        with self.lock:
+            with open(self.manifest_file, 'ab') as manifest_con:
+                manifest_con.write("%s\n" % json.dumps(record))
+                manifest_con.flush()
+                os.fsync(manifest_con.fileno())
+            if not is_state_reached(self.unit_states.get(unit_key), state):
+                self.unit_states[unit_key] = state
+            if cluster_id is not None:
+                self.unit_cluster_ids[unit_key] = cluster_id
+
+    def set_job_state(self, job_info, state, cluster_id=None):
+        """
+        Records the new state of an ensemble-watershed job
+        """
+        self.set_state(get_job_unit_key(job_info), state, cluster_id)
+
+    def get_job_cluster_id(self, job_info):
+        """
+        Returns the HTCondor cluster id last recorded for an ensemble-watershed job
+        """
+        return self.get_cluster_id(get_job_unit_key(job_info))
+
+    def job_has_reached(self, job_info, state):
+        """
+        Checks if an ensemble-watershed job has reached the state
+        """
+        return self.has_reached(get_job_unit_key(job_info), state)
+
+class ForecastRunManifests(object):
+    """
+    Run manifests of the forecast cycles of a run. Each unit is recorded
+    in the manifest of its forecast cycle.
+    """
+    def __init__(self, manifest_directory):
+        self.manifest_directory = manifest_directory
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+    def get_manifest(self, forecast_date_timestep):
+        """
+        Returns the manifest of a forecast cycle
+        """
+        with self.lock:
+            if forecast_date_timestep not in self.manifests:
+                self.manifests[forecast_date_timestep] = \
+                    RunManifest(get_run_manifest_file(self.manifest_directory, forecast_date_timestep))
+            return self.manifests[forecast_date_timestep]
+
+    def get_manifest_file(self, forecast_date_timestep):
+        """
+        Returns the manifest file of a forecast cycle
+        """
+        return self.get_manifest(forecast_date_timestep).manifest_file
+
+    def get_unit_manifest(self, unit_key):
+        """
+        Returns the manifest of the forecast cycle of a unit
+        """
+        return self.get_manifest(get_unit_forecast_date_timestep(unit_key))
+
+    def get_state(self, unit_key):
+        """
+        Returns the current state of the unit or None
+        """
+        return self.get_unit_manifest(unit_key).get_state(unit_key)
+
+    def has_reached(self, unit_key, state):
+        """
+        Checks if the unit has reached the state
+        """
+        return self.get_unit_manifest(unit_key).has_reached(unit_key, state)
+
+    def set_state(self, unit_key, state, cluster_id=None):
+        """
+        Records the new state of the unit in the manifest of its cycle
+        """
+        self.get_unit_manifest(unit_key).set_state(unit_key, state, cluster_id)
+
+    def set_job_state(self, job_info, state, cluster_id=None):
+        """
+        Records the new state of an ensemble-watershed job
+        """
+        self.set_state(get_job_unit_key(job_info), state, cluster_id)
+
+    def get_job_cluster_id(self, job_info):
+        """
+        Returns the HTCondor cluster id last recorded for an ensemble-watershed job
+        """
+        unit_key = get_job_unit_key(job_info)
+        return self.get_unit_manifest(unit_key).get_cluster_id(unit_key)
+
+    def job_has_reached(self, job_info, state):
+        """
+        Checks if an ensemble-watershed job has reached the state
+        """
+        return self.has_reached(get_job_unit_key(job_info), state)
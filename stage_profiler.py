@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Opt-in profiling of the stages of the ECMWF-RAPID process.
+
+Profiling is enabled by setting the environment variable
+ERFP_PROFILE_STAGES=true (or the profile_stages option of the master
+process, which passes it on to the jobs). Each profiled stage writes
+next to its output:
+    profile_<stage>_<label>.prof -- cProfile statistics
+    profile_<stage>_<label>.json -- run time and memory of the stage
+    profile_<stage>_<label>.tracemalloc -- allocation snapshot (only if
+        the tracemalloc module is available)
+ERFP_PROFILE_DIRECTORY overrides the directory of the profiles.
+
+The profiles of all jobs of a cycle are merged into a hotspot report with
+write_hotspot_report or from the command line (since in seconds since
+epoch to only merge the stages of a cycle):
+    python stage_profiler.py profile_directory [report_file [since]]
+
+The peak RSS of a stage is the peak of its process up to the end of the
+stage (ru_maxrss), not of the stage alone.
+"""
+import cProfile
+from contextlib import contextmanager
+import datetime
+import functools
+from glob import glob
+import inspect
+import json
+import os
+import pstats
+import resource
+import socket
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PROFILE_ENVIRONMENT_VARIABLE = 'ERFP_PROFILE_STAGES'
+PROFILE_DIRECTORY_ENVIRONMENT_VARIABLE = 'ERFP_PROFILE_DIRECTORY'
+
+#only the outermost stage is profiled as profilers cannot be nested
+_active_stages = []
+
+def profiling_enabled():
+    """
+    Checks if profiling is enabled in the environment
+    """
+    return os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "").lower() in ("true", "1", "yes")
+
+def enable_profiling(profile_directory=None):
+    """
+    Enables profiling for this process and the processes it starts
+    """
+    os.environ[PROFILE_ENVIRONMENT_VARIABLE] = "true"
+    if profile_directory:
+        os.environ[PROFILE_DIRECTORY_ENVIRONMENT_VARIABLE] = profile_directory
+
+def get_profile_directory(output_directory=None):
+    """
+    Returns the directory for the profiles of a stage
+    """
+    return os.environ.get(PROFILE_DIRECTORY_ENVIRONMENT_VARIABLE) or output_directory or os.getcwd()
+
+@contextmanager
+def profile_stage(stage_name, output_directory=None, label=None):
+    """
+    Profiles the code run in the context as a stage if profiling is enabled
+    """
+    if not profiling_enabled() or _active_stages:
+        yield
+        return
+
+    if label is None:
+        label = "%s_%s" % (socket.gethostname(), os.getpid())
+    profile_base = os.path.join(get_profile_directory(output_directory),
+                                "profile_%s_%s_%s" % (stage_name, label,
+                                                      datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S%f")))
+    if tracemalloc is not None:
+        tracemalloc.start()
+    children_usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    profiler = cProfile.Profile()
+    _active_stages.append(stage_name)
+    time_start = time.time()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        seconds = time.time() - time_start
+        _active_stages.pop()
+        children_usage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        summary = {'stage' : stage_name,
+                   'label' : label,
+                   'host' : socket.gethostname(),
+                   'time_start' : time_start,
+                   'seconds' : seconds,
+                   #RAPID runs in a separate process
+                   'children_cpu_seconds' : (children_usage_end.ru_utime + children_usage_end.ru_stime) - \
+                                            (children_usage_start.ru_utime + children_usage_start.ru_stime),
+                   #peak of the process so far, including the stages before this one
+                   'process_peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   }
+        try:
+            profiler.dump_stats("%s.prof" % profile_base)
+            if tracemalloc is not None:
+                summary['traced_memory_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.take_snapshot().dump("%s.tracemalloc" % profile_base)
+                tracemalloc.stop()
+            with open("%s.json" % profile_base, 'wb') as summary_con:
+                json.dump(summary, summary_con)
+        except Exception as ex:
+            print "Error writing profile of", stage_name, ex
+            pass
+
+def profiled_stage(stage_name, output_directory_argument=None):
+    """
+    Decorator to profile a function as a stage if profiling is enabled.
+    The profiles are written to the directory in the argument
+    output_directory_argument of the function if given.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiling_enabled():
+                return function(*args, **kwargs)
+            output_directory = None
+            if output_directory_argument:
+                output_directory = inspect.getcallargs(function, *args, **kwargs).get(output_directory_argument)
+            with profile_stage(stage_name, output_directory):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_stage_profiles(profile_directory, since=None):
+    """
+    Returns the profiles in the directory as {stage: [profile summary]}.
+    Each summary has the file base name in profile_base. If since is given
+    (seconds since epoch), only stages started after that are returned.
+    """
+    stage_profiles = {}
+    for summary_file in glob(os.path.join(profile_directory, "profile_*.json")):
+        try:
+            with open(summary_file, 'rb') as summary_con:
+                summary = json.load(summary_con)
+        except ValueError:
+            continue
+        if since is not None and summary.get('time_start', 0) < since:
+            continue
+        summary['profile_base'] = os.path.splitext(summary_file)[0]
+        if os.path.exists("%s.prof" % summary['profile_base']):
+            stage_profiles.setdefault(summary['stage'], []).append(summary)
+    return stage_profiles
+
+def write_allocation_hotspots(report_con, profile_bases, top):
+    """
+    Writes the lines with the largest allocations summed over the snapshots
+    """
+    allocation_sizes = {}
+    for profile_base in profile_bases:
+        snapshot_file = "%s.tracemalloc" % profile_base
+        if not os.path.exists(snapshot_file):
+            continue
+        for statistic in tracemalloc.Snapshot.load(snapshot_file).statistics('lineno'):
+            frame = statistic.traceback[0]
+            location = "%s:%s" % (frame.filename, frame.lineno)
+            allocation_sizes[location] = allocation_sizes.get(location, 0) + statistic.size
+    if allocation_sizes:
+        report_con.write("\nLargest allocations at end of stage (summed over jobs):\n")
+        for location, size in sorted(allocation_sizes.iteritems(), key=lambda item: -item[1])[:top]:
+            report_con.write("  %10.1f MB  %s\n" % (size/(1024.0*1024.0), location))
+
+def write_hotspot_report(profile_directory, report_file=None, since=None, top=25):
+    """
+    Merges the profiles of all jobs in the directory by stage and writes a
+    report with the time of each stage and its functions with the largest
+    cumulative time. The merged profile of each stage is written to
+    profile_merged_<stage>.prof. Returns the report file.
+    """
+    if report_file is None:
+        report_file = os.path.join(profile_directory, 'profile_report.txt')
+    stage_profiles = get_stage_profiles(profile_directory, since)
+    if not stage_profiles:
+        print "No stage profiles found in", profile_directory
+        return None
+
+    temp_report_file = "%s.%s.tmp" % (report_file, os.getpid())
+    with open(temp_report_file, 'wb') as report_con:
+        report_con.write("Stage hotspot report for %s\n" % profile_directory)
+        report_con.write("Generated %s\n\n" % datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+        report_con.write("%-32s %6s %12s %10s %10s %14s %18s\n" % ("stage", "runs", "total (s)", "mean (s)",
+                                                                  "max (s)", "child cpu (s)",
+                                                                  "proc peak rss (MB)"))
+        stage_totals = sorted([(sum([summary['seconds'] for summary in summaries]), stage) \
+                               for stage, summaries in stage_profiles.iteritems()], reverse=True)
+        for total_seconds, stage in stage_totals:
+            summaries = stage_profiles[stage]
+            report_con.write("%-32s %6d %12.1f %10.2f %10.2f %14.1f %18.1f\n" % \
+                             (stage, len(summaries), total_seconds, total_seconds/len(summaries),
+                              max([summary['seconds'] for summary in summaries]),
+                              sum([summary.get('children_cpu_seconds', 0) for summary in summaries]),
+                              max([summary.get('process_peak_rss_kb', summary.get('max_rss_kb', 0)) \
+                                   for summary in summaries])/1024.0))
+
+        for total_seconds, stage in stage_totals:
+            profile_bases = [summary['profile_base'] for summary in stage_profiles[stage]]
+            report_con.write("\n%s\n%s (%d runs)\n%s\n" % ("="*80, stage, len(profile_bases), "="*80))
+            stats = pstats.Stats(*["%s.prof" % profile_base for profile_base in profile_bases],
+                                 stream=report_con)
+            stats.dump_stats(os.path.join(profile_directory, 'profile_merged_%s.prof' % stage))
+            stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+            if tracemalloc is not None:
+                write_allocation_hotspots(report_con, profile_bases, top)
+    os.rename(temp_report_file, report_file)
+    print "Stage hotspot report written to", report_file
+    return report_file
+
+if __name__ == "__main__":
+    write_hotspot_report(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None,
+                         float(sys.argv[3]) if len(sys.argv) > 3 else None)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Uploads RAPID outputs to the data store concurrently with a bounded pool
+of worker threads.
+"""
+import datetime
+import fcntl
+import json
+import os
+from Queue import Queue
+import random
+import tempfile
+import threading
+import time
+
+#local imports
+from output_packager import package_file
+
+class UploadManager(object):
+    """
+    Uploads RAPID output files with a pool of worker threads.
+
+    Each worker creates its own data manager with data_manager_factory as
+    the dataset managers keep the current resource as state. Failed uploads
+    are retried with exponential backoff. Successful uploads are recorded
+    by resource name in upload_record_file so that a resource is not
+    uploaded twice when the process is run again.
+
+    Use with a local HTTP stand-in for CKAN by passing a factory that
+    creates the data manager with the stand-in url (see
+    benchmarks/upload_benchmark.py).
+
+    If an OutputPackager is given, outputs are compressed in its process
+    pool and each archive is queued for upload as soon as it is written.
+
+    If given, state_callback(job_info, state) is called with 'converted'
+    when the output is packaged and with 'uploaded' after the upload.
+    """
+    def __init__(self, data_manager_factory, upload_record_file,
+                 num_workers=4, max_attempts=5, backoff_seconds=2,
+                 max_backoff_seconds=120, record_lifetime_days=7,
+                 packager=None, state_callback=None):
+        self.data_manager_factory = data_manager_factory
+        self.packager = packager
+        self.state_callback = state_callback
+        self.upload_record_file = upload_record_file
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.record_lifetime_days = record_lifetime_days
+        self.upload_stats = []
+        self.upload_queue = Queue()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.upload_record = self.read_upload_record()
+        self.workers = []
+
+    def read_upload_record(self):
+        """
+        Reads in the record of completed uploads and removes old entries.
+        The record is shared by the processes uploading at the same time
+        (e.g. the post processing nodes of a DAG).
+        """
+        upload_record = {}
+        if os.path.exists(self.upload_record_file):
+            try:
+                with open(self.upload_record_file, 'rb') as record_file:
+                    upload_record = json.load(record_file)
+            except ValueError:
+                print "Invalid upload record", self.upload_record_file, ". Starting new record ..."
+        date_limit = datetime.datetime.utcnow() - datetime.timedelta(self.record_lifetime_days)
+        return dict([(resource_name, record) for resource_name, record in upload_record.iteritems() \
+                     if datetime.datetime.strptime(record['uploaded'], "%Y-%m-%dT%H:%M:%S") > date_limit])
+
+    def write_upload_record(self):
+        """
+        Merges the uploads of this process into the record of completed
+        uploads under a lock file shared with the other processes and
+        writes it through a unique temporary file (call with lock held)
+        """
+        lock_file = open("%s.lock" % self.upload_record_file, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            upload_record = self.read_upload_record()
+            upload_record.update(self.upload_record)
+            record_fd, temp_record_file = tempfile.mkstemp(prefix="%s." % os.path.basename(self.upload_record_file),
+                                                           suffix=".tmp",
+                                                           dir=os.path.dirname(os.path.abspath(self.upload_record_file)))
+            try:
+                with os.fdopen(record_fd, 'wb') as record_file:
+                    json.dump(upload_record, record_file)
+                os.rename(temp_record_file, self.upload_record_file)
+            except Exception:
+                try:
+                    os.remove(temp_record_file)
+                except OSError:
+                    pass
+                raise
+            self.upload_record = upload_record
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def is_uploaded(self, resource_name, file_size):
+        """
+        Checks if the resource was already uploaded from a file of the same size
+        """
+        with self.lock:
+            record = self.upload_record.get(resource_name)
+        return record is not None and record['size'] == file_size
+
+    def start(self):
+        """
+        Starts the upload worker threads
+        """
+        for worker_index in range(self.num_workers):
+            worker = threading.Thread(target=self.upload_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def add_upload(self, job_info):
+        """
+        Adds the output of a finished job to the upload queue
+        """
+        if not self.workers:
+            self.start()
+        data_manager = self.get_data_manager()
+        resource_name = self.get_resource_name(data_manager, job_info)
+        output_file = job_info['outflow_file_name']
+        file_size = os.path.getsize(output_file)
+        if self.is_uploaded(resource_name, file_size):
+            print resource_name, "already uploaded. Skipping ..."
+            self.update_state(job_info, 'uploaded')
+            return
+
+        archive_base = os.path.join(job_info['master_watershed_outflow_directory'], resource_name)
+        if self.packager is None:
+            self.upload_queue.put((job_info, resource_name, archive_base, None, file_size))
+        else:
+            def queue_upload(archive_file):
+                if archive_file is None:
+                    print "Packaging failed for", resource_name, ". Skipping upload ..."
+                else:
+                    self.update_state(job_info, 'converted')
+                    self.upload_queue.put((job_info, resource_name, archive_base, archive_file, file_size))
+            self.packager.package_output(output_file, archive_base, queue_upload)
+
+    def wait_for_uploads(self):
+        """
+        Blocks until all queued uploads are done and stops the workers
+        """
+        if self.packager is not None:
+            self.packager.wait_for_packages()
+        self.upload_queue.join()
+        for worker in self.workers:
+            self.upload_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def update_state(self, job_info, state):
+        """
+        Reports the new state of the job output to the state callback
+        """
+        if self.state_callback is not None:
+            try:
+                self.state_callback(job_info, state)
+            except Exception, ex:
+                print ex
+                pass
+
+    def get_data_manager(self):
+        """
+        Returns the data manager of the current worker thread
+        """
+        if not hasattr(self.local, 'data_manager'):
+            self.local.data_manager = self.data_manager_factory()
+        return self.local.data_manager
+
+    def upload_worker(self):
+        """
+        Uploads items from the queue until a None item is found
+        """
+        while True:
+            upload_item = self.upload_queue.get()
+            try:
+                if upload_item is None:
+                    return
+                self.upload_job_output(*upload_item)
+            except Exception, ex:
+                print ex
+                pass
+            finally:
+                self.upload_queue.task_done()
+
+    def get_resource_name(self, data_manager, job_info):
+        """
+        Sets the data manager to the resource of the job and returns its name
+        """
+        data_manager.initialize_run_ecmwf(job_info['watershed'], job_info['subbasin'],
+                                          job_info['forecast_date_timestep'])
+        data_manager.update_resource_ensemble_number(job_info['ensemble_number'])
+        return data_manager.resource_name
+
+    def upload_job_output(self, job_info, resource_name, archive_base, archive_file, file_size):
+        """
+        Uploads the packaged RAPID output of a job with retries
+        """
+        data_manager = self.get_data_manager()
+        self.get_resource_name(data_manager, job_info)
+        try:
+            if archive_file is None:
+                archive_file = package_file(job_info['outflow_file_name'], archive_base)
+                if archive_file is None:
+                    return
+                self.update_state(job_info, 'converted')
+            if self.upload_file(data_manager, resource_name, archive_file, file_size):
+                self.update_state(job_info, 'uploaded')
+        finally:
+            #remove archive file
+            if archive_file is not None:
+                try:
+                    os.remove(archive_file)
+                except OSError:
+                    pass
+
+    def upload_file(self, data_manager, resource_name, upload_file, file_size):
+        """
+        Uploads a file with exponential backoff between attempts
+        """
+        upload_size = os.path.getsize(upload_file)
+        for attempt in range(self.max_attempts):
+            time_start = time.time()
+            try:
+                return_data = data_manager.upload_resource(upload_file)
+            except Exception, ex:
+                return_data = {'success' : False, 'error' : str(ex)}
+            upload_seconds = time.time() - time_start
+            if return_data['success']:
+                with self.lock:
+                    self.upload_stats.append({'resource_name' : resource_name,
+                                              'bytes' : upload_size,
+                                              'seconds' : upload_seconds,
+                                              'attempts' : attempt + 1,
+                                              })
+                    self.upload_record[resource_name] = {'size' : file_size,
+                                                         'uploaded' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                                                         }
+                    self.write_upload_record()
+                print "Upload success", resource_name, \
+                    "%0.1f Kb/s" % (upload_size/(1024*max(upload_seconds, 0.001)))
+                return True
+
+            print return_data
+            if attempt + 1 < self.max_attempts:
+                backoff = min(self.max_backoff_seconds, self.backoff_seconds*2**attempt)
+                backoff *= random.uniform(0.5, 1.0)
+                print "Attempting to upload", resource_name, "again in %0.1f seconds" % backoff
+                time.sleep(backoff)
+
+        print "Upload failed", resource_name
+        with self.lock:
+            self.upload_stats.append({'resource_name' : resource_name,
+                                      'bytes' : 0,
+                                      'seconds' : 0,
+                                      'attempts' : self.max_attempts,
+                                      })
+        return False
+
+    def print_upload_summary(self):
+        """
+        Prints the number of uploads and aggregate throughput
+        """
+        with self.lock:
+            upload_stats = list(self.upload_stats)
+        num_success = len([stat for stat in upload_stats if stat['bytes'] > 0])
+        total_bytes = sum([stat['bytes'] for stat in upload_stats])
+        total_seconds = sum([stat['seconds'] for stat in upload_stats])
+        print "Uploads succeeded: %s of %s" % (num_success, len(upload_stats))
+        if total_seconds > 0:
+            print "Upload throughput per worker: %0.1f Kb/s" % (total_bytes/(1024*total_seconds))